@@ -0,0 +1,74 @@
+#!/usr/bin/env python
+"""Compare the time and peak memory of decoding a large departures response
+in full with the standard library, and of decoding only the departures of one
+traffic type with `decoding.decode_departures`, both selectively and as a
+response filtered by the API, with and without orjson. The responses hold
+either all traffic types, or only the one asked for, like the responses of
+the API when the others are left out by `departure_url`.
+Run with: python benchmarks/bench_decoding.py [count]
+"""
+
+import json
+import sys
+import timeit
+import tracemalloc
+
+from check_sl_delay import decoding, fakeapi
+
+TRAFFIC_TYPES = ['Metros']
+
+
+def peak_memory(function, content):
+    "Return the peak memory, in bytes, allocated while running `function`."
+    tracemalloc.start()
+    function(content)
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return peak
+
+
+def selective(content):
+    "Decode the departures of `TRAFFIC_TYPES` from `content`."
+    return decoding.decode_departures(content, TRAFFIC_TYPES)
+
+
+def filtered(content):
+    """Decode the departures of `TRAFFIC_TYPES` from `content`, as filtered
+    by the API."""
+    return decoding.decode_departures(content, TRAFFIC_TYPES, True)
+
+
+def main(count=3000):
+    "Run the benchmark and print the results."
+    orjson = decoding.orjson
+    decoders = [('json.loads', json.loads), ('selective', selective)]
+    if orjson is not None:
+        decoders.append(('filtered (orjson)', filtered))
+    decoders.append(('filtered (json)', filtered))
+
+    for description, traffic_types in (('all traffic types',
+                                        ('Metros', 'Buses', 'Trains', 'Trams',
+                                         'Ships')), ('one traffic type',
+                                                     TRAFFIC_TYPES)):
+        content = json.dumps(fakeapi.generate_response(
+            count, traffic_types)).encode('utf-8')
+        print(
+            str(count) + ' departures of ' + description + ', ' +
+            str(len(content) // 1000) + ' kB, best of 5')
+        print('decoder'.ljust(20) + 'ms'.rjust(11) + 'peak kB'.rjust(13))
+        for name, function in decoders:
+            decoding.orjson = orjson if name == 'filtered (orjson)' else None
+            elapsed = min(
+                timeit.repeat(lambda function=function, content=content:
+                              function(content),
+                              number=1,
+                              repeat=5))
+            print(
+                name.ljust(20) + format(elapsed * 1000, '11.1f') +
+                format(peak_memory(function, content) / 1000, '13.0f'))
+        decoding.orjson = orjson
+        print()
+
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 3000)
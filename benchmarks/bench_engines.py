@@ -0,0 +1,66 @@
+#!/usr/bin/env python
+"""Compare the wall time of a batch of checks for the different engines.
+
+The checks are run against a local stand-in for the SL APIs, which adds a
+fixed latency to every request, to show how well the engines overlap the
+network waits. Run with: python benchmarks/bench_engines.py [checks] [latency]
+"""
+
+import sys
+import time
+
+from check_sl_delay import check_sl_delay, fakeapi
+
+API_KEY = '0' * 32
+
+
+def bench(rows, engine, workers):
+    "Return the wall time, in seconds, of running all `rows`."
+    start = time.perf_counter()
+    results = check_sl_delay.run_checks(API_KEY,
+                                        API_KEY,
+                                        60,
+                                        rows,
+                                        60,
+                                        workers=workers,
+                                        engine=engine)
+    elapsed = time.perf_counter() - start
+    assert all(state in (0, 1, 2) for state, _ in results), results
+    return elapsed
+
+
+def main(checks=100, latency=0.05):
+    "Run the benchmark and print the results."
+    server = fakeapi.start_server({'': fakeapi.generate_response(200)},
+                                  latency=latency)
+    (check_sl_delay.SITE_API_URL,
+     check_sl_delay.DEPARTURE_API_URL) = fakeapi.api_urls(server.base_url)
+
+    rows = [{
+        'site_id': 1000 + number,
+        'traffic_type': 'METRO',
+        'minutes': 1,
+        'warning': 20,
+        'critical': 30,
+        'service': ''
+    } for number in range(checks)]
+
+    print(
+        str(checks) + ' checks, ' + format(latency * 1000, '.0f') +
+        ' ms latency per request')
+    print('engine'.ljust(24) + 'seconds'.rjust(11) + 'checks/s'.rjust(13))
+    for name, engine, workers in (('sequential', 'threads', 1),
+                                  ('threads (16 workers)', 'threads', 16),
+                                  ('async (32 in flight)', 'async', 32)):
+        elapsed = bench(rows, engine, workers)
+        print(
+            name.ljust(24) + format(elapsed, '11.3f') +
+            format(checks / elapsed, '13.1f'))
+
+    server.shutdown()
+    server.server_close()
+
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 100,
+         float(sys.argv[2]) if len(sys.argv) > 2 else 0.05)
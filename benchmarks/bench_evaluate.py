@@ -0,0 +1,50 @@
+#!/usr/bin/env python
+"""Compare the evaluation of large departure responses by the list pipeline
+(`diffs_from_response`, `compare_to_threshold` and
+`calculate_percentage_of_offenders`) and by the single pass of
+`evaluate_departures`. Run with: python benchmarks/bench_evaluate.py [count]
+"""
+
+import sys
+import timeit
+
+from check_sl_delay import check_sl_delay, fakeapi
+
+THRESHOLD = 3
+
+
+def pipeline(response):
+    "Evaluate `response` by building the intermediate lists."
+    return check_sl_delay.calculate_percentage_of_offenders(
+        check_sl_delay.compare_to_threshold(
+            check_sl_delay.diffs_from_response(response, 'Buses'), THRESHOLD))
+
+
+def single_pass(response):
+    "Evaluate `response` in a single pass."
+    evaluation = check_sl_delay.evaluate_departures(response, 'Buses',
+                                                    THRESHOLD)
+    return check_sl_delay.calculate_percentage(evaluation['offenders'],
+                                               evaluation['total'])
+
+
+def main(count=10000):
+    "Run the benchmark and print the results."
+    response = fakeapi.generate_response(count, ('Buses', ))
+    assert pipeline(response) == single_pass(response)
+
+    print(str(count) + ' departures, best of 5')
+    print('evaluator'.ljust(12) + 'ms'.rjust(11) + 'us/departure'.rjust(17))
+    for name, function in (('pipeline', pipeline), ('single pass',
+                                                    single_pass)):
+        elapsed = min(
+            timeit.repeat(lambda function=function: function(response),
+                          number=1,
+                          repeat=5))
+        print(
+            name.ljust(12) + format(elapsed * 1000, '11.1f') +
+            format(elapsed * 1e6 / count, '17.2f'))
+
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 10000)
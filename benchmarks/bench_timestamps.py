@@ -0,0 +1,48 @@
+#!/usr/bin/env python
+"""Compare the cost per departure of parsing its two timestamps with
+`datetime.strptime` and with `parse_datetime`, with and without its cache.
+Run with: python benchmarks/bench_timestamps.py [count]
+"""
+
+from datetime import datetime
+import sys
+import timeit
+
+from check_sl_delay import check_sl_delay, fakeapi
+
+
+def parse_all(parse, departures):
+    "Parse both timestamps of all `departures` with `parse`."
+    for departure in departures:
+        parse(departure['TimeTabledDateTime'])
+        parse(departure['ExpectedDateTime'])
+
+
+def main(count=10000):
+    "Run the benchmark and print the results."
+    departures = fakeapi.generate_response(
+        count, ('Buses', ))['ResponseData']['Buses']
+
+    def strptime(text):
+        return datetime.strptime(text, check_sl_delay.DATETIME_FORMAT)
+
+    def cold_cache(text):
+        check_sl_delay.parse_datetime.cache_clear()
+        return check_sl_delay.parse_datetime(text)
+
+    print(str(count) + ' departures, best of 5')
+    print('parser'.ljust(26) + 'us/departure'.rjust(17))
+    for name, parse in (('datetime.strptime', strptime),
+                        ('parse_datetime, no cache',
+                         check_sl_delay.parse_datetime.__wrapped__),
+                        ('parse_datetime, cold cache', cold_cache),
+                        ('parse_datetime', check_sl_delay.parse_datetime)):
+        elapsed = min(
+            timeit.repeat(lambda parse=parse: parse_all(parse, departures),
+                          number=1,
+                          repeat=5))
+        print(name.ljust(26) + format(elapsed * 1e6 / count, '17.3f'))
+
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 10000)
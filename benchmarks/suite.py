@@ -0,0 +1,247 @@
+#!/usr/bin/env python
+"""Benchmark suite of the stages of a check, of single checks end to end and
+of batches of checks, compared to stored baselines.
+
+The stages are run on responses from `fakeapi.generate_response` with
+--sizes departures spread over all traffic types, and the checks against a
+local `fakeapi` server answering with --check-size departures per site.
+The benchmarks are run in --rounds rounds, each of them after a fixed
+calibration loop, which the times of the round are divided by, so that a
+baseline saved on one machine can be compared on another. Every benchmark
+keeps its best relative time of all rounds, and the spread between its best
+and worst round, which measures the noise of the machine. The baselines store
+both, and the run fails if any benchmark is more than --threshold plus the
+spread of its baseline slower than the baseline.
+
+Run with: python benchmarks/suite.py [--sizes 10,1000] [--check-size 1000]
+[--filter stage/] [--rounds 3] [--save] [--baseline FILE] [--threshold 0.25]
+"""
+
+import argparse
+import json
+import os
+import sys
+import timeit
+
+from check_sl_delay import check_sl_delay, decoding, fakeapi
+
+API_KEY = '0' * 32
+
+TRAFFIC_TYPES = tuple(check_sl_delay.TRAFFIC_TYPE_API_FORMAT_OPTIONS.values())
+
+THRESHOLDS = [1, 3, 5]
+
+DEFAULT_BASELINE = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                'baseline.json')
+
+
+def best_time(function, repeat=7):
+    """Return the best time, in seconds, of a call of `function`, running it
+    enough times per repeat to be measurable."""
+    timer = timeit.Timer(function)
+    number = timer.autorange()[0]
+    return min(timer.repeat(repeat=repeat, number=number)) / number
+
+
+def calibrate():
+    """Return the best time of a fixed loop, which all times are divided by.
+    It is repeated more than the benchmarks, since all of them depend on it."""
+    return best_time(lambda: sum(number * number for number in range(10000)),
+                     25)
+
+
+def stage_benchmarks(size):
+    "Return the benchmarks of the stages of a check of `size` departures."
+    response = fakeapi.generate_response(size, TRAFFIC_TYPES)
+    content = json.dumps(response).encode('utf-8')
+    departures = check_sl_delay.extract_departures(response, 'Buses')
+    delays = check_sl_delay.sorted_delays(response, 'Buses')
+    return {
+        'decode': lambda: decoding.loads(content),
+        'decode_selective':
+        lambda: decoding.decode_departures(content, ['Buses']),
+        'extract_departures':
+        lambda: check_sl_delay.extract_departures(response, 'Buses'),
+        'calculate_delays':
+        lambda: check_sl_delay.calculate_delays(departures),
+        'evaluate_departures':
+        lambda: check_sl_delay.evaluate_departures(response, 'Buses', 3),
+        'calculate_type_values':
+        lambda: check_sl_delay.calculate_type_values(
+            response, list(TRAFFIC_TYPES), THRESHOLDS),
+        'delay_statistics': lambda: check_sl_delay.delay_statistics(delays)
+    }
+
+
+def rows(count):
+    "Return `count` rows of a sites file, for different sites."
+    return [{
+        'site_id': 1000 + number,
+        'traffic_type': 'METRO',
+        'minutes': THRESHOLDS,
+        'warning': 20,
+        'critical': 30,
+        'service': str(number)
+    } for number in range(count)]
+
+
+def check_benchmarks():
+    """Return the benchmarks of a single check and of a batch of checks,
+    against the server which the plugin is pointed at."""
+    row = rows(1)[0]
+    batch = rows(50)
+
+    def single_check():
+        state, output = check_sl_delay.run_check(API_KEY, API_KEY, 60, row,
+                                                 10)
+        assert state in (0, 1, 2), output
+
+    def batch_of_checks():
+        results = check_sl_delay.run_checks(API_KEY,
+                                            API_KEY,
+                                            60,
+                                            batch,
+                                            10,
+                                            workers=8)
+        assert all(state in (0, 1, 2) for state, _ in results), results
+
+    return {'single': single_check, 'batch_50_sites': batch_of_checks}
+
+
+def run_round(sizes, check_size, name_filter=''):
+    """Run all benchmarks whose name contains `name_filter` once, and return
+    their best times, and the time of the calibration loop run before them."""
+    times = {}
+
+    def measure(name, function, repeat=7):
+        if name_filter not in name:
+            return
+        # Warm up the caches and allocations of the benchmark first.
+        function()
+        times[name] = best_time(function, repeat)
+
+    calibration = calibrate()
+    for size in sizes:
+        for stage, function in stage_benchmarks(size).items():
+            measure('stage/' + stage + '/' + str(size), function)
+
+    server = fakeapi.start_server(
+        {'': fakeapi.generate_response(check_size, TRAFFIC_TYPES)})
+    check_sl_delay.configure_api_urls(server.base_url)
+    try:
+        for check, function in check_benchmarks().items():
+            measure('check/' + check + '/' + str(check_size), function, 3)
+    finally:
+        check_sl_delay.configure_api_urls()
+        server.shutdown()
+        server.server_close()
+
+    return times, calibration
+
+
+def run(sizes, check_size, name_filter='', rounds=3):
+    """Run all benchmarks whose name contains `name_filter` in `rounds`
+    rounds, and return their best time divided by the calibration time of its
+    round, and the spread of these times between the rounds, keyed by name."""
+    ratios = {}
+    best_times = {}
+    for number in range(rounds):
+        print('Round ' + str(number + 1) + ' of ' + str(rounds))
+        times, calibration = run_round(sizes, check_size, name_filter)
+        for name, elapsed in times.items():
+            ratios.setdefault(name, []).append(elapsed / calibration)
+            best_times[name] = min(best_times.get(name, elapsed), elapsed)
+
+    results = {}
+    for name, values in ratios.items():
+        results[name] = {
+            'time': min(values),
+            'spread': max(values) / min(values) - 1
+        }
+        print(
+            name.ljust(40) + format(best_times[name] * 1000, '13.3f') +
+            ' ms ' + format(results[name]['spread'], '8.0%') + ' spread')
+    return results
+
+
+def regressions(results, baseline, threshold):
+    """Return the names and relative changes of the `results` which are more
+    than `threshold` plus the spread of their `baseline` slower than it."""
+    return [(name, results[name]['time'] / baseline[name]['time'] - 1)
+            for name in sorted(results) if name in baseline
+            and results[name]['time'] > baseline[name]['time'] *
+            (1 + threshold + baseline[name]['spread'])]
+
+
+def main(argv=None):
+    """Run the benchmarks, and save them as the baseline or exit with 1 if any
+    of them has regressed."""
+    parser = argparse.ArgumentParser(
+        description='Benchmark the stages and checks of check_sl_delay.')
+    parser.add_argument('--sizes',
+                        default='10,1000,100000',
+                        type=lambda text: [int(size) for size in
+                                           text.split(',')],
+                        help='Comma separated numbers of departures.')
+    parser.add_argument('--check-size',
+                        default=1000,
+                        type=int,
+                        help='Number of departures of the checked sites.')
+    parser.add_argument('--filter',
+                        default='',
+                        help='Only run the benchmarks containing this.')
+    parser.add_argument('--baseline',
+                        default=DEFAULT_BASELINE,
+                        help='File of the stored baselines.')
+    parser.add_argument('--threshold',
+                        default=0.25,
+                        type=float,
+                        help=('Fail if a benchmark is this much slower than ' +
+                              'its baseline, plus the spread of the ' +
+                              'baseline, 0.25 meaning 25%%.'))
+    parser.add_argument('--rounds',
+                        default=3,
+                        type=int,
+                        help='Number of rounds to run the benchmarks in.')
+    parser.add_argument('--save',
+                        action='store_true',
+                        help='Save the results as the baselines.')
+    args = parser.parse_args(argv)
+
+    results = run(args.sizes, args.check_size, args.filter, args.rounds)
+
+    if args.save:
+        baseline = {}
+        if os.path.exists(args.baseline):
+            with open(args.baseline, encoding='utf-8') as baseline_file:
+                baseline = json.load(baseline_file)
+        baseline.update({
+            name: {
+                key: float(format(value, '.4g'))
+                for key, value in result.items()
+            }
+            for name, result in results.items()
+        })
+        with open(args.baseline, 'w', encoding='utf-8') as baseline_file:
+            json.dump(baseline, baseline_file, indent=4, sort_keys=True)
+            baseline_file.write('\n')
+        print('Saved the baselines in ' + args.baseline)
+        return
+
+    if not os.path.exists(args.baseline):
+        print('No baselines in ' + args.baseline + ', save them with --save')
+        return
+    with open(args.baseline, encoding='utf-8') as baseline_file:
+        baseline = json.load(baseline_file)
+    slower = regressions(results, baseline, args.threshold)
+    for name, change in slower:
+        print('Regression: ' + name + ' is ' + format(change, '.0%') +
+              ' slower than its baseline')
+    if slower:
+        sys.exit(1)
+    print('No regressions of more than ' + format(args.threshold, '.0%') +
+          ' plus the spread of the baselines')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,341 @@
+"""asyncio engine, running all checks of a batch over a single event loop.
+
+This engine requires the optional dependency aiohttp, which is installed with
+`pip install check_sl_delay[async]`. The parsing and evaluation of the API
+responses is shared with the default engine in `check_sl_delay`."""
+
+# pylint: disable=too-many-arguments,too-many-locals
+
+import asyncio
+import json
+import time
+import click
+
+try:
+    import aiohttp
+except ImportError:
+    aiohttp = None
+
+from check_sl_delay import check_sl_delay as plugin
+from check_sl_delay import decoding, scheduler
+
+
+async def wait_for_rate_limit(api):
+    """Wait until the rate limit of `api` allows another request, like
+    `check_sl_delay.wait_for_rate_limit`. The request is given up by
+    cancelling the wait."""
+    limit = scheduler.rate_limit(api)
+    wait = limit.reserve()
+    try:
+        await asyncio.sleep(wait)
+    except asyncio.CancelledError:
+        limit.cancel(wait)
+        raise
+
+
+async def fetch_json(session,
+                     semaphore,
+                     url,
+                     request_timeout,
+                     verbosity=0,
+                     api=None,
+                     metrics=None,
+                     traffic_types=None,
+                     stage_times=None,
+                     validators=None):
+    """Fetch `url` and return the decoded JSON, exiting the plugin on errors.
+    The request is subject to the rate limit of `api`, if given. The size of
+    the download and the time taken to decode it are recorded in
+    `metrics`. Only the departures of `traffic_types` are decoded, if given,
+    see `decoding.decode_departures`.
+
+    The times of the request, as the 'site' stage for the site API and
+    otherwise as the 'api' stage, and of the decoding are recorded in
+    `stage_times`, see `check_sl_delay.record_timing`. Connections are not
+    timed separately by this engine.
+
+    If a dictionary of `validators` of an earlier response is given, the
+    response is only sent if it has changed since then, and None is returned
+    if it has not, like `check_sl_delay.fetch_response`."""
+    # Output for -vv:
+    plugin.maybe_output(print_on_levels=[2],
+                        actual_level=verbosity,
+                        msg='URL: %s (fetch_json)',
+                        args=(url, ),
+                        stage='site' if api == 'site' else 'api')
+
+    if api is not None:
+        await wait_for_rate_limit(api)
+
+    try:
+        async with semaphore:
+            request_start = time.perf_counter()
+            async with session.get(
+                    url,
+                    headers=plugin.conditional_headers(validators),
+                    timeout=aiohttp.ClientTimeout(
+                        total=request_timeout)) as response:
+                body = await response.read()
+                # Only known before decompression by recent versions of
+                # aiohttp.
+                downloaded_bytes = getattr(response.content,
+                                           'total_raw_bytes', len(body))
+            plugin.record_timing(stage_times,
+                                 'site' if api == 'site' else 'api',
+                                 time.perf_counter() - request_start)
+
+    # If the API does not respond within `request_timeout`:
+    except asyncio.TimeoutError:
+        plugin.exit_request_timeout('No response within ' +
+                                    str(request_timeout) + ' seconds')
+
+    # If there is a problem with the connection:
+    except aiohttp.ClientError as exception_message:
+        plugin.exit_request_error(exception_message)
+
+    if validators is not None:
+        if validators and response.status == 304:
+            # Output for -vv:
+            plugin.maybe_output(print_on_levels=[2],
+                                actual_level=verbosity,
+                                msg='Response not modified. (fetch_json)',
+                                stage='api')
+            return None
+        validators.clear()
+        for name, header in (('etag', 'ETag'),
+                             ('last_modified', 'Last-Modified')):
+            if response.headers.get(header):
+                validators[name] = response.headers[header]
+
+    start = time.perf_counter()
+    try:
+        if traffic_types is None:
+            json_response = decoding.loads(body)
+        else:
+            # The API has left out the other traffic types.
+            json_response = decoding.decode_departures(
+                body, traffic_types, True)
+
+    # If the response does not conform to json, or some other error while
+    # decoding the json:
+    except (json.decoder.JSONDecodeError,
+            UnicodeDecodeError) as exception_message:
+        plugin.exit_decoding_error(exception_message)
+
+    decode_time = time.perf_counter() - start
+    plugin.check_api_status(json_response)
+    plugin.record_metric(metrics, 'response_bytes', downloaded_bytes, 'B')
+    plugin.record_metric(metrics, 'decode_time', round(decode_time, 6), 's')
+    plugin.record_timing(stage_times, 'decode', decode_time)
+    return json_response
+
+
+async def fetch_departures(session,
+                           semaphore,
+                           departure_api_key,
+                           site_id,
+                           period,
+                           verbosity=0,
+                           request_timeout=None,
+                           response_cache=None,
+                           traffic_types=None):
+    """Return a tuple of the departures for `site_id`, whether they came from
+    `response_cache`, and the metrics and the stage times of their download,
+    fetching them if needed. Whether they came from the cache is None if no
+    `response_cache` is given. Only the departures of `traffic_types` are
+    fetched and decoded, if given, see `check_sl_delay.departure_url`.
+
+    Like in the default engine, the cache entry is locked while fetching, so
+    that other processes wanting the same departures wait for this download,
+    and a stale response is revalidated instead of downloaded again if the
+    API supports it, see `ResponseCache.get_or_fetch_async`."""
+    transfer_metrics = {}
+    stage_times = {}
+
+    async def fetch(stale_response=None, validators=None):
+        response = await fetch_json(
+            session, semaphore,
+            plugin.departure_url(departure_api_key, site_id, period,
+                                 traffic_types), request_timeout, verbosity,
+            'departure', transfer_metrics, traffic_types, stage_times,
+            validators)
+        # The stale response has not been modified.
+        return stale_response if response is None else response
+
+    if response_cache is None:
+        response, hit = await fetch(), None
+    else:
+        # The stale response and its validators are only read on a miss.
+        response, hit = await response_cache.get_or_fetch_async(
+            site_id, period, fetch, True)
+    scheduler.record_departures(site_id, response)
+    return response, hit, transfer_metrics, stage_times
+
+
+async def check_row(session,
+                    semaphore,
+                    site_api_key,
+                    row,
+                    departures,
+                    timeout,
+                    verbosity=0,
+                    request_timeout=None,
+                    site_cache=None,
+                    batch_timeout=None,
+                    deadline=None,
+                    history=None):
+    """Run the check for a single `row` of a sites file and return the
+    resulting state and output, like `check_sl_delay.run_check`, which also
+    describes `batch_timeout`, `deadline` and `history`.
+
+    The `departures` are a future of the result of `fetch_departures` for the
+    site of the row, which may be shared with other rows."""
+    # Only timed when asked for, like in `check_sl_delay.plugin_main`.
+    stage_times = {} if row.get('stage_timings', False) else None
+
+    async def lookup_site():
+        "Return the site name, from `site_cache` when possible."
+        name = None if site_cache is None else site_cache.get(row['site_id'])
+        if name is None:
+            name = plugin.parse_site(
+                await fetch_json(session, semaphore,
+                                 plugin.site_url(site_api_key,
+                                                 row['site_id']),
+                                 request_timeout, verbosity, 'site', None,
+                                 None, stage_times),
+                row['site_id'],
+                verbosity)
+            if site_cache is not None:
+                site_cache.put(row['site_id'], name)
+        return name
+
+    async def check():
+        # The departures are shielded, since they may be shared with other
+        # rows which have not timed out.
+        results = await asyncio.gather(lookup_site(),
+                                       asyncio.shield(departures),
+                                       return_exceptions=True)
+
+        # Handle the results in the same order as the default engine, so that
+        # an invalid site id is reported before any problem with the
+        # departures.
+        for result in results:
+            if isinstance(result, Exception):
+                raise result
+
+        response, hit, transfer_metrics, departure_times = results[1]
+        metrics = {}
+        if hit is not None:
+            plugin.record_metric(metrics, 'response_cache_hit', int(hit))
+        if row.get('transfer_stats', False):
+            metrics.update(transfer_metrics)
+        if stage_times is not None:
+            stage_times.update(departure_times)
+
+        plugin.evaluate_check(results[0], response,
+                              plugin.api_traffic_types(row['traffic_type']),
+                              row['minutes'], row['warning'], row['critical'],
+                              verbosity, metrics,
+                              row.get('type_policy', 'worst'), history,
+                              row['site_id'], row.get('statistics', False),
+                              row.get('p90_warning'),
+                              row.get('p90_critical'), stage_times)
+
+    row_deadline, reported_timeout = plugin.check_deadline(
+        timeout, batch_timeout, deadline)
+    try:
+        await asyncio.wait_for(check(), max(row_deadline - time.monotonic(),
+                                            0))
+    except click.ClickException as exception:
+        return int(exception.message), getattr(exception, 'output', '')
+    except asyncio.TimeoutError:
+        return 3, 'UNKNOWN: ' + plugin.timeout_message(reported_timeout)
+    except Exception as exception:  # pylint: disable=broad-except
+        return plugin.unexpected_error(exception)
+
+    # `evaluate_check` always exits via `exit_plugin`, so this should not
+    # happen.
+    return 3, 'UNKNOWN: No result from check'
+
+
+async def check_rows(site_api_key,
+                     departure_api_key,
+                     period,
+                     rows,
+                     timeout,
+                     concurrency=1,
+                     verbosity=0,
+                     request_timeout=None,
+                     site_cache=None,
+                     response_cache=None,
+                     batch_timeout=None,
+                     deadline=None,
+                     history=None):
+    """Run the checks for all `rows` concurrently in the running event loop.
+    The departures of each site are only fetched once for all its rows, and
+    without a `response_cache` only for the traffic types of its rows."""
+    traffic_types = {}
+    for row in rows:
+        row_types = plugin.api_traffic_types(row['traffic_type'])
+        traffic_types.setdefault(row['site_id'], set()).update(
+            [row_types] if isinstance(row_types, str) else row_types)
+
+    semaphore = asyncio.Semaphore(concurrency)
+    connector = aiohttp.TCPConnector(limit=concurrency)
+    async with aiohttp.ClientSession(connector=connector) as session:
+        departures = {}
+        for row in rows:
+            if row['site_id'] not in departures:
+                departures[row['site_id']] = asyncio.ensure_future(
+                    fetch_departures(
+                        session, semaphore, departure_api_key,
+                        row['site_id'], period, verbosity, request_timeout,
+                        response_cache, None if response_cache is not None
+                        else traffic_types[row['site_id']]))
+
+        results = await asyncio.gather(*[
+            check_row(session, semaphore, site_api_key, row,
+                      departures[row['site_id']], timeout, verbosity,
+                      request_timeout, site_cache, batch_timeout, deadline,
+                      history) for row in rows
+        ])
+
+        # Do not leave any unfinished downloads behind for checks that timed
+        # out.
+        for future in departures.values():
+            future.cancel()
+        await asyncio.gather(*departures.values(), return_exceptions=True)
+        return results
+
+
+def run_checks(site_api_key,
+               departure_api_key,
+               period,
+               rows,
+               timeout,
+               concurrency=1,
+               verbosity=0,
+               request_timeout=None,
+               site_cache=None,
+               response_cache=None,
+               batch_timeout=None,
+               deadline=None,
+               history=None):
+    """Run the checks for all `rows` over a single event loop, with at most
+    `concurrency` requests in flight, and return a list of (state, output)
+    tuples in the same order as `rows`. All checks are given up at the
+    `deadline` of the batch, which is reported as `batch_timeout`."""
+    if aiohttp is None:
+        plugin.exit_plugin(4,
+                           error=('--engine async requires aiohttp, install ' +
+                                  'it with: ' +
+                                  'pip install check_sl_delay[async]'))
+
+    loop = asyncio.new_event_loop()
+    try:
+        return loop.run_until_complete(
+            check_rows(site_api_key, departure_api_key, period, rows, timeout,
+                       concurrency, verbosity, request_timeout, site_cache,
+                       response_cache, batch_timeout, deadline, history))
+    finally:
+        loop.close()
@@ -0,0 +1,309 @@
+"""Caches shared between invocations of the plugin, stored in a cache dir."""
+
+from contextlib import contextmanager
+import json
+import os
+import tempfile
+import threading
+import time
+
+try:
+    import fcntl
+except ImportError:
+    # File locking is not available on Windows, where the caches still work
+    # but concurrent processes may fetch the same response.
+    fcntl = None
+
+
+def default_cache_dir():
+    "Return the default cache dir, following the XDG base directory spec."
+    cache_home = os.environ.get('XDG_CACHE_HOME') or os.path.join(
+        os.path.expanduser('~'), '.cache')
+    return os.path.join(cache_home, 'check_sl_delay')
+
+
+def write_json_atomically(path, data):
+    """Write `data` as JSON to `path` via a temporary file, so that other
+    processes never see a partially written file."""
+    directory = os.path.dirname(path)
+    os.makedirs(directory, exist_ok=True)
+    file_descriptor, temporary_path = tempfile.mkstemp(dir=directory,
+                                                       suffix='.tmp')
+    try:
+        with os.fdopen(file_descriptor, 'w',
+                       encoding='utf-8') as temporary_file:
+            json.dump(data, temporary_file)
+        os.replace(temporary_path, path)
+    except OSError:
+        os.unlink(temporary_path)
+        raise
+
+
+def read_json(path):
+    "Return the JSON in `path`, or an empty dict if it is missing or invalid."
+    try:
+        with open(path, encoding='utf-8') as json_file:
+            data = json.load(json_file)
+    except (OSError, ValueError):
+        return {}
+    return data if isinstance(data, dict) else {}
+
+
+@contextmanager
+def locked(path):
+    """Hold an exclusive lock on the file `path` while in the context, which
+    blocks other processes and threads locking the same file."""
+    with open(path, 'a', encoding='utf-8') as lock_file:
+        if fcntl is not None:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            if fcntl is not None:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+
+async def lock_async(path):
+    """Take an exclusive lock on the file `path`, like `locked`, waiting for
+    it in the default executor of the event loop, so that the loop keeps
+    running meanwhile. Return a function which releases the lock."""
+    # Imported here, since only the asyncio engine needs it.
+    # pylint: disable=import-outside-toplevel,consider-using-with
+    import asyncio
+    lock_file = open(path, 'a', encoding='utf-8')
+
+    def release(_future=None):
+        try:
+            if fcntl is not None:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+        finally:
+            lock_file.close()
+
+    if fcntl is not None:
+        acquire = asyncio.get_event_loop().run_in_executor(
+            None, fcntl.flock, lock_file, fcntl.LOCK_EX)
+        try:
+            await asyncio.shield(acquire)
+        except BaseException:
+            # Waiting for the lock can not be cancelled, so it is released as
+            # soon as it has been taken instead.
+            acquire.add_done_callback(release)
+            raise
+    return release
+
+
+class SiteCache:
+    """Names of validated site ids, kept for `ttl` seconds.
+
+    The names are stored as JSON in `cache_dir`, so that they are reused by
+    later invocations of the plugin and the typeahead API does not need to be
+    called on every check. The cache is best effort: if it cannot be read or
+    written, the names are simply fetched from the API again."""
+
+    def __init__(self, cache_dir, ttl):
+        self.path = os.path.join(cache_dir, 'sites.json')
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._sites = None
+        self._lock = threading.Lock()
+
+    def _load(self):
+        "Load the cache file, unless it has already been loaded."
+        if self._sites is None:
+            self._sites = read_json(self.path)
+        return self._sites
+
+    def get(self, site_id):
+        "Return the cached name of `site_id`, or None if missing or expired."
+        with self._lock:
+            entry = self._load().get(str(site_id))
+            try:
+                if time.time() - entry['time'] < self.ttl:
+                    self.hits += 1
+                    return entry['name']
+            except (KeyError, TypeError):
+                pass
+            self.misses += 1
+            return None
+
+    def put(self, site_id, name):
+        "Store the validated `name` of `site_id`."
+        with self._lock:
+            # Merge with the current contents of the file, since other
+            # processes may have added sites since it was loaded.
+            self._sites = read_json(self.path)
+            self._sites[str(site_id)] = {'name': name, 'time': time.time()}
+            try:
+                write_json_atomically(self.path, self._sites)
+            except OSError:
+                pass
+
+    def stats(self):
+        "Return a line summarizing the use of the cache."
+        with self._lock:
+            return ('Site cache: ' + str(self.hits) + ' hits, ' +
+                    str(self.misses) + ' misses, ' +
+                    str(len(self._load())) + ' entries in ' + self.path)
+
+
+def stale_entry(entry):
+    """Return a tuple of the response of a `ResponseCache` entry, even if it
+    has expired, and a dictionary of its validators, see
+    `ResponseCache.stale`."""
+    validators = entry.get('validators')
+    if 'response' not in entry or not isinstance(validators, dict):
+        return None, {}
+    return entry['response'], validators
+
+
+class ResponseCache:
+    """Departure responses, shared between processes for `ttl` seconds.
+
+    The responses are keyed by site id and time window, so that checks of
+    different traffic types and thresholds for the same site all use the same
+    download. Like `SiteCache`, the cache is best effort."""
+
+    def __init__(self, cache_dir, ttl):
+        self.directory = os.path.join(cache_dir, 'departures')
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+
+    def _path(self, site_id, time_window):
+        "Return the path of the cache file for `site_id` and `time_window`."
+        return os.path.join(self.directory,
+                            str(site_id) + '-' + str(time_window) + '.json')
+
+    def _count(self, hit):
+        "Count a hit or a miss."
+        with self._lock:
+            if hit:
+                self.hits += 1
+            else:
+                self.misses += 1
+
+    def _read_entry(self, site_id, time_window):
+        """Return a tuple of the cached response, or None if it is missing or
+        expired, and the whole cache entry it was read from."""
+        entry = read_json(self._path(site_id, time_window))
+        try:
+            if 0 <= time.time() - entry['time'] < self.ttl:
+                return entry['response'], entry
+        except (KeyError, TypeError):
+            pass
+        return None, entry
+
+    def _read(self, site_id, time_window):
+        "Return the cached response, or None if it is missing or expired."
+        return self._read_entry(site_id, time_window)[0]
+
+    def get(self, site_id, time_window):
+        """Return the cached response, or None if it is missing or expired,
+        counting it as a hit or a miss."""
+        response = self._read(site_id, time_window)
+        self._count(response is not None)
+        return response
+
+    def stale(self, site_id, time_window):
+        """Return a tuple of the cached response, even if it has expired, and
+        a dictionary of its validators, for revalidating it with the API. The
+        response is None and the dictionary empty if there is none."""
+        return stale_entry(read_json(self._path(site_id, time_window)))
+
+    def put(self, site_id, time_window, response, validators=None):
+        """Store `response` for `site_id` and `time_window`, together with a
+        dictionary of its `validators`, see `stale`."""
+        entry = {'time': time.time(), 'response': response}
+        if validators:
+            entry['validators'] = validators
+        try:
+            write_json_atomically(self._path(site_id, time_window), entry)
+        except OSError:
+            pass
+
+    def get_or_fetch(self, site_id, time_window, fetch, revalidate=False):
+        """Return a tuple of the cached response and True, or of a response
+        from calling `fetch` and False.
+
+        With `revalidate`, `fetch` is called with the stale response and the
+        dictionary of its validators, see `stale`, which are taken from the
+        same read of the cache as the check for a fresh response. `fetch` may
+        update the validators, which are stored with the fetched response.
+
+        While fetching, the cache entry is locked, so that concurrent
+        processes wanting the same response wait for this download instead of
+        making their own."""
+        response, entry = self._read_entry(site_id, time_window)
+        if response is not None:
+            self._count(True)
+            return response, True
+
+        def fetch_entry(entry):
+            if not revalidate:
+                return fetch(), None
+            stale_response, validators = stale_entry(entry)
+            return fetch(stale_response, validators), validators
+
+        path = self._path(site_id, time_window)
+        try:
+            os.makedirs(self.directory, exist_ok=True)
+            with locked(path + '.lock'):
+                # Someone else may have fetched it while waiting for the lock.
+                response, entry = self._read_entry(site_id, time_window)
+                if response is not None:
+                    self._count(True)
+                    return response, True
+                response, validators = fetch_entry(entry)
+                self.put(site_id, time_window, response, validators)
+        except OSError:
+            response = fetch_entry(entry)[0]
+
+        self._count(False)
+        return response, False
+
+    async def get_or_fetch_async(self,
+                                 site_id,
+                                 time_window,
+                                 fetch,
+                                 revalidate=False):
+        """Like `get_or_fetch`, but for a coroutine function `fetch`, waiting
+        for the lock of the cache entry without blocking the event loop, see
+        `lock_async`."""
+        response, entry = self._read_entry(site_id, time_window)
+        if response is not None:
+            self._count(True)
+            return response, True
+
+        async def fetch_entry(entry):
+            if not revalidate:
+                return await fetch(), None
+            stale_response, validators = stale_entry(entry)
+            return await fetch(stale_response, validators), validators
+
+        path = self._path(site_id, time_window)
+        try:
+            os.makedirs(self.directory, exist_ok=True)
+            release = await lock_async(path + '.lock')
+            try:
+                # Someone else may have fetched it while waiting for the lock.
+                response, entry = self._read_entry(site_id, time_window)
+                if response is not None:
+                    self._count(True)
+                    return response, True
+                response, validators = await fetch_entry(entry)
+                self.put(site_id, time_window, response, validators)
+            finally:
+                release()
+        except OSError:
+            response = (await fetch_entry(entry))[0]
+
+        self._count(False)
+        return response, False
+
+    def stats(self):
+        "Return a line summarizing the use of the cache."
+        with self._lock:
+            return ('Response cache: ' + str(self.hits) + ' hits, ' +
+                    str(self.misses) + ' misses in ' + self.directory)
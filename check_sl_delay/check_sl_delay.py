@@ -1,21 +1,89 @@
 #!/usr/bin/env python
-# pylint: disable=too-many-arguments
+# pylint: disable=too-many-arguments,too-many-locals,too-many-lines
 """Main module."""
 
+from bisect import bisect_left
+from collections import Counter
 from datetime import datetime
+from functools import lru_cache
+import csv
+import heapq
 import json
+import re
 import sys
+import threading
+import time
 import click
-from func_timeout import func_timeout, FunctionTimedOut
-import requests
 
-
-def maybe_output(print_on_levels=None, actual_level=0, msg=''):
-    "Determine wether or not to print output to stdout based on verbosity."
-    if print_on_levels is None:
-        print_on_levels = []
-    if msg and actual_level in print_on_levels:
+from check_sl_delay import scheduler, transport
+from check_sl_delay.cache import ResponseCache, SiteCache, default_cache_dir
+from check_sl_delay.client import default_socket_path
+
+
+# The JSON log sink, see `configure_log_sink`.
+LOG_SINK = None
+
+# The API keys in the query strings of URLs, up to the end of the URL.
+API_KEY_PATTERN = re.compile(r'(\bkey=)[^&\s\'"()<>]+')
+
+
+def redact_api_keys(text):
+    "Replace the API keys in the URLs in `text`."
+    return API_KEY_PATTERN.sub(r'\1REDACTED', text)
+
+
+def configure_log_sink(path=None):
+    """Also write all verbose output, as JSON lines, to `path`, or to stderr
+    if `path` is '-', see `jsonlog`. Stops writing it if `path` is None."""
+    global LOG_SINK  # pylint: disable=global-statement
+    if path is None and LOG_SINK is None:
+        return
+    # Imported here, since it is only needed with a log sink.
+    # pylint: disable=import-outside-toplevel,cyclic-import
+    from check_sl_delay import jsonlog
+    if path is None:
+        LOG_SINK = None
+        jsonlog.close_sink()
+        return
+    LOG_SINK = jsonlog.open_sink(path)
+
+
+def maybe_output(print_on_levels=None,
+                 actual_level=0,
+                 msg='',
+                 args=(),
+                 **fields):
+    """Determine wether or not to print output to stdout based on verbosity,
+    and write it to the log sink, if any.
+
+    The message `msg` is only formatted with `args`, like `msg % args`, when
+    it is output, and the API keys are redacted. The keyword arguments are
+    structured fields of the message, like the `site`, `stage` and
+    `duration`, which are only written to the log sink."""
+    printed = actual_level in (print_on_levels or ())
+    if not msg or not printed and LOG_SINK is None:
+        return
+    if args:
+        msg = msg % args
+    msg = redact_api_keys(str(msg))
+    if printed:
         click.echo(msg)
+    if LOG_SINK is not None:
+        LOG_SINK.write(min(print_on_levels or [2]), msg, fields)
+
+
+class LazyFormat:
+    """Call `function` with `args` when formatted, to pass the result as an
+    argument of `maybe_output` without calling it when nothing is output."""
+
+    # pylint: disable=too-few-public-methods
+
+    def __init__(self, function, *args):
+        self.function = function
+        self.args = args
+
+    def __str__(self):
+        return str(self.function(*self.args))
 
 
 def generate_perfdata_string(value='U', warning='', critical=''):
@@ -26,6 +94,92 @@ def generate_perfdata_string(value='U', warning='', critical=''):
     return perfdata_string
 
 
+def generate_metrics_string(metrics=None):
+    """Generate perfdata for additional `metrics`, which map labels to tuples
+    of value and unit of measurement, to be appended to the perfdata string
+    from `generate_perfdata_string`."""
+    if not metrics:
+        return ''
+    return ''.join(' ' + label + '=' + str(value) + unit
+                   for label, (value, unit) in metrics.items())
+
+
+def record_metric(metrics,
+                  label,
+                  value,
+                  unit='',
+                  warning=None,
+                  critical=None):
+    """Record a metric to be reported as perfdata, unless `metrics` is None,
+    which means that nobody is collecting them. The `warning` and `critical`
+    thresholds are only added if either of them is set."""
+    if metrics is not None:
+        if warning is not None or critical is not None:
+            unit += (';' + ('' if warning is None else str(warning)) + ';' +
+                     ('' if critical is None else str(critical)))
+        metrics[label] = (value, unit)
+
+
+# The stages of a check which are timed with --stage-timings, in the order
+# they are reported.
+STAGES = ('site', 'api', 'connect', 'decode', 'evaluate')
+
+# The site and the departures are fetched concurrently, and both add to the
+# time of the 'connect' stage.
+_STAGE_TIMES_LOCK = threading.Lock()
+
+
+def record_timing(stage_times, stage, seconds):
+    """Add `seconds` to the time of `stage` in `stage_times`, unless it is
+    None, which means that the stages are not timed."""
+    if stage_times is not None:
+        with _STAGE_TIMES_LOCK:
+            stage_times[stage] = stage_times.get(stage, 0.0) + seconds
+
+
+def record_request_timing(stage_times, stage, timings):
+    """Record the `timings` of a request from `transport.timed_get` as the
+    time of `stage`, and its handshakes as the time of the 'connect'
+    stage."""
+    record_timing(stage_times, stage, timings['connect'] + timings['transfer'])
+    record_timing(stage_times, 'connect', timings['connect'])
+
+
+def format_stage_times(stage_times):
+    "Format the `stage_times` of a check for the verbose output."
+    return ', '.join(stage + ' ' + str(round(stage_times[stage], 6)) + 's'
+                     for stage in STAGES if stage in stage_times)
+
+
+def record_stage_metrics(metrics, stage_times, verbosity=0):
+    """Record the `stage_times` of a check in `metrics`, labelled like
+    `api_time`, and show them with -vv."""
+    if stage_times is None:
+        return
+    # Output for -vv:
+    maybe_output(print_on_levels=[2],
+                 actual_level=verbosity,
+                 msg='Stage timings: %s (record_stage_metrics)',
+                 args=(LazyFormat(format_stage_times, stage_times), ),
+                 stage_times=stage_times)
+    for stage in STAGES:
+        if stage in stage_times:
+            record_metric(metrics, stage + '_time',
+                          round(stage_times[stage], 6), 's')
+
+
+def plugin_exception(state, output):
+    """Create the `click.ClickException` used to exit the plugin with `state`.
+    The check `output` is attached to the exception and printed by whoever
+    catches it, which lets the batch mode collect the results instead."""
+    # The `state` needs to be awkwardly converted to a string to be passed on
+    # as an exception message.
+    exception = click.ClickException(str(state))
+    # The errors of requests may contain URLs with the API keys.
+    exception.output = redact_api_keys(output)
+    return exception
+
+
 def exit_plugin(state=3,
                 value='U',
                 name='',
@@ -33,10 +187,11 @@ def exit_plugin(state=3,
                 critical='',
                 minutes='',
                 error='No error information provided',
-                verbosity=0):
+                verbosity=0,
+                metrics=None):
     "Exit the plugin with a valid exit code and string."
     # The function will not literally exit, but throw a click.ClickException
-    # which will be caught in the `cli` function.
+    # which will be caught in the `cli` function, where the output is printed.
 
     # Service status options to pick from, depending on the state to return.
     service_status_options = {
@@ -52,16 +207,31 @@ def exit_plugin(state=3,
     # Output for -vv:
     maybe_output(print_on_levels=[2],
                  actual_level=verbosity,
-                 msg='State is: ' + str(state) + '. (exit_plugin)')
+                 msg='State is: %s. (exit_plugin)',
+                 args=(state, ))
 
     # Pick the service status corresponding to `state`, or fallback to 'ERROR'.
     service_status = service_status_options.get(state, 'ERROR')
 
     # Early bail if the state is either 'ERROR' or 'UNKNOWN'.
     if service_status in ('ERROR', 'UNKNOWN'):
-        # Print the actual check output and then raise the exception.
-        click.echo(service_status + ': ' + error)
-        raise click.ClickException(str(state))
+        raise plugin_exception(state, service_status + ': ' + error)
+
+    # Output for -vv:
+    maybe_output(
+        print_on_levels=[2],
+        actual_level=verbosity,
+        msg='Generating exit message and perfdata string. (exit_plugin)')
+
+    perfdata = (generate_perfdata_string(value, warning, critical) +
+                generate_metrics_string(metrics))
+
+    # Use the short version of the output if the option -v has not been set,
+    # which needs no value message.
+    if verbosity == 0:
+        raise plugin_exception(state,
+                               service_status + ': ' + str(value) + '%' +
+                               perfdata)
 
     if name:
         name_string = ('at ' + name + ' ')
@@ -90,30 +260,61 @@ def exit_plugin(state=3,
     else:
         value_message = ''
 
-    # Output for -vv:
-    maybe_output(
-        print_on_levels=[2],
-        actual_level=verbosity,
-        msg='Generating exit message and perfdata string. (exit_plugin)')
+    # Finally throw the exception to exit the plugin via the exception being
+    # caught in `cli`, with the longer version of the output for -v and -vv.
+    raise plugin_exception(
+        state, service_status + ': ' + str(value) + value_message + perfdata)
 
-    # Print the short version of the output if the option -v has not been set.
-    maybe_output(print_on_levels=[0],
-                 actual_level=verbosity,
-                 msg=str(service_status + ': ' + str(value) + '%' +
-                         generate_perfdata_string(value, warning, critical)))
 
-    # Print the longer version of the output if either -v or -vv have been set.
-    maybe_output(print_on_levels=[1, 2],
-                 actual_level=verbosity,
-                 msg=str(service_status + ': ' + str(value) + value_message +
-                         generate_perfdata_string(value, warning, critical)))
+API_BASE_URL = 'https://api.sl.se'
+SITE_API_PATH = '/api2/typeahead.json/'
+DEPARTURE_API_PATH = '/api2/realtimedeparturesV4.json/'
+SITE_API_URL = API_BASE_URL + SITE_API_PATH
+DEPARTURE_API_URL = API_BASE_URL + DEPARTURE_API_PATH
 
-    # Finally throw the exception to exit the plugin via the exception being
-    # caught in `cli`.
+# Environment variable overriding the base URL of the SL APIs.
+BASE_URL_ENVVAR = 'CHECK_SL_DELAY_BASE_URL'
 
-    # The `state` needs to be awkwardly converted to a string to be passed on
-    # as an exception message.
-    raise click.ClickException(str(state))
+
+def configure_api_urls(base_url=None):
+    """Send the requests to the SL APIs to `base_url`, like
+    'http://127.0.0.1:8080', instead of `API_BASE_URL`. Used to test and
+    benchmark against a local stand-in for the APIs, see `fakeapi`."""
+    global SITE_API_URL, DEPARTURE_API_URL  # pylint: disable=global-statement
+    base_url = (base_url or API_BASE_URL).rstrip('/')
+    SITE_API_URL = base_url + SITE_API_PATH
+    DEPARTURE_API_URL = base_url + DEPARTURE_API_PATH
+
+
+class DeadlineExceeded(Exception):
+    "Raised when the deadline of a check is reached before it is done."
+
+
+def remaining_timeout(request_timeout=None, deadline=None):
+    """Return the timeout of the next request: `request_timeout`, limited to
+    the time left until `deadline`, which is a `time.monotonic` value. Raises
+    `DeadlineExceeded` if there is no time left."""
+    if deadline is None:
+        return request_timeout
+    remaining = deadline - time.monotonic()
+    if remaining <= 0:
+        raise DeadlineExceeded()
+    if request_timeout is None:
+        return remaining
+    return min(request_timeout, remaining)
+
+
+def deadline_passed(deadline):
+    "Return True if `deadline`, a `time.monotonic` value, has been reached."
+    return deadline is not None and time.monotonic() >= deadline
+
+
+def wait_for_rate_limit(api, deadline=None):
+    """Wait until the rate limit of `api` allows another request, see
+    `scheduler.RateLimit`. Raises `DeadlineExceeded` if that would be after
+    `deadline`."""
+    if not scheduler.rate_limit(api).acquire(deadline):
+        raise DeadlineExceeded()
 
 
 def exit_invalid_id(site_id):
@@ -121,28 +322,125 @@ def exit_invalid_id(site_id):
     exit_plugin(state=3, error='Invalid site id: ' + str(site_id))
 
 
-def fetch_site(site_api_key, site_id, verbosity=0):
-    "Verify that the site_id is valid and return the `name` of the site."
-    url = ('https://api.sl.se/api2/typeahead.json/'
-           '?key=' + site_api_key + '&searchstring=' + str(site_id))
+def exit_request_timeout(exception_message):
+    "Exit the plugin with an error message noting the request timeout."
+    exit_plugin(state=3,
+                error='HTTP request timed out: ' + str(exception_message))
+
+
+def exit_request_error(exception_message):
+    "Exit the plugin with an error message noting the failed request."
+    exit_plugin(state=3,
+                error='Encountered an exception during HTTP request: ' +
+                str(exception_message))
+
+
+def exit_decoding_error(exception_message):
+    "Exit the plugin with an error message noting the failed JSON decoding."
+    exit_plugin(state=3,
+                error='Encountered an exception during JSON Decoding: ' +
+                str(exception_message))
+
+
+def check_api_status(json_response):
+    """Exit the plugin if the `json_response` of an SL API is an error, like
+    an exceeded quota, which has a non-zero StatusCode and no
+    ResponseData."""
+    if not isinstance(json_response, dict):
+        exit_plugin(state=3, error='Unexpected response from the SL API')
+    status_code = json_response.get('StatusCode') or 0
+    if status_code == 0 and json_response.get('ResponseData') is not None:
+        return
+    exit_plugin(state=3,
+                error=('SL API error ' + str(status_code) + ': ' +
+                       str(json_response.get('Message') or
+                           'No ResponseData in the response')))
+
+
+def site_url(site_api_key, site_id):
+    "Return the URL used to look up `site_id` in the SL Platsuppslag API."
+    return (SITE_API_URL + '?key=' + site_api_key + '&searchstring=' +
+            str(site_id))
+
+
+def departure_url(departure_api_key, site_id, time_window, traffic_types=None):
+    """Return the URL used to fetch the departures for `site_id`. If a list of
+    `traffic_types` in the format of the API is given, the API is asked to
+    leave out the departures of all other traffic types."""
+    url = (DEPARTURE_API_URL + '?key=' + departure_api_key + '&siteid=' +
+           str(site_id) + '&timewindow=' + str(time_window))
+    if traffic_types is not None:
+        for name, api_format in TRAFFIC_TYPE_API_FORMAT_OPTIONS.items():
+            if api_format not in traffic_types:
+                url += '&' + name.lower() + '=false'
+    return url
+
+
+def conditional_headers(validators=None):
+    """Return the headers asking the API to only send a response if it has
+    changed since the response which `validators` were taken from."""
+    headers = {}
+    if validators:
+        if validators.get('etag'):
+            headers['If-None-Match'] = validators['etag']
+        if validators.get('last_modified'):
+            headers['If-Modified-Since'] = validators['last_modified']
+    return headers
+
+
+def fetch_site(site_api_key,
+               site_id,
+               verbosity=0,
+               request_timeout=None,
+               deadline=None,
+               session=None,
+               stage_times=None):
+    """Verify that the site_id is valid and return the `name` of the site.
+    The request is sent using `session`, or the shared session by default,
+    and may not outlast `deadline`, see `remaining_timeout`. The time of the
+    request is recorded in `stage_times`, see `record_timing`."""
+    url = site_url(site_api_key, site_id)
     # Output for -vv:
     maybe_output(print_on_levels=[2],
                  actual_level=verbosity,
-                 msg=str('URL: ' + url + ' (fetch_site)'))
+                 msg='URL: %s (fetch_site)',
+                 args=(url, ),
+                 site=site_id,
+                 stage='site')
 
     try:
         # Output for -vv:
         maybe_output(print_on_levels=[2],
                      actual_level=verbosity,
-                     msg=str('Fetching API response for site : ' +
-                             str(site_id) + '. (fetch_site)'))
-        response = requests.get(url)
+                     msg='Fetching API response for site : %s. (fetch_site)',
+                     args=(site_id, ),
+                     site=site_id,
+                     stage='site')
+        wait_for_rate_limit('site', deadline)
+        response, timings = transport.timed_get(
+            url, remaining_timeout(request_timeout, deadline), session,
+            deadline=deadline)
+
+    # If the API does not respond within `request_timeout`, or before the
+    # deadline of the whole check:
+    except transport.RequestTimeout as exception_message:
+        if deadline_passed(deadline):
+            raise DeadlineExceeded() from exception_message
+        exit_request_timeout(exception_message)
 
     # If there is a problem with the connection:
-    except requests.exceptions.ConnectionError as exception_message:
-        exit_plugin(state=3,
-                    error='Encountered an exception during HTTP request: ' +
-                    str(exception_message))
+    except transport.RequestError as exception_message:
+        exit_request_error(exception_message)
+
+    # Output for -vv:
+    maybe_output(print_on_levels=[2],
+                 actual_level=verbosity,
+                 msg='Request timing: %s (fetch_site)',
+                 args=(LazyFormat(transport.format_timings, timings), ),
+                 site=site_id,
+                 stage='site',
+                 duration=timings['connect'] + timings['transfer'])
+    record_request_timing(stage_times, 'site', timings)
 
     try:
         json_response = response.json()
@@ -150,10 +448,15 @@ def fetch_site(site_api_key, site_id, verbosity=0):
     # If the response does not conform to json, or some other error while
     # decoding the json:
     except json.decoder.JSONDecodeError as exception_message:
-        exit_plugin(state=3,
-                    error='Encountered an exception during JSON Decoding: ' +
-                    str(exception_message))
+        exit_decoding_error(exception_message)
 
+    return parse_site(json_response, site_id, verbosity)
+
+
+def parse_site(json_response, site_id, verbosity=0):
+    """Verify that the `json_response` from the SL Platsuppslag API is an exact
+    match for `site_id` and return the `name` of the site."""
+    check_api_status(json_response)
     try:
         response_id = json_response['ResponseData'][0]['SiteId']
         response_name = json_response['ResponseData'][0]['Name']
@@ -182,59 +485,273 @@ def fetch_site(site_api_key, site_id, verbosity=0):
     return stripped_name
 
 
-def fetch_response(departure_api_key, site_id, time_window, verbosity=0):
-    "Method to fetch the API response."
-    url = ('https://api.sl.se/api2/realtimedeparturesV4.json/'
-           '?key=' + departure_api_key + '&siteid=' + str(site_id) +
-           '&timewindow=' + str(time_window))
+def lookup_site(site_api_key,
+                site_id,
+                verbosity=0,
+                request_timeout=None,
+                site_cache=None,
+                deadline=None,
+                stage_times=None):
+    """Return the `name` of the site, from `site_cache` if it is given and the
+    site has been validated before, and otherwise using `fetch_site`."""
+    if site_cache is not None:
+        name = site_cache.get(site_id)
+        if name is not None:
+            # Output for -vv:
+            maybe_output(print_on_levels=[2],
+                         actual_level=verbosity,
+                         msg='Using cached name for site: %s. (lookup_site)',
+                         args=(site_id, ),
+                         site=site_id,
+                         stage='site')
+            return name
+
+    name = fetch_site(site_api_key, site_id, verbosity, request_timeout,
+                      deadline, None, stage_times)
+
+    if site_cache is not None:
+        site_cache.put(site_id, name)
+    return name
+
+
+def fetch_response(departure_api_key,
+                   site_id,
+                   time_window,
+                   verbosity=0,
+                   request_timeout=None,
+                   deadline=None,
+                   session=None,
+                   traffic_types=None,
+                   metrics=None,
+                   validators=None,
+                   stage_times=None):
+    """Method to fetch the API response. The request is sent using `session`,
+    or the shared session by default, and may not outlast `deadline`, see
+    `remaining_timeout`. Only the departures of `traffic_types` are
+    requested and decoded, if given, see `departure_url` and
+    `decoding.decode_departures`.
+
+    If a dictionary of `validators` of an earlier response is given, the
+    response is only sent if it has changed since then, and None is returned
+    if it has not. The dictionary is updated with the validators of the new
+    response. The size of the download and the time taken to decode it are
+    recorded in `metrics`, and the times of the request and of the decoding
+    in `stage_times`, see `record_timing`."""
+    url = departure_url(departure_api_key, site_id, time_window, traffic_types)
     # Output for -vv:
     maybe_output(print_on_levels=[2],
                  actual_level=verbosity,
-                 msg=str('URL: ' + url + ' (fetch_response)'))
+                 msg='URL: %s (fetch_response)',
+                 args=(url, ),
+                 site=site_id,
+                 stage='api')
 
     try:
         # Output for -vv:
         maybe_output(print_on_levels=[2],
                      actual_level=verbosity,
-                     msg='Fetching API response. (fetch_response)')
-        response = requests.get(url)
+                     msg='Fetching API response. (fetch_response)',
+                     site=site_id,
+                     stage='api')
+        wait_for_rate_limit('departure', deadline)
+        response, timings = transport.timed_get(
+            url, remaining_timeout(request_timeout, deadline), session,
+            conditional_headers(validators), deadline)
+
+    # If the API does not respond within `request_timeout`, or before the
+    # deadline of the whole check:
+    except transport.RequestTimeout as exception_message:
+        if deadline_passed(deadline):
+            raise DeadlineExceeded() from exception_message
+        exit_request_timeout(exception_message)
 
     # If there is a problem with the connection:
-    except requests.exceptions.ConnectionError as exception_message:
-        exit_plugin(state=3,
-                    error='Encountered an exception during HTTP request: ' +
-                    str(exception_message))
+    except transport.RequestError as exception_message:
+        exit_request_error(exception_message)
 
+    # Output for -vv:
+    maybe_output(print_on_levels=[2],
+                 actual_level=verbosity,
+                 msg='Request timing: %s (fetch_response)',
+                 args=(LazyFormat(transport.format_timings, timings), ),
+                 site=site_id,
+                 stage='api',
+                 duration=timings['connect'] + timings['transfer'])
+    record_request_timing(stage_times, 'api', timings)
+
+    if validators is not None:
+        if validators and response.status_code == 304:
+            # Output for -vv:
+            maybe_output(print_on_levels=[2],
+                         actual_level=verbosity,
+                         msg='Response not modified. (fetch_response)',
+                         site=site_id,
+                         stage='api')
+            return None
+        validators.clear()
+        for name, header in (('etag', 'ETag'),
+                             ('last_modified', 'Last-Modified')):
+            if response.headers.get(header):
+                validators[name] = response.headers[header]
+
+    # Imported here, since it imports orjson if it is installed.
+    # pylint: disable=import-outside-toplevel
+    from check_sl_delay import decoding
+    start = time.perf_counter()
     try:
-        json_response = response.json()
+        if traffic_types is None:
+            json_response = decoding.loads(response.content)
+        else:
+            # The API has left out the other traffic types.
+            json_response = decoding.decode_departures(
+                response.content, traffic_types, True)
 
     # If the response does not conform to json, or some other error while
     # decoding the json:
-    except json.decoder.JSONDecodeError as exception_message:
-        exit_plugin(state=3,
-                    error='Encountered an exception during JSON Decoding: ' +
-                    str(exception_message))
+    except (json.decoder.JSONDecodeError,
+            UnicodeDecodeError) as exception_message:
+        exit_decoding_error(exception_message)
+    decode_time = time.perf_counter() - start
+    # Before the response may be cached, see `lookup_response`.
+    check_api_status(json_response)
+
+    # Output for -vv:
+    maybe_output(print_on_levels=[2],
+                 actual_level=verbosity,
+                 msg='Decoded %s bytes in %ss. (fetch_response)',
+                 args=(len(response.content), round(decode_time, 6)),
+                 site=site_id,
+                 stage='decode',
+                 duration=decode_time)
+    record_metric(metrics, 'response_bytes', timings['bytes'], 'B')
+    record_metric(metrics, 'decode_time', round(decode_time, 6), 's')
+    record_timing(stage_times, 'decode', decode_time)
 
     # Return the full json reponse.
     return json_response
 
 
-def structure_departure(departure):
-    """Structure data for a given `departure` into a dictionary containing the
-    key `scheduled`, `expected` and `delay`."
-    """
-    datetime_re = '%Y-%m-%dT%H:%M:%S'
-    scheduled = datetime.strptime(departure['TimeTabledDateTime'], datetime_re)
-    expected = datetime.strptime(departure['ExpectedDateTime'], datetime_re)
+def lookup_response(departure_api_key,
+                    site_id,
+                    time_window,
+                    verbosity=0,
+                    request_timeout=None,
+                    response_cache=None,
+                    metrics=None,
+                    deadline=None,
+                    traffic_types=None,
+                    transfer_stats=False,
+                    stage_times=None):
+    """Return the departures response, from `response_cache` if it is given
+    and has a fresh response, and otherwise using `fetch_response`.
+
+    Without a `response_cache`, only the departures of `traffic_types` are
+    fetched. With one, the departures of all traffic types are fetched, since
+    the cache is shared with checks of other traffic types, and a stale
+    response is revalidated instead of downloaded again if the API supports
+    it. With `transfer_stats`, the size of the download and the time taken
+    to decode it are recorded in `metrics`. The times of the stages of the
+    download are recorded in `stage_times`, see `fetch_response`."""
+    transfer_metrics = metrics if transfer_stats else None
+    if isinstance(traffic_types, str):
+        traffic_types = [traffic_types]
+
+    if response_cache is None:
+        response = fetch_response(departure_api_key, site_id, time_window,
+                                  verbosity, request_timeout, deadline, None,
+                                  traffic_types, transfer_metrics, None,
+                                  stage_times)
+        # Lets the long-running modes poll quiet sites less often.
+        scheduler.record_departures(site_id, response)
+        return response
+
+    def fetch(stale_response, validators):
+        response = fetch_response(departure_api_key, site_id, time_window,
+                                  verbosity, request_timeout, deadline, None,
+                                  None, transfer_metrics, validators,
+                                  stage_times)
+        # The stale response has not been modified.
+        return stale_response if response is None else response
+
+    # The stale response and its validators are only read on a miss.
+    response, hit = response_cache.get_or_fetch(site_id, time_window, fetch,
+                                                True)
+    # Output for -vv:
+    maybe_output(print_on_levels=[2],
+                 actual_level=verbosity,
+                 msg='Response cache %s for site: %s. (lookup_response)',
+                 args=('hit' if hit else 'miss', site_id),
+                 site=site_id,
+                 stage='api')
+    record_metric(metrics, 'response_cache_hit', int(hit))
+    scheduler.record_departures(site_id, response)
+    return response
+
+
+DATETIME_FORMAT = '%Y-%m-%dT%H:%M:%S'
+
+
+def parse_fixed_format(text):
+    """Parse `text` in `DATETIME_FORMAT` by slicing out the fields at their
+    fixed positions, for Python versions without `datetime.fromisoformat`."""
+    digits = (text[0:4] + text[5:7] + text[8:10] + text[11:13] + text[14:16] +
+              text[17:19])
+    if not digits.isdigit():
+        raise ValueError('Invalid timestamp: ' + text)
+    return datetime(int(text[0:4]), int(text[5:7]), int(text[8:10]),
+                    int(text[11:13]), int(text[14:16]), int(text[17:19]))
+
+
+# `datetime.fromisoformat` is implemented in C and much faster, but is only
+# available from Python 3.7.
+FROM_FIXED_FORMAT = getattr(datetime, 'fromisoformat', parse_fixed_format)
+
+
+@lru_cache(maxsize=4096)
+def parse_datetime(text):
+    """Parse a timestamp from the API, in the format `DATETIME_FORMAT`.
+
+    Timestamps with the separators in the expected positions are parsed with
+    `FROM_FIXED_FORMAT`, which is many times faster than `datetime.strptime`.
+    Anything unexpected falls back to `datetime.strptime`, which raises a
+    ValueError for invalid timestamps. Departures often share timestamps, so
+    the results are cached."""
+    # The separators are at positions 4, 7, 10, 13 and 16.
+    if len(text) == 19 and text[4:17:3] == '--T::':
+        try:
+            return FROM_FIXED_FORMAT(text)
+        except ValueError:
+            pass
+    return datetime.strptime(text, DATETIME_FORMAT)
+
+
+def departures_of(response, traffic_type):
+    "Return the departures of `traffic_type` in `response`, if any."
+    # Not every site has departures of every traffic type, which the API then
+    # leaves out or sets to null.
+    return response['ResponseData'].get(traffic_type) or []
+
+
+def departure_delay(departure):
+    "Return the delay of `departure` in seconds, 0 if it is not delayed."
+    scheduled = parse_datetime(departure['TimeTabledDateTime'])
+    expected = parse_datetime(departure['ExpectedDateTime'])
 
     # If the departure is delayed, then calculate the diff.
     if expected > scheduled:
-        delay_time = expected - scheduled
-        delay = delay_time.seconds
-    else:
-        delay = 0
+        return (expected - scheduled).seconds
+    return 0
 
-    return {'scheduled': scheduled, 'expected': expected, 'delay': delay}
+
+def structure_departure(departure):
+    """Structure data for a given `departure` into a dictionary containing the
+    key `scheduled`, `expected` and `delay`."
+    """
+    return {
+        'scheduled': parse_datetime(departure['TimeTabledDateTime']),
+        'expected': parse_datetime(departure['ExpectedDateTime']),
+        'delay': departure_delay(departure)
+    }
 
 
 def extract_departures(response, traffic_type, verbosity=0):
@@ -251,7 +768,7 @@ def extract_departures(response, traffic_type, verbosity=0):
     #  'expected': datetime(2020, 3, 19, 13, 21),
     #  'scheduled': datetime(2020, 3, 19, 13, 19)}
 
-    for departure in response['ResponseData'][traffic_type]:
+    for departure in departures_of(response, traffic_type):
         departures.append(structure_departure(departure))
     return departures
 
@@ -298,22 +815,65 @@ def get_diffs(departure_api_key,
         actual_level=verbosity,
         msg=('Calculating diff between expected and scheduled departures.' +
              '(get_diffs)'))
+    return diffs_from_response(
+        fetch_response(departure_api_key, site_id, time_window, verbosity),
+        traffic_type, verbosity)
+
+
+def diffs_from_response(response, traffic_type, verbosity=0):
+    """Get the diffs between scheduled and expected departures from an already
+    fetched `response` and return them in whole minutes."""
     # This higher order function calls on the various functions to get to work.
     diffs = calculate_delays(
-        extract_departures(
-            fetch_response(departure_api_key, site_id, time_window, verbosity),
-            traffic_type, verbosity), verbosity)
+        extract_departures(response, traffic_type, verbosity), verbosity)
     minutes = convert_minutes(diffs)
     return minutes
 
 
+def evaluate_departures(response, traffic_type, threshold, verbosity=0):
+    """Walk the departures of `traffic_type` in `response` once and return a
+    dictionary with the `total` count, the count of `offenders` delayed
+    `threshold` minutes or more, and the `max_delay` and `sum_delay` in
+    seconds.
+
+    This gives the same counts as `compare_to_threshold` on the result of
+    `diffs_from_response`, without building any intermediate lists."""
+    # Output for -vv:
+    maybe_output(print_on_levels=[2],
+                 actual_level=verbosity,
+                 msg='Evaluating departures against threshold: %s '
+                 '(evaluate_departures)',
+                 args=(threshold, ),
+                 stage='evaluate')
+    # A delay of `threshold` whole minutes or more is the same as a delay of
+    # `threshold` * 60 seconds or more.
+    threshold_seconds = int(threshold) * 60
+    total = offenders = max_delay = sum_delay = 0
+
+    for departure in departures_of(response, traffic_type):
+        delay = departure_delay(departure)
+        total += 1
+        sum_delay += delay
+        max_delay = max(max_delay, delay)
+        if delay >= threshold_seconds:
+            offenders += 1
+
+    return {
+        'total': total,
+        'offenders': offenders,
+        'max_delay': max_delay,
+        'sum_delay': sum_delay
+    }
+
+
 def compare_to_threshold(diffs, threshold, verbosity=0):
     "Compare the diffs to the threshold and return True for offenders."
     # Output for -vv:
     maybe_output(print_on_levels=[2],
                  actual_level=verbosity,
-                 msg=str('Comparing diffs to threshold: ' + str(threshold) +
-                         ' (compare_to_threshold)'))
+                 msg='Comparing diffs to threshold: %s (compare_to_threshold)',
+                 args=(threshold, ),
+                 stage='evaluate')
     results = []
     # Will produce a list of either True or False, like this:
     # [True, True, False]
@@ -325,9 +885,12 @@ def compare_to_threshold(diffs, threshold, verbosity=0):
 def calculate_percentage_of_offenders(results):
     """Calculate what percentage of `results` are True, which means that they
     were deemed above the threshold by `compare_to_threshold`."""
-    total_count = len(results)
-    true_count = results.count(True)
+    return calculate_percentage(results.count(True), len(results))
+
 
+def calculate_percentage(true_count, total_count):
+    """Calculate what percentage `true_count` is of `total_count`, rounded
+    down to an integer."""
     # Limit the result to an integer, for easy comparison.
     # Acceptable since we are only going to compare against integers,
     # and since we only care wether or not the result is equal to or greater
@@ -346,19 +909,230 @@ def calculate_final_value(departure_api_key,
                           traffic_type,
                           threshold,
                           verbosity=0):
-    """Calculate the final `value` based on the results from `get_diffs`
-    using `calculate_percentage_of_offenders` and `compare_to_threshold`."""
+    """Calculate the final `value` for the departures of `site_id`, see
+    `calculate_value`."""
+    return calculate_value(
+        fetch_response(departure_api_key, site_id, time_window, verbosity),
+        traffic_type, threshold, verbosity)
+
+
+def calculate_value(response, traffic_type, threshold, verbosity=0):
+    """Calculate the final `value` for an already fetched `response`, using
+    `evaluate_departures` and `calculate_percentage`."""
     # Output for -vv:
     maybe_output(print_on_levels=[2],
                  actual_level=verbosity,
-                 msg='Calculating the final value. (calculate_final_value)')
-    diffs = get_diffs(departure_api_key, site_id, time_window, traffic_type,
-                      verbosity)
-    value = calculate_percentage_of_offenders(
-        compare_to_threshold(diffs, threshold, verbosity))
+                 msg='Calculating the final value. (calculate_value)')
+    evaluation = evaluate_departures(response, traffic_type, threshold,
+                                     verbosity)
+    value = calculate_percentage(evaluation['offenders'],
+                                 evaluation['total'])
     return value
 
 
+def sorted_delays(response, traffic_type, verbosity=0):
+    """Return the delays of all departures of `traffic_type` in `response`, in
+    seconds and sorted, from a single pass over the departures."""
+    # Output for -vv:
+    maybe_output(print_on_levels=[2],
+                 actual_level=verbosity,
+                 msg='Sorting the delays of the departures. (sorted_delays)')
+    delays = [
+        departure_delay(departure)
+        for departure in departures_of(response, traffic_type)
+    ]
+    delays.sort()
+    return delays
+
+
+def departure_key(departure):
+    """Return a key identifying `departure` in every response it is in: its
+    journey number, scheduled time and stop point. Returns None if the
+    departure lacks any of them."""
+    try:
+        return (str(departure['JourneyNumber']) + '/' +
+                departure['TimeTabledDateTime'] + '/' +
+                str(departure['StopPointNumber']))
+    except (KeyError, TypeError):
+        return None
+
+
+def keyed_delays(response, traffic_type, verbosity=0):
+    """Return a list of tuples of the `departure_key` and the delay in seconds
+    of every departure of `traffic_type` in `response`, listing departures
+    which are in the response more than once only once."""
+    # Output for -vv:
+    maybe_output(print_on_levels=[2],
+                 actual_level=verbosity,
+                 msg='Identifying the departures. (keyed_delays)')
+    delays = {}
+    unidentified = []
+    for departure in departures_of(response, traffic_type):
+        delay = departure_delay(departure)
+        key = departure_key(departure)
+        if key is None:
+            unidentified.append((None, delay))
+        else:
+            delays[key] = delay
+    return list(delays.items()) + unidentified
+
+
+def calculate_values(response, traffic_type, thresholds, verbosity=0):
+    """Calculate the final value of every threshold in `thresholds` for an
+    already fetched `response`, and return them in a dictionary keyed by the
+    threshold.
+
+    The delays are sorted once, after which the number of offenders of each
+    threshold is found by bisecting, instead of comparing all delays to every
+    threshold."""
+    # Output for -vv:
+    maybe_output(print_on_levels=[2],
+                 actual_level=verbosity,
+                 msg='Calculating the final values for thresholds: %s '
+                 '(calculate_values)',
+                 args=(thresholds, ),
+                 stage='evaluate')
+    return percentages_from_delays(
+        sorted_delays(response, traffic_type, verbosity), thresholds)
+
+
+def percentages_from_delays(delays, thresholds):
+    """Return the percentage of the sorted `delays` which are offenders of
+    each threshold in `thresholds`, in a dictionary keyed by the threshold."""
+    total = len(delays)
+    values = {}
+    for threshold in thresholds:
+        # A delay of `threshold` whole minutes or more is the same as a delay
+        # of `threshold` * 60 seconds or more.
+        offenders = total - bisect_left(delays, int(threshold) * 60)
+        values[threshold] = calculate_percentage(offenders, total)
+    return values
+
+
+def percentages_from_histogram(histogram, thresholds):
+    """Return the percentage of the departures in `histogram`, which maps
+    whole minutes of delay to a number of departures, which are offenders of
+    each threshold in `thresholds`, in a dictionary keyed by the threshold."""
+    total = sum(histogram.values())
+    values = {}
+    for threshold in thresholds:
+        offenders = sum(count for minutes, count in histogram.items()
+                        if minutes >= int(threshold))
+        values[threshold] = calculate_percentage(offenders, total)
+    return values
+
+
+def delay_statistics(delays):
+    """Return a dictionary of statistics of the sorted `delays`, in seconds:
+    their `count`, `mean` and `max`, and the percentiles `p50`, `p90` and
+    `p99`, using the nearest rank. Since the delays are sorted, every
+    percentile is a single lookup. All are 0 if there are no delays."""
+    count = len(delays)
+    statistics = {
+        'count': count,
+        'mean': sum(delays) // count if count else 0,
+        'max': delays[-1] if count else 0
+    }
+    for percentile in (50, 90, 99):
+        # The smallest delay which at least `percentile` % of the delays are
+        # less than or equal to.
+        rank = max((percentile * count + 99) // 100, 1)
+        statistics['p' + str(percentile)] = delays[rank - 1] if count else 0
+    return statistics
+
+
+def calculate_type_values(response,
+                          traffic_types,
+                          thresholds,
+                          type_policy='worst',
+                          verbosity=0,
+                          metrics=None,
+                          history=None,
+                          site_id=None,
+                          statistics=None,
+                          departure_delays=None):
+    """Calculate the final value of every threshold in `thresholds` for
+    several `traffic_types` of the same `response`, and return them in a
+    dictionary keyed by the threshold.
+
+    With the 'worst' `type_policy`, the value of a threshold is the highest
+    value of any of the traffic types, and with the 'combined' policy it is
+    calculated over the departures of all the traffic types together. The
+    value of the primary threshold for each traffic type is recorded in
+    `metrics`, if there is more than one.
+
+    With a `history`, the departures are recorded for `site_id` and the values
+    are calculated over all departures in the window of the history instead,
+    counting every departure once, see `DelayHistory`. Their number is
+    recorded in `metrics`.
+
+    If a `statistics` dictionary is given, it is updated with the
+    `delay_statistics` of all departures of the `traffic_types` in
+    `response`, which are never taken from the history. If a
+    `departure_delays` list is given, it is extended with the sorted delays
+    of the same departures."""
+    # Output for -vv:
+    maybe_output(print_on_levels=[2],
+                 actual_level=verbosity,
+                 msg='Calculating the %s values for traffic types: %s '
+                 '(calculate_type_values)',
+                 args=(type_policy, traffic_types),
+                 stage='evaluate')
+    traffic_type_names = {
+        api_format: name
+        for name, api_format in TRAFFIC_TYPE_API_FORMAT_OPTIONS.items()
+    }
+    type_delays = []
+    all_histograms = Counter()
+    values = {threshold: 0 for threshold in thresholds}
+    for traffic_type in traffic_types:
+        if history is None:
+            delays = sorted_delays(response, traffic_type, verbosity)
+            type_values = percentages_from_delays(delays, thresholds)
+        else:
+            departures = keyed_delays(response, traffic_type, verbosity)
+            delays = sorted(delay for _key, delay in departures)
+            histogram = history.update(site_id, traffic_type, departures)
+            all_histograms.update(histogram)
+            type_values = percentages_from_histogram(histogram, thresholds)
+        if (type_policy == 'combined' or statistics is not None
+                or departure_delays is not None):
+            type_delays.append(delays)
+        if len(traffic_types) > 1:
+            record_metric(
+                metrics, '\'Percentage delayed ' +
+                traffic_type_names.get(traffic_type, traffic_type) + '\'',
+                type_values[thresholds[0]], '%')
+        if type_policy != 'combined':
+            for threshold in thresholds:
+                values[threshold] = max(values[threshold],
+                                        type_values[threshold])
+
+    # The delays of each traffic type are sorted, so merging them keeps all of
+    # them sorted without sorting them again.
+    all_delays = list(heapq.merge(*type_delays))
+    if statistics is not None:
+        statistics.update(delay_statistics(all_delays))
+    if departure_delays is not None:
+        departure_delays.extend(all_delays)
+
+    if history is not None:
+        history_departures = sum(all_histograms.values())
+        # Output for -vv:
+        maybe_output(print_on_levels=[2],
+                     actual_level=verbosity,
+                     msg='Departures in the window of the history: %s '
+                     '(calculate_type_values)',
+                     args=(history_departures, ),
+                     stage='evaluate')
+        record_metric(metrics, 'history_departures', history_departures)
+        if type_policy == 'combined':
+            values = percentages_from_histogram(all_histograms, thresholds)
+    elif type_policy == 'combined':
+        values = percentages_from_delays(all_delays, thresholds)
+    return values
+
+
 def determine_state(value, warning='', critical=''):
     """Based on `value`, calculate if it is greater or equal either `critical`
     or `warning` and return the corresponding state as an integer of either
@@ -378,37 +1152,578 @@ def plugin_main(site_api_key,
                 minutes,
                 warning,
                 critical,
-                verbosity=0):
+                verbosity=0,
+                request_timeout=None,
+                site_cache=None,
+                response_cache=None,
+                type_policy='worst',
+                deadline=None,
+                history=None,
+                statistics=False,
+                p90_warning=None,
+                p90_critical=None,
+                transfer_stats=False,
+                stage_timings=False,
+                concurrent_lookups=True):
     """Main function that will execute the actual API call function and
-    determine the state based on the value returned."""
+    determine the state based on the value returned.
+
+    All requests are given up when `deadline`, a `time.monotonic` value, is
+    reached, and `DeadlineExceeded` is raised. With a `history`, the state is
+    determined over its window, see `calculate_type_values`. See
+    `evaluate_check` for `statistics`, `p90_warning` and `p90_critical`, and
+    `lookup_response` for `transfer_stats`. With `stage_timings`, the time
+    taken by every stage of the check is added to the perfdata, see
+    `STAGES`. It may also be a dictionary to record the times in, see
+    `profiling.MemoryStages`. With `concurrent_lookups`, the site and the
+    departures are fetched concurrently, in two threads of their own."""
     # Output for -vv:
     maybe_output(print_on_levels=[2],
                  actual_level=verbosity,
                  msg="Enter the function `plugin_main`.")
-    name = fetch_site(site_api_key, site_id, verbosity)
 
-    value = calculate_final_value(departure_api_key, site_id, period,
-                                  traffic_type_api_format, minutes, verbosity)
+    # Metrics reported as perfdata in addition to the percentage delayed.
+    metrics = {}
+    # Only timed when asked for, since nobody reads them otherwise.
+    if isinstance(stage_timings, dict):
+        stage_times = stage_timings
+    else:
+        stage_times = {} if stage_timings else None
+
+    def site_lookup():
+        return lookup_site(site_api_key, site_id, verbosity, request_timeout,
+                           site_cache, deadline, stage_times)
+
+    def departures_lookup():
+        return lookup_response(departure_api_key, site_id, period, verbosity,
+                               request_timeout, response_cache, metrics,
+                               deadline, traffic_type_api_format,
+                               transfer_stats, stage_times)
+
+    if concurrent_lookups:
+        # The site name and the departures are independent of each other, so
+        # fetch them concurrently. The results are collected in the same
+        # order as they used to be fetched in, so that an invalid site id is
+        # still reported before any problem with the departures.
+        # Imported here, to keep the startup of the plugin fast.
+        # pylint: disable=import-outside-toplevel
+        from concurrent.futures import ThreadPoolExecutor
+        with ThreadPoolExecutor(max_workers=2) as executor:
+            site_future = executor.submit(site_lookup)
+            response_future = executor.submit(departures_lookup)
+            name = site_future.result()
+            response = response_future.result()
+    else:
+        name = site_lookup()
+        response = departures_lookup()
+
+    evaluate_check(name, response, traffic_type_api_format, minutes, warning,
+                   critical, verbosity, metrics, type_policy, history, site_id,
+                   statistics, p90_warning, p90_critical, stage_times)
+
+
+def evaluate_check(name,
+                   response,
+                   traffic_type_api_format,
+                   minutes,
+                   warning,
+                   critical,
+                   verbosity=0,
+                   metrics=None,
+                   type_policy='worst',
+                   history=None,
+                   site_id=None,
+                   statistics=False,
+                   p90_warning=None,
+                   p90_critical=None,
+                   stage_times=None):
+    """Determine the state of a check from the site `name` and the departures
+    `response`, and exit the plugin with it. Shared by all engines.
+
+    With a list of thresholds in `minutes`, the first one is the primary
+    threshold which `warning` and `critical` apply to, and the value of every
+    threshold is added to the perfdata. With a list of traffic types in
+    `traffic_type_api_format`, their values are combined according to
+    `type_policy` (see `calculate_type_values`), and the value of every
+    traffic type is added to the perfdata. With a `history`, the departures
+    are recorded for `site_id` and the values are calculated over the window
+    of the history.
+
+    With `statistics`, the `delay_statistics` of the departures are added to
+    the perfdata, and the 90th percentile of the delays, in seconds, is also
+    compared to `p90_warning` and `p90_critical`.
+
+    If a `stage_times` dictionary is given, the time of the evaluation is
+    added to it, and all of them to the perfdata, see `record_timing`."""
+    start = time.perf_counter()
+    thresholds = minutes_thresholds(minutes)
+    minutes = thresholds[0]
+    single_type = isinstance(traffic_type_api_format, str)
+    if metrics is None:
+        metrics = {}
+
+    delay_stats = {} if statistics else None
+
+    if history is not None or statistics:
+        values = calculate_type_values(
+            response, [traffic_type_api_format]
+            if single_type else traffic_type_api_format, thresholds,
+            type_policy, verbosity, metrics, history, site_id, delay_stats)
+        value = values[minutes]
+    elif single_type and len(thresholds) == 1:
+        value = calculate_value(response, traffic_type_api_format, minutes,
+                                verbosity)
+    elif single_type:
+        values = calculate_values(response, traffic_type_api_format,
+                                  thresholds, verbosity)
+        value = values[minutes]
+    else:
+        values = calculate_type_values(response, traffic_type_api_format,
+                                       thresholds, type_policy, verbosity,
+                                       metrics)
+        value = values[minutes]
+
+    if len(thresholds) > 1:
+        for threshold in thresholds:
+            record_metric(metrics,
+                          '\'Percentage delayed ' + str(threshold) + 'm\'',
+                          values[threshold], '%')
     # Output for -vv:
     maybe_output(print_on_levels=[2],
                  actual_level=verbosity,
-                 msg=str('Percentage of departures delayed above threshold: ' +
-                         str(value) + ' (plugin_main)'))
+                 msg='Percentage of departures delayed above threshold: %s '
+                 '(evaluate_check)',
+                 args=(value, ),
+                 stage='evaluate')
 
     state = determine_state(value, warning, critical)
 
+    if statistics:
+        record_metric(metrics, 'delay_count', delay_stats['count'])
+        record_metric(metrics, 'delay_mean', delay_stats['mean'], 's')
+        record_metric(metrics, 'delay_max', delay_stats['max'], 's')
+        record_metric(metrics, 'delay_p50', delay_stats['p50'], 's')
+        record_metric(metrics, 'delay_p90', delay_stats['p90'], 's',
+                      p90_warning, p90_critical)
+        record_metric(metrics, 'delay_p99', delay_stats['p99'], 's')
+        state = worst_state([
+            state,
+            determine_state(delay_stats['p90'], p90_warning, p90_critical)
+        ])
+
     if not isinstance(warning, int):
         warning = ''
     if not isinstance(critical, int):
         critical = ''
 
+    record_timing(stage_times, 'evaluate', time.perf_counter() - start)
+    record_stage_metrics(metrics, stage_times, verbosity)
+
     exit_plugin(state=state,
                 value=value,
                 name=name,
                 warning=warning,
                 critical=critical,
                 minutes=minutes,
-                verbosity=verbosity)
+                verbosity=verbosity,
+                metrics=metrics)
+
+
+TRAFFIC_TYPE_API_FORMAT_OPTIONS = {
+    'METRO': 'Metros',
+    'BUS': 'Buses',
+    'TRAIN': 'Trains',
+    'TRAM': 'Trams',
+    'SHIP': 'Ships'
+}
+
+# How the values of several traffic types are combined into one, see
+# `calculate_type_values`.
+TYPE_POLICIES = ['worst', 'combined']
+
+
+def parse_traffic_types(text):
+    """Parse a comma separated list of traffic types, like 'BUS,METRO', or
+    'ALL' for all of them, and return it normalized to upper case without
+    duplicates. Raises ValueError for unknown traffic types."""
+    traffic_types = []
+    for field in text.split(','):
+        field = field.strip().upper()
+        if field != 'ALL' and field not in TRAFFIC_TYPE_API_FORMAT_OPTIONS:
+            raise ValueError('Invalid traffic type: ' + text)
+        if field not in traffic_types:
+            traffic_types.append(field)
+    if 'ALL' in traffic_types:
+        return 'ALL'
+    return ','.join(traffic_types)
+
+
+def api_traffic_types(traffic_type):
+    """Convert a traffic type from `parse_traffic_types` to the format of the
+    API: a string for a single traffic type, and a list for several."""
+    if traffic_type == 'ALL':
+        return list(TRAFFIC_TYPE_API_FORMAT_OPTIONS.values())
+    api_formats = [
+        TRAFFIC_TYPE_API_FORMAT_OPTIONS[field]
+        for field in traffic_type.split(',')
+    ]
+    if len(api_formats) == 1:
+        return api_formats[0]
+    return api_formats
+
+
+def validate_traffic_types(_context, _parameter, value):
+    "Parse the --traffic-type option with `parse_traffic_types`."
+    if value is None:
+        return None
+    try:
+        return parse_traffic_types(value)
+    except ValueError as exception_message:
+        raise click.BadParameter(
+            'must be one of ' + ', '.join(TRAFFIC_TYPE_API_FORMAT_OPTIONS) +
+            ', a comma separated list of them, or ALL.') from exception_message
+
+
+# The order in which the states are considered worse than each other when
+# summarizing several checks, from best to worst.
+STATE_SEVERITY = [0, 3, 1, 2]
+
+
+def worst_state(states):
+    "Return the worst of `states`, where CRITICAL > WARNING > UNKNOWN > OK."
+    worst = 0
+    for state in states:
+        if STATE_SEVERITY.index(state) > STATE_SEVERITY.index(worst):
+            worst = state
+    return worst
+
+
+def timeout_message(timeout):
+    "Return the message used when the plugin times out after `timeout`."
+    if timeout == 1:
+        return 'Timeout reached after 1 second'
+    return 'Timeout reached after ' + str(timeout) + ' seconds'
+
+
+def check_deadline(timeout, batch_timeout=None, batch_deadline=None):
+    """Return the deadline of a check of a batch starting now, together with
+    the timeout to report if it is reached. The check gets `timeout` seconds,
+    unless `batch_deadline`, the end of the `batch_timeout` shared by all
+    checks of the batch, comes first."""
+    deadline = start_deadline(timeout)
+    if batch_deadline is not None and batch_deadline < deadline:
+        return batch_deadline, batch_timeout
+    return deadline, timeout
+
+
+def start_deadline(timeout=None):
+    """Return the deadline, as a `time.monotonic` value, of something starting
+    now with `timeout` seconds to go, or None if there is no `timeout`."""
+    if timeout is None:
+        return None
+    return time.monotonic() + timeout
+
+
+def parse_minutes(text):
+    """Parse a comma separated list of delay thresholds in minutes, like
+    '1,3,5'. A single threshold is returned as an int, and several as a list
+    of unique ints where the first one is the primary threshold. Raises
+    ValueError for anything else."""
+    thresholds = []
+    for field in text.split(','):
+        field = field.strip()
+        if not field.isdigit():
+            raise ValueError('Invalid minutes: ' + text)
+        if int(field) not in thresholds:
+            thresholds.append(int(field))
+    if len(thresholds) == 1:
+        return thresholds[0]
+    return thresholds
+
+
+def minutes_thresholds(minutes):
+    "Return `minutes` from `parse_minutes` as a list of thresholds."
+    if isinstance(minutes, int):
+        return [minutes]
+    return list(minutes)
+
+
+def validate_minutes(_context, _parameter, value):
+    "Parse the --minutes option with `parse_minutes`."
+    if value is None:
+        return None
+    try:
+        return parse_minutes(value)
+    except ValueError as exception_message:
+        raise click.BadParameter(
+            'must be a whole number of minutes, or a comma separated list ' +
+            'of them, like 1,3,5.') from exception_message
+
+
+def parse_listen(text):
+    """Parse an address to listen on, like 'localhost:9861' or ':9861', into
+    a tuple of host and port. An empty host means all interfaces. Raises
+    ValueError for anything else."""
+    host, separator, port = text.rpartition(':')
+    if not separator or not port.isdigit() or int(port) > 65535:
+        raise ValueError('Invalid address: ' + text)
+    return host, int(port)
+
+
+def validate_listen(_context, _parameter, value):
+    "Parse the --listen option with `parse_listen`."
+    try:
+        return parse_listen(value)
+    except ValueError as exception_message:
+        raise click.BadParameter(
+            'must be a port, optionally with a host, like :9861 or ' +
+            'localhost:9861.') from exception_message
+
+
+def validate_base_url(_context, _parameter, value):
+    "Check that the --base-url option is an HTTP(S) URL."
+    if value is not None and not value.startswith(('http://', 'https://')):
+        raise click.BadParameter('must start with http:// or https://.')
+    return value
+
+
+def parse_threshold(value, name, line_number):
+    """Parse an optional threshold (0-100) from a sites file row. Empty values
+    return None, just like an omitted option."""
+    if value.strip() == '':
+        return None
+    try:
+        threshold = int(value)
+    except ValueError:
+        threshold = -1
+    if not 0 <= threshold <= 100:
+        exit_plugin(4,
+                    error=('Invalid ' + name + ' on line ' +
+                           str(line_number) + ' of --sites-file: ' + value))
+    return threshold
+
+
+def parse_site_row(fields, line_number):
+    """Parse one row of a sites file into a dictionary.
+
+    The columns are: site_id, traffic_type, minutes, warning, critical and
+    service, where warning, critical and service are optional."""
+    fields = [field.strip() for field in fields]
+
+    if not 3 <= len(fields) <= 6:
+        exit_plugin(4,
+                    error=('Expected 3 to 6 columns on line ' +
+                           str(line_number) + ' of --sites-file, got ' +
+                           str(len(fields))))
+
+    fields += [''] * (6 - len(fields))
+    site_id, traffic_type, minutes, warning, critical, service = fields
+
+    if not site_id.isdigit() or int(site_id) < 1:
+        exit_plugin(4,
+                    error=('Invalid site id on line ' + str(line_number) +
+                           ' of --sites-file: ' + site_id))
+    try:
+        traffic_type = parse_traffic_types(traffic_type)
+    except ValueError:
+        exit_plugin(4,
+                    error=('Invalid traffic type on line ' +
+                           str(line_number) + ' of --sites-file: ' +
+                           traffic_type))
+    try:
+        thresholds = parse_minutes(minutes)
+    except ValueError:
+        exit_plugin(4,
+                    error=('Invalid minutes on line ' + str(line_number) +
+                           ' of --sites-file: ' + minutes))
+
+    warning = parse_threshold(warning, 'warning', line_number)
+    critical = parse_threshold(critical, 'critical', line_number)
+
+    if isinstance(critical, int) and isinstance(
+            warning, int) and warning > critical:
+        exit_plugin(4,
+                    error=('Warning (' + str(warning) +
+                           ') higher than critical (' + str(critical) +
+                           ') on line ' + str(line_number) +
+                           ' of --sites-file'))
+
+    if not service:
+        service = ' '.join([site_id, traffic_type, minutes])
+
+    return {
+        'site_id': int(site_id),
+        'traffic_type': traffic_type,
+        'minutes': thresholds,
+        'warning': warning,
+        'critical': critical,
+        'service': service
+    }
+
+
+def read_sites_file(sites_file):
+    """Read the rows of a sites file, which is a CSV file with one check per
+    line. Empty lines and lines starting with '#' are ignored."""
+    rows = []
+    for line_number, fields in enumerate(csv.reader(sites_file), start=1):
+        if not fields or not ''.join(fields).strip():
+            continue
+        if fields[0].strip().startswith('#'):
+            continue
+        rows.append(parse_site_row(fields, line_number))
+
+    if not rows:
+        exit_plugin(4, error='No checks found in --sites-file.')
+
+    return rows
+
+
+def unexpected_error(exception):
+    """Return the state and output of a check of a batch which raised the
+    unexpected `exception`, so that it does not abort the other checks."""
+    return 3, redact_api_keys('UNKNOWN: Unexpected error: ' + repr(exception))
+
+
+def run_check(site_api_key,
+              departure_api_key,
+              period,
+              row,
+              timeout,
+              verbosity=0,
+              request_timeout=None,
+              site_cache=None,
+              response_cache=None,
+              batch_timeout=None,
+              deadline=None,
+              history=None,
+              concurrent_lookups=True):
+    """Run `plugin_main` for a single `row` of a sites file and return the
+    resulting state and output instead of exiting. The check is given up
+    after `timeout` seconds, or at the `deadline` of the batch, see
+    `check_deadline`. See `plugin_main` for `concurrent_lookups`."""
+    row_deadline, reported_timeout = check_deadline(timeout, batch_timeout,
+                                                    deadline)
+    try:
+        plugin_main(site_api_key, departure_api_key, row['site_id'], period,
+                    api_traffic_types(row['traffic_type']), row['minutes'],
+                    row['warning'], row['critical'], verbosity,
+                    request_timeout, site_cache, response_cache,
+                    row.get('type_policy', 'worst'), row_deadline, history,
+                    row.get('statistics', False), row.get('p90_warning'),
+                    row.get('p90_critical'), row.get('transfer_stats', False),
+                    row.get('stage_timings', False), concurrent_lookups)
+    except click.ClickException as exception:
+        return int(exception.message), getattr(exception, 'output', '')
+    except DeadlineExceeded:
+        return 3, 'UNKNOWN: ' + timeout_message(reported_timeout)
+    except Exception as exception:  # pylint: disable=broad-except
+        return unexpected_error(exception)
+
+    # `plugin_main` always exits via `exit_plugin`, so this should not happen.
+    return 3, 'UNKNOWN: No result from check'
+
+
+def format_batch_result(row, state, output, passive_host=None):
+    """Format the result of a batch check, either as a plain line prefixed by
+    the service name or as a Nagios/Icinga passive check result."""
+    if passive_host:
+        return ('[' + str(int(time.time())) +
+                '] PROCESS_SERVICE_CHECK_RESULT;' + passive_host + ';' +
+                row['service'] + ';' + str(state) + ';' + output)
+    return row['service'] + ': ' + output
+
+
+def run_checks(site_api_key,
+               departure_api_key,
+               period,
+               rows,
+               timeout,
+               verbosity=0,
+               workers=1,
+               request_timeout=None,
+               engine='threads',
+               site_cache=None,
+               response_cache=None,
+               batch_timeout=None,
+               history=None):
+    """Run the checks for all `rows` and return a list of (state, output)
+    tuples in the same order as the rows.
+
+    With the 'threads' `engine` the checks are run on a pool of at most
+    `workers` threads, and with the 'async' engine they are run over a single
+    event loop with at most `workers` requests in flight.
+
+    Each check is given up after `timeout` seconds, and all of them after
+    `batch_timeout` seconds if it is given."""
+    deadline = start_deadline(batch_timeout)
+    # Output for -vv:
+    maybe_output(print_on_levels=[2],
+                 actual_level=verbosity,
+                 msg='Running %s checks using %s workers and the %s engine. '
+                 '(run_checks)',
+                 args=(len(rows), workers, engine))
+
+    if engine == 'async':
+        # Imported here, since it is only needed for this engine.
+        # pylint: disable=import-outside-toplevel,cyclic-import
+        from check_sl_delay import aio
+        return aio.run_checks(site_api_key, departure_api_key, period, rows,
+                              timeout, workers, verbosity, request_timeout,
+                              site_cache, response_cache, batch_timeout,
+                              deadline, history)
+
+    # With several workers, the checks already run in parallel, and each of
+    # them fetches the site and the departures in its own worker instead of
+    # starting two more threads.
+    concurrent_lookups = workers == 1
+
+    def check(row):
+        return run_check(site_api_key, departure_api_key, period, row,
+                         timeout, verbosity, request_timeout, site_cache,
+                         response_cache, batch_timeout, deadline, history,
+                         concurrent_lookups)
+
+    # Imported here, to keep the startup of the plugin fast.
+    # pylint: disable=import-outside-toplevel
+    from concurrent.futures import ThreadPoolExecutor
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        return list(executor.map(check, rows))
+
+
+def run_batch(site_api_key,
+              departure_api_key,
+              period,
+              rows,
+              timeout,
+              passive_host=None,
+              verbosity=0,
+              workers=1,
+              request_timeout=None,
+              engine='threads',
+              site_cache=None,
+              response_cache=None,
+              batch_timeout=None,
+              history=None):
+    """Run all checks in `rows` within this process, print one result line per
+    row and exit the plugin with the worst state of them all. See `run_checks`
+    for how `workers`, `engine` and `batch_timeout` are used."""
+    results = run_checks(site_api_key, departure_api_key, period, rows,
+                         timeout, verbosity, workers, request_timeout, engine,
+                         site_cache, response_cache, batch_timeout, history)
+
+    states = []
+    for row, (state, output) in zip(rows, results):
+        states.append(state)
+        click.echo(format_batch_result(row, state, output, passive_host))
+
+    raise plugin_exception(worst_state(states), '')
+
+
+def from_environment(name):
+    """Return True if the value of the parameter `name` of the current click
+    command was read from its environment variable."""
+    return (click.get_current_context().get_parameter_source(name) ==
+            click.core.ParameterSource.ENVIRONMENT)
 
 
 @click.command(context_settings=dict(help_option_names=['-h', '--help']))
@@ -439,14 +1754,15 @@ def plugin_main(site_api_key,
           'or equal than this option. Must be greater than ' + '--warning.'))
 @click.option('-i',
               '--site-id',
-              required=True,
               type=click.IntRange(1, ),
-              help='Site-id to check.')
+              help='Site-id to check. Required unless --sites-file is used.')
 @click.option('-m',
               '--minutes',
-              required=True,
-              type=click.IntRange(0, ),
-              help='Delay threshold, in minutes.')
+              callback=validate_minutes,
+              help=('Delay threshold, in minutes. Use a comma separated ' +
+                    'list, like 1,3,5, to check several thresholds at once, ' +
+                    'where the first one is used for --warning and ' +
+                    '--critical. Required unless --sites-file is used.'))
 @click.option('-p',
               '--period',
               required=True,
@@ -456,19 +1772,218 @@ def plugin_main(site_api_key,
               '--timeout',
               default=10,
               type=click.IntRange(0, ),
-              help='Plugin timeout, in seconds.')
+              help=('Plugin timeout, in seconds. With --sites-file it ' +
+                    'applies to each check separately.'))
+@click.option('--batch-timeout',
+              type=click.IntRange(0, ),
+              help=('Timeout shared by all checks in --sites-file, in ' +
+                    'seconds. Checks which are not done when it is reached ' +
+                    'are UNKNOWN. With --daemon or --exporter it applies to ' +
+                    'each poll.'))
+@click.option('--pool-size',
+              default=10,
+              type=click.IntRange(1, ),
+              help=('Number of connections to keep alive per host. Should ' +
+                    'be at least --workers.'))
+@click.option('--retries',
+              default=0,
+              type=click.IntRange(0, ),
+              help=('Number of times to retry failed requests, including ' +
+                    'responses with status 429, 500, 502, 503 and 504.'))
+@click.option('--backoff',
+              default=0.5,
+              type=click.FLOAT,
+              help=('Backoff factor between retries, in seconds. The n:th ' +
+                    'retry waits backoff * 2^(n - 1) seconds.'))
+@click.option('--http-backend',
+              default='requests',
+              type=click.Choice(transport.BACKENDS),
+              help=('HTTP library used for the requests. The stdlib backend ' +
+                    'starts faster, and keeps one connection per host and ' +
+                    '--workers alive.'))
+@click.option('--base-url',
+              envvar=BASE_URL_ENVVAR,
+              callback=validate_base_url,
+              help=('Base URL of the SL APIs, like http://127.0.0.1:8080 ' +
+                    'for a local check_sl_delay_fakeapi. Defaults to ' +
+                    API_BASE_URL + ', or $' + BASE_URL_ENVVAR + '.'))
+@click.option('-r',
+              '--request-timeout',
+              type=click.FLOAT,
+              help=('Timeout for each HTTP request, in seconds. Requests ' +
+                    'never outlast --timeout, which they share.'))
+@click.option('--site-rate-limit',
+              default=0,
+              type=click.IntRange(0, ),
+              help=('Requests per minute to send to SL Platsuppslag at ' +
+                    'most, spaced evenly. 0 means unlimited.'))
+@click.option('--departure-rate-limit',
+              default=0,
+              type=click.IntRange(0, ),
+              help=('Requests per minute to send to SL Realtidsinformation ' +
+                    'at most, spaced evenly. 0 means unlimited.'))
 @click.option('-T',
               '--traffic-type',
-              required=True,
-              type=click.Choice(['BUS', 'METRO', 'TRAIN']),
-              help='Traffic type to check.')
+              callback=validate_traffic_types,
+              help=('Traffic type to check: BUS, METRO, TRAIN, TRAM or ' +
+                    'SHIP. Use a comma separated list, like BUS,METRO, or ' +
+                    'ALL to check several traffic types of the same ' +
+                    'departures at once. Required unless --sites-file is ' +
+                    'used.'))
+@click.option('--type-policy',
+              default='worst',
+              type=click.Choice(TYPE_POLICIES),
+              help=('How the values of several traffic types are combined: ' +
+                    'the worst of them, or combined over all their ' +
+                    'departures.'))
+@click.option('--statistics',
+              is_flag=True,
+              help=('Add the count, mean, max and 50th, 90th and 99th ' +
+                    'percentile of the delays, in seconds, to the perfdata.'))
+@click.option('--p90-warning',
+              type=click.IntRange(0, ),
+              help=('Warning threshold for the 90th percentile of the ' +
+                    'delays, in seconds. Implies --statistics.'))
+@click.option('--p90-critical',
+              type=click.IntRange(0, ),
+              help=('Critical threshold for the 90th percentile of the ' +
+                    'delays, in seconds. Implies --statistics.'))
+@click.option('--transfer-stats',
+              is_flag=True,
+              help=('Add the size of the departures download, in bytes, ' +
+                    'and the time taken to decode it to the perfdata.'))
+@click.option('--stage-timings',
+              is_flag=True,
+              help=('Add the time taken by every stage of the check, like ' +
+                    'the requests to the APIs, decoding and evaluation, to ' +
+                    'the perfdata, in seconds.'))
+@click.option('--profile',
+              'profile_dir',
+              envvar='CHECK_SL_DELAY_PROFILE',
+              type=click.Path(file_okay=False),
+              help=('Profile the check with cProfile and write the ' +
+                    'statistics to a file in this directory, to be read ' +
+                    'with pstats. Also read from $CHECK_SL_DELAY_PROFILE.'))
+@click.option('--profile-memory',
+              is_flag=True,
+              envvar='CHECK_SL_DELAY_PROFILE_MEMORY',
+              help=('With --profile, trace the memory allocations of the ' +
+                    'check with tracemalloc instead, and write the peak of ' +
+                    'every stage and the largest allocations. Also adds ' +
+                    'the --stage-timings.'))
+@click.option('--log-json',
+              envvar='CHECK_SL_DELAY_LOG_JSON',
+              type=click.Path(dir_okay=False, allow_dash=True),
+              help=('Also write all verbose output, whatever the ' +
+                    'verbosity, as JSON lines with structured fields to ' +
+                    'this file, or to stderr if it is -. Also read from ' +
+                    '$CHECK_SL_DELAY_LOG_JSON.'))
+@click.option('--cache-dir',
+              default=default_cache_dir,
+              type=click.Path(file_okay=False),
+              help='Directory where the caches are stored.')
+@click.option('--site-cache-ttl',
+              default=7 * 24 * 3600,
+              type=click.IntRange(0, ),
+              help=('How long the names of validated sites are cached, in ' +
+                    'seconds.'))
+@click.option('--response-cache-ttl',
+              default=0,
+              type=click.IntRange(0, ),
+              help=('How long departure responses are shared between ' +
+                    'checks of the same site and --period, in seconds, for ' +
+                    'example 30. Disabled by default.'))
+@click.option('--no-cache',
+              is_flag=True,
+              help='Do not read or write any caches.')
+@click.option('--history-window',
+              default=0,
+              type=click.IntRange(0, ),
+              help=('Record the departures of every check in a history in ' +
+                    '--cache-dir, and calculate the percentage over all ' +
+                    'departures recorded in this many minutes, for example ' +
+                    '30, instead of only the current ones. Disabled by ' +
+                    'default.'))
+@click.option('--history-retention',
+              default=24 * 3600,
+              type=click.IntRange(0, ),
+              help=('How long departures are kept in the history, in ' +
+                    'seconds. Must cover --history-window.'))
+@click.option('-e',
+              '--engine',
+              default='threads',
+              type=click.Choice(['threads', 'async']),
+              help=('Engine used to run the checks in --sites-file. The ' +
+                    'async engine requires aiohttp.'))
+@click.option('-f',
+              '--sites-file',
+              type=click.File('r'),
+              help=('CSV file with one check per line, in the format: ' +
+                    'site_id,traffic_type,minutes[,warning[,critical' +
+                    '[,service]]]. All checks are run in one process and ' +
+                    'one result line is printed per check.'))
+@click.option('-P',
+              '--passive-host',
+              type=click.STRING,
+              help=('Print the results of --sites-file as passive check ' +
+                    'results for this host, to be written to the ' +
+                    'Nagios/Icinga command file.'))
+@click.option('-W',
+              '--workers',
+              default=1,
+              type=click.IntRange(1, ),
+              help=('Number of checks in --sites-file to run concurrently, ' +
+                    'or requests in flight with --engine async.'))
+@click.option('-D',
+              '--daemon',
+              is_flag=True,
+              help=('Keep running and poll the checks in --sites-file every ' +
+                    '--interval seconds, answering queries from ' +
+                    'check_sl_delay_client on --socket.'))
+@click.option('--interval',
+              default=60,
+              type=click.IntRange(1, ),
+              help=('Seconds between the polls of --daemon or --exporter, ' +
+                    'which are spread over the interval.'))
+@click.option('--max-interval',
+              type=click.IntRange(1, ),
+              help=('Seconds between the polls of sites without departures ' +
+                    'with --daemon or --exporter. Defaults to --interval.'))
+@click.option('--quiet-departures',
+              default=10,
+              type=click.IntRange(1, ),
+              help=('Sites with fewer departures than this are polled less ' +
+                    'often, up to every --max-interval seconds.'))
+@click.option('--socket',
+              'socket_path',
+              default=default_socket_path,
+              type=click.Path(dir_okay=False),
+              help='Path of the Unix domain socket of --daemon.')
+@click.option('--exporter',
+              is_flag=True,
+              help=('Keep running and poll the checks in --sites-file every ' +
+                    '--interval seconds, serving their metrics to ' +
+                    'Prometheus on --listen.'))
+@click.option('--listen',
+              default=':9861',
+              callback=validate_listen,
+              help='Address to serve the metrics of --exporter on.')
 @click.option('-v',
               '--verbose',
               count=True,
               help='Use 2 times for higher verbosity.')
 @click.version_option()
 def cli(site_api_key, departure_api_key, warning, critical, site_id, minutes,
-        period, timeout, traffic_type, verbose):
+        period, timeout, batch_timeout, pool_size, retries, backoff,
+        http_backend, base_url, request_timeout, site_rate_limit,
+        departure_rate_limit, traffic_type, type_policy, statistics,
+        p90_warning, p90_critical, transfer_stats, stage_timings, profile_dir,
+        profile_memory, log_json, cache_dir, site_cache_ttl,
+        response_cache_ttl, no_cache, history_window, history_retention,
+        engine, sites_file, passive_host, workers, daemon, interval,
+        max_interval, quiet_departures, socket_path, exporter, listen,
+        verbose):
+    # pylint: disable=too-many-branches,too-many-statements
     """check_sl_delay will connect to the SL API to determine the percentage of
     delayed departures for any given site-id.
 
@@ -485,40 +2000,153 @@ def cli(site_api_key, departure_api_key, warning, critical, site_id, minutes,
     departures in the coming 10 minutes. It will warn if the percentage of
     departures that are more than 1 minute late is 20% or more of the total
     amount of departures for the time period. It will crit if the same
-    percentage is 30% or more."""
+    percentage is 30% or more.
+
+    To check many sites in one process, list them in a --sites-file instead of
+    using --site-id, --traffic-type, --minutes, --warning and --critical. The
+    --timeout then applies to each check separately, and --workers checks are
+    run concurrently.
+
+    With --daemon, the checks in --sites-file are instead polled every
+    --interval seconds by a long-running process, and the latest result of a
+    service is queried with: check_sl_delay_client <service>
+
+    With --exporter, the checks in --sites-file are polled the same way, and
+    their metrics are served to Prometheus on http://<--listen>/metrics."""
+
+    try:
+        configure_log_sink(log_json)
+    except OSError as exception_message:
+        raise click.UsageError('Could not open --log-json: ' +
+                               str(exception_message))
 
     # Misc output for -vv:
     maybe_output(print_on_levels=[2], actual_level=verbose, msg='Variables:')
     maybe_output(print_on_levels=[2],
                  actual_level=verbose,
-                 msg=str('Threshold = ' + str(minutes) + ' minutes.'))
+                 msg='Threshold = %s minutes.',
+                 args=(minutes, ))
     maybe_output(print_on_levels=[2],
                  actual_level=verbose,
-                 msg=str('Warning = ' + str(warning)))
+                 msg='Warning = %s',
+                 args=(warning, ))
     maybe_output(print_on_levels=[2],
                  actual_level=verbose,
-                 msg=str('Critical = ' + str(critical)))
+                 msg='Critical = %s',
+                 args=(critical, ))
 
-    traffic_type_api_format_options = {
-        'METRO': 'Metros',
-        'BUS': 'Buses',
-        'TRAIN': 'Trains'
-    }
+    if daemon and not sites_file:
+        raise click.UsageError('--daemon requires --sites-file.')
+
+    if exporter and not sites_file:
+        raise click.UsageError('--exporter requires --sites-file.')
+
+    if exporter and engine == 'async':
+        raise click.UsageError(
+            '--exporter only runs on the threads --engine.')
+
+    if exporter and history_window:
+        raise click.UsageError(
+            '--exporter and --history-window can not be used together.')
+
+    if daemon and exporter:
+        raise click.UsageError(
+            '--daemon and --exporter can not be used together.')
+
+    # $CHECK_SL_DELAY_PROFILE is set for all checks of a monitoring system,
+    # and must not fail its batches, which are not profiled.
+    if profile_dir and sites_file and from_environment('profile_dir'):
+        # Output for -vv:
+        maybe_output(print_on_levels=[2],
+                     actual_level=verbose,
+                     msg='Not profiling --sites-file from the environment: %s',
+                     args=(profile_dir, ))
+        profile_dir = None
+        if from_environment('profile_memory'):
+            profile_memory = False
+
+    if profile_dir and sites_file:
+        raise click.UsageError(
+            '--profile only profiles single checks, not --sites-file.')
+
+    if profile_memory and not profile_dir:
+        raise click.UsageError('--profile-memory requires --profile.')
+
+    if not sites_file:
+        # These options are only optional when running a --sites-file.
+        for option, value in (("'-i' / '--site-id'", site_id),
+                              ("'-m' / '--minutes'", minutes),
+                              ("'-T' / '--traffic-type'", traffic_type)):
+            if value is None:
+                raise click.UsageError('Missing option ' + option + '.')
 
     # Convert the transportation type string to be in a format recognized
     # by the API:
-    traffic_type_api_format = traffic_type_api_format_options[traffic_type]
+    traffic_type_api_format = None
+    if traffic_type is not None:
+        traffic_type_api_format = api_traffic_types(traffic_type)
+
+    # Thresholds on the statistics are pointless without them.
+    if p90_warning is not None or p90_critical is not None:
+        statistics = True
+
+    # The names of validated sites are cached between invocations, to avoid
+    # calling the typeahead API on every check.
+    if no_cache:
+        site_cache = None
+    else:
+        site_cache = SiteCache(cache_dir, site_cache_ttl)
+
+    # Departure responses are shared for a short while between checks of
+    # different traffic types and thresholds for the same site.
+    if no_cache or response_cache_ttl == 0:
+        response_cache = None
+    else:
+        response_cache = ResponseCache(cache_dir, response_cache_ttl)
+
+    # The departures are only recorded when they are evaluated over a window.
+    history = None
+    if history_window > 0:
+        # Imported here, since it is only needed for this mode.
+        # pylint: disable=import-outside-toplevel,cyclic-import
+        from check_sl_delay.history import DelayHistory
+        history = DelayHistory(cache_dir, history_window * 60,
+                               history_retention)
+
+    # All requests share the same session, to reuse connections.
+    transport.configure_session(pool_size, retries, backoff, http_backend)
+    scheduler.configure_rate_limits(site_rate_limit, departure_rate_limit)
+    if base_url is not None:
+        configure_api_urls(base_url)
 
     # Exit functionality below:
 
     # This seemingly ugly solution is necessary to escape the grip of 'click'
     # with an exit code other than 0 and without printing anything to stderr.
     def exit_with_correct_code(exit_code):
+        for used_cache in (site_cache, response_cache):
+            if used_cache is not None:
+                # Output for -vv:
+                maybe_output(print_on_levels=[2],
+                             actual_level=verbose,
+                             msg='%s',
+                             args=(LazyFormat(used_cache.stats), ))
+        if history is not None:
+            # Output for -vv, only counting the history when it is output:
+            maybe_output(print_on_levels=[2],
+                         actual_level=verbose,
+                         msg='%s',
+                         args=(LazyFormat(history.stats), ))
+            history.close()
+        output = getattr(exit_code, 'output', '')
+        if output:
+            click.echo(output)
         sys.exit(int(str(exit_code)))
 
-    # Wrap the `plugin_main` function in `func_timeout` to be able to set a
-    # timeout option (-t) for the whole plugin, not only network related
-    # functions.
+    # The timeout option (-t) is a deadline for the whole plugin, which every
+    # request is given the time left of. A check reaching it raises
+    # `DeadlineExceeded`.
+    deadline = start_deadline(timeout)
     try:
         # Validation of crit and warn needs to be inside the try clause to
         # correctly exit.
@@ -541,27 +2169,86 @@ def cli(site_api_key, departure_api_key, warning, critical, site_id, minutes,
                         error=('--departure-api-key must be a' +
                                ' 32 characters long string.'))
 
-        func_timeout(timeout,
-                     plugin_main,
-                     args=(site_api_key, departure_api_key, site_id, period,
-                           traffic_type_api_format, minutes, warning, critical,
-                           verbose))
+        if request_timeout is not None and request_timeout <= 0:
+            exit_plugin(4,
+                        error=('--request-timeout must be greater than 0.'))
+
+        if (isinstance(p90_critical, int) and isinstance(p90_warning, int)
+                and p90_warning > p90_critical):
+            exit_plugin(4,
+                        error=('--p90-warning (' + str(p90_warning) +
+                               ') higher than --p90-critical (' +
+                               str(p90_critical) + ')'))
+
+        if history_retention < history_window * 60:
+            exit_plugin(4,
+                        error=('--history-retention must be at least ' +
+                               '--history-window.'))
+
+        if sites_file:
+            rows = read_sites_file(sites_file)
+            # The policy applies to every row with several traffic types, and
+            # the statistics to every row.
+            for row in rows:
+                row.update(type_policy=type_policy,
+                           statistics=statistics,
+                           p90_warning=p90_warning,
+                           p90_critical=p90_critical,
+                           transfer_stats=transfer_stats,
+                           stage_timings=stage_timings)
+
+        if daemon:
+            # Imported here, since it is only needed for this mode.
+            # pylint: disable=import-outside-toplevel,cyclic-import
+            from check_sl_delay import daemon as daemon_mode
+            daemon_mode.run_daemon(site_api_key, departure_api_key, period,
+                                   rows, timeout, socket_path, interval,
+                                   verbose, workers, request_timeout, engine,
+                                   site_cache, response_cache, batch_timeout,
+                                   history, max_interval, quiet_departures)
+
+        if exporter:
+            # Imported here, since it is only needed for this mode.
+            # pylint: disable=import-outside-toplevel,cyclic-import
+            from check_sl_delay import exporter as exporter_mode
+            exporter_mode.run_exporter(site_api_key, departure_api_key, period,
+                                       rows, timeout, listen, interval,
+                                       verbose, workers, request_timeout,
+                                       site_cache, response_cache,
+                                       batch_timeout, max_interval,
+                                       quiet_departures)
+
+        if sites_file:
+            run_batch(site_api_key, departure_api_key, period, rows, timeout,
+                      passive_host, verbose, workers, request_timeout, engine,
+                      site_cache, response_cache, batch_timeout, history)
+
+        def check(stage_times=stage_timings):
+            plugin_main(site_api_key, departure_api_key, site_id, period,
+                        traffic_type_api_format, minutes, warning, critical,
+                        verbose, request_timeout, site_cache, response_cache,
+                        type_policy, deadline, history, statistics,
+                        p90_warning, p90_critical, transfer_stats,
+                        stage_times)
+
+        if profile_dir:
+            # Imported here, since it is only needed when profiling.
+            # pylint: disable=import-outside-toplevel,cyclic-import
+            from check_sl_delay import profiling
+            profiling.run_profiled(check, profile_dir, str(site_id),
+                                   profile_memory, verbose)
+        else:
+            check()
 
     # This is the common exit point for most cases not related to input
     # validation or timeouts:
     except click.ClickException as exit_code:
         exit_with_correct_code(exit_code)
 
-    except FunctionTimedOut:
-        if timeout == 1:
-            timeout_message = 'Timeout reached after 1 second'
-        else:
-            timeout_message = ('Timeout reached after ' + str(timeout) +
-                               ' seconds')
-
+    except DeadlineExceeded:
         # Go through the `exit_plugin` function to set the correct message.
         try:
-            exit_plugin(error=timeout_message)
+            exit_plugin(error=timeout_message(timeout))
 
         # This is the actual exit point for timeouts:
         except click.ClickException as exit_code:
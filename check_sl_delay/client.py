@@ -0,0 +1,89 @@
+"""Thin client for the daemon mode of check_sl_delay.
+
+The client only asks a running `check_sl_delay --daemon` for the latest
+result of a service, so it deliberately imports nothing but the standard
+library modules it needs, to start and exit within milliseconds."""
+
+import argparse
+import os
+import socket
+import sys
+
+# The state and output returned when the daemon cannot be reached.
+UNKNOWN = 3
+
+
+def default_socket_path():
+    """Return the default path of the daemon socket, in the runtime dir if
+    there is one and otherwise in the cache dir."""
+    runtime_dir = os.environ.get('XDG_RUNTIME_DIR')
+    if runtime_dir:
+        return os.path.join(runtime_dir, 'check_sl_delay.sock')
+    cache_home = os.environ.get('XDG_CACHE_HOME') or os.path.join(
+        os.path.expanduser('~'), '.cache')
+    return os.path.join(cache_home, 'check_sl_delay', 'daemon.sock')
+
+
+def parse_reply(reply):
+    """Parse a reply from the daemon, which is the state on the first line
+    followed by the plugin output, into a tuple of (state, output)."""
+    state, _, output = reply.partition('\n')
+    try:
+        return int(state), output.rstrip('\n')
+    except ValueError:
+        return UNKNOWN, 'UNKNOWN: Invalid reply from daemon: ' + reply
+
+
+def query(service, socket_path=None, timeout=5.0):
+    """Ask the daemon listening on `socket_path` for the latest result of
+    `service` and return it as a tuple of (state, output)."""
+    if socket_path is None:
+        socket_path = default_socket_path()
+
+    try:
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as connection:
+            connection.settimeout(timeout)
+            connection.connect(socket_path)
+            connection.sendall(service.encode('utf-8') + b'\n')
+            chunks = []
+            while True:
+                chunk = connection.recv(4096)
+                if not chunk:
+                    break
+                chunks.append(chunk)
+    except socket.timeout:
+        return UNKNOWN, ('UNKNOWN: No reply from daemon within ' +
+                         str(timeout) + ' seconds')
+    except OSError as exception_message:
+        return UNKNOWN, ('UNKNOWN: Could not connect to daemon at ' +
+                         socket_path + ': ' + str(exception_message))
+
+    return parse_reply(b''.join(chunks).decode('utf-8', 'replace'))
+
+
+def main(argv=None):
+    """Print the latest result of a service from the daemon and exit with its
+    state, just like the plugin itself."""
+    parser = argparse.ArgumentParser(
+        description=('Query a running check_sl_delay --daemon for the ' +
+                     'latest result of a service in its --sites-file.'))
+    parser.add_argument('service', help='Service name, as in --sites-file.')
+    parser.add_argument('-s',
+                        '--socket',
+                        default=None,
+                        help=('Path of the daemon socket. Defaults to ' +
+                              default_socket_path()))
+    parser.add_argument('-t',
+                        '--timeout',
+                        default=5.0,
+                        type=float,
+                        help='Timeout for the reply, in seconds.')
+    args = parser.parse_args(argv)
+
+    state, output = query(args.service, args.socket, args.timeout)
+    print(output)
+    sys.exit(state)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,216 @@
+"""Daemon mode, keeping the results of a sites file fresh in a warm process.
+
+The daemon runs all checks of a sites file every `interval` seconds, spread
+over the interval, using the same engines as the batch mode, and answers
+queries for the latest result of a service over a Unix domain socket. The
+queries are made with the thin client in `check_sl_delay.client`, which
+avoids the cost of starting the full plugin for every check."""
+
+# pylint: disable=too-many-arguments,too-many-locals
+
+from contextlib import contextmanager
+import os
+import signal
+import socket
+from socketserver import StreamRequestHandler, ThreadingMixIn, UnixStreamServer
+import threading
+import time
+
+from check_sl_delay import check_sl_delay as plugin
+from check_sl_delay import scheduler
+
+
+class QueryHandler(StreamRequestHandler):
+    "Answer a query for the latest result of a service."
+
+    def handle(self):
+        "Read a service name and reply with its state and output."
+        service = self.rfile.readline(4096).decode('utf-8', 'replace').strip()
+        state, output = self.server.result(service)
+        self.wfile.write((str(state) + '\n' + output + '\n').encode('utf-8'))
+
+
+class DaemonServer(ThreadingMixIn, UnixStreamServer):
+    """Unix domain socket server holding the latest result of every service.
+
+    Results older than `max_age` seconds are reported as UNKNOWN, since the
+    daemon has then failed to poll the service in time."""
+    daemon_threads = True
+
+    def __init__(self, socket_path, services, max_age):
+        UnixStreamServer.__init__(self, socket_path, QueryHandler)
+        self.services = set(services)
+        self.max_age = max_age
+        self.results = {}
+        self._lock = threading.Lock()
+
+    def update(self, rows, results):
+        "Store the `results` of `run_checks` for `rows`."
+        now = time.time()
+        with self._lock:
+            for row, (state, output) in zip(rows, results):
+                self.results[row['service']] = (state, output, now)
+
+    def result(self, service):
+        "Return the latest state and output of `service`."
+        if service not in self.services:
+            return 3, 'UNKNOWN: No such service in --sites-file: ' + service
+
+        with self._lock:
+            latest = self.results.get(service)
+
+        if latest is None:
+            return 3, 'UNKNOWN: No result yet, the daemon is starting'
+
+        state, output, polled = latest
+        age = int(time.time() - polled)
+        if age > self.max_age:
+            return 3, ('UNKNOWN: The latest result is ' + str(age) +
+                       ' seconds old')
+        return state, output
+
+
+def check_services(rows):
+    "Exit the plugin if a service name is used by more than one row."
+    services = set()
+    for row in rows:
+        if row['service'] in services:
+            plugin.exit_plugin(4,
+                               error=('Duplicate service in --sites-file: ' +
+                                      row['service']))
+        services.add(row['service'])
+
+
+def remove_stale_socket(socket_path):
+    """Remove a socket left behind by a daemon which is no longer running, or
+    exit the plugin if there is a daemon listening on `socket_path`."""
+    if not os.path.exists(socket_path):
+        return
+
+    try:
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as connection:
+            connection.connect(socket_path)
+    except OSError:
+        os.unlink(socket_path)
+        return
+
+    plugin.exit_plugin(4,
+                       error=('A daemon is already listening on ' +
+                              socket_path))
+
+
+@contextmanager
+def stop_on_signals():
+    """Return an event which is set on SIGTERM or SIGINT while in the
+    context, after which the previous signal handlers are restored."""
+    stop = threading.Event()
+
+    def handle_signal(*_args):
+        stop.set()
+
+    previous_handlers = {
+        signum: signal.signal(signum, handle_signal)
+        for signum in (signal.SIGTERM, signal.SIGINT)
+    }
+    try:
+        yield stop
+    finally:
+        for signum, handler in previous_handlers.items():
+            signal.signal(signum, handler)
+
+
+def poll(server, schedule, check, stop, verbosity=0):
+    """Call `check` with the rows which are due in the `schedule`, a
+    `scheduler.Scheduler`, storing the results in `server`, until `stop` is
+    set."""
+    while not stop.is_set():
+        rows = schedule.due()
+        if not rows:
+            stop.wait(schedule.wait())
+            continue
+
+        start = time.monotonic()
+        try:
+            server.update(rows, check(rows))
+        # One bad poll must not stop the daemon, so report it as the result
+        # of the polled services instead.
+        except Exception as exception_message:  # pylint: disable=broad-except
+            output = plugin.redact_api_keys('UNKNOWN: Poll failed: ' +
+                                            repr(exception_message))
+            # Output for every verbosity:
+            plugin.maybe_output(print_on_levels=[0, 1, 2],
+                                actual_level=verbosity,
+                                msg='%s (poll)',
+                                args=(output, ))
+            server.update(rows, [(3, output)] * len(rows))
+        finally:
+            schedule.done()
+        elapsed = time.monotonic() - start
+
+        # Output for -vv:
+        plugin.maybe_output(print_on_levels=[2],
+                            actual_level=verbosity,
+                            msg='Polled %s checks in %s seconds, %s checks '
+                            'are overdue. (poll)',
+                            args=(len(rows), round(elapsed, 3),
+                                  plugin.LazyFormat(schedule.queue_depth)),
+                            duration=elapsed)
+
+
+def run_daemon(site_api_key,
+               departure_api_key,
+               period,
+               rows,
+               timeout,
+               socket_path,
+               interval=60,
+               verbosity=0,
+               workers=1,
+               request_timeout=None,
+               engine='threads',
+               site_cache=None,
+               response_cache=None,
+               batch_timeout=None,
+               history=None,
+               max_interval=None,
+               quiet_departures=10):
+    """Poll all checks in `rows` every `interval` seconds and answer queries
+    on `socket_path` until SIGTERM or SIGINT, then exit the plugin with OK.
+    See `check_sl_delay.run_checks` for how `workers`, `engine`,
+    `batch_timeout` and `history` are used, the timeout applying to each
+    poll, and `scheduler.Scheduler` for how the polls are spread and how
+    `max_interval` and `quiet_departures` are used.
+
+    A result is considered stale after two missed polls, that is when it is
+    older than two of the longest intervals plus the time a poll may
+    take."""
+    check_services(rows)
+
+    directory = os.path.dirname(socket_path)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+    remove_stale_socket(socket_path)
+
+    schedule = scheduler.Scheduler(rows, interval, max_interval,
+                                   quiet_departures)
+    server = DaemonServer(socket_path, [row['service'] for row in rows],
+                          2 * schedule.max_interval + timeout)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+
+    def check(due_rows):
+        return plugin.run_checks(site_api_key, departure_api_key, period,
+                                 due_rows, timeout, verbosity, workers,
+                                 request_timeout, engine, site_cache,
+                                 response_cache, batch_timeout, history)
+
+    try:
+        with stop_on_signals() as stop:
+            poll(server, schedule, check, stop, verbosity)
+    finally:
+        server.shutdown()
+        server.server_close()
+        os.unlink(socket_path)
+
+    raise plugin.plugin_exception(0, '')
@@ -0,0 +1,312 @@
+"""Prometheus exporter mode, serving the delays of a sites file as metrics.
+
+Like the daemon mode, the exporter polls all checks of a sites file every
+`interval` seconds in a warm process, using the same fetching and parsing as
+the plugin. The metrics of the latest poll are kept in memory and served on
+`/metrics` in the Prometheus text format, so scrapes never call the SL APIs.
+The metrics are labelled by the service, site id and traffic type of each row
+of the sites file, and the exporter also serves the state of its scheduler
+and of the rate limits of the APIs, see `scheduler`."""
+
+# pylint: disable=too-many-arguments,too-many-locals
+
+from bisect import bisect_right
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+import threading
+import time
+
+import click
+
+from check_sl_delay import check_sl_delay as plugin
+from check_sl_delay import daemon, scheduler
+
+# Upper bounds of the buckets of the delay histogram, in seconds.
+DELAY_BUCKETS = (0, 60, 120, 180, 300, 600, 900, 1800)
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+
+def collect(site_api_key,
+            departure_api_key,
+            period,
+            row,
+            timeout,
+            verbosity=0,
+            request_timeout=None,
+            site_cache=None,
+            response_cache=None,
+            batch_timeout=None,
+            deadline=None):
+    """Run the check of a single `row` of a sites file and return a dictionary
+    of the metrics of the departures, see `render_metrics`. The check is given
+    up like in `check_sl_delay.run_check`, and if it fails for any reason,
+    the metrics only tell so."""
+    traffic_types = plugin.api_traffic_types(row['traffic_type'])
+    if isinstance(traffic_types, str):
+        traffic_types = [traffic_types]
+    thresholds = plugin.minutes_thresholds(row['minutes'])
+    row_deadline = plugin.check_deadline(timeout, batch_timeout, deadline)[0]
+    metrics = {}
+    sample = {'up': 0, 'state': 3}
+
+    try:
+        plugin.lookup_site(site_api_key, row['site_id'], verbosity,
+                           request_timeout, site_cache, row_deadline)
+        start = time.perf_counter()
+        response = plugin.lookup_response(departure_api_key, row['site_id'],
+                                          period, verbosity, request_timeout,
+                                          response_cache, metrics,
+                                          row_deadline, traffic_types)
+        fetch_seconds = time.perf_counter() - start
+
+        # The percentages are calculated from the same sorted delays which
+        # are exported.
+        delays = []
+        values = plugin.calculate_type_values(response,
+                                              traffic_types,
+                                              thresholds,
+                                              row.get('type_policy', 'worst'),
+                                              departure_delays=delays)
+    except click.ClickException as exception:
+        sample['state'] = int(exception.message)
+        return sample
+    except plugin.DeadlineExceeded:
+        return sample
+    # A single bad row must not stop the polls of the others.
+    except Exception:  # pylint: disable=broad-except
+        return sample
+
+    sample.update(up=1,
+                  fetch_seconds=fetch_seconds,
+                  state=plugin.determine_state(values[thresholds[0]],
+                                               row['warning'],
+                                               row['critical']),
+                  values=values,
+                  departures=len(delays),
+                  delay_sum=sum(delays),
+                  buckets=[bisect_right(delays, bound)
+                           for bound in DELAY_BUCKETS],
+                  cache_hit=metrics.get('response_cache_hit', (None, ))[0])
+    return sample
+
+
+def escape_label(value):
+    "Escape a label value for the Prometheus text format."
+    return (str(value).replace('\\', '\\\\').replace('"', '\\"').replace(
+        '\n', '\\n'))
+
+
+def format_labels(labels):
+    "Format a list of label names and values for the Prometheus text format."
+    if not labels:
+        return ''
+    return '{' + ','.join(name + '="' + escape_label(value) + '"'
+                          for name, value in labels) + '}'
+
+
+# The type and help text of every exported metric, in the order they are
+# rendered.
+METRICS = {
+    'check_sl_delay_up': ('gauge',
+                          'Whether the latest poll of the check succeeded.'),
+    'check_sl_delay_state': ('gauge',
+                             'Nagios state of the latest poll of the check.'),
+    'check_sl_delay_last_poll_timestamp_seconds':
+    ('gauge', 'Time of the latest poll of the check.'),
+    'check_sl_delay_polls_total': ('counter', 'Polls of the check.'),
+    'check_sl_delay_response_cache_hits_total':
+    ('counter', 'Polls which read the departures from the response cache.'),
+    'check_sl_delay_fetch_duration_seconds':
+    ('gauge', 'Time taken to get the departures in the latest poll.'),
+    'check_sl_delay_departures': ('gauge', 'Departures in the latest poll.'),
+    'check_sl_delay_percentage_delayed':
+    ('gauge', 'Percentage of the departures delayed by at least minutes.'),
+    'check_sl_delay_delay_seconds_le':
+    ('gauge', 'Departures in the latest poll delayed by at most le seconds.'),
+    'check_sl_delay_delay_sum_seconds':
+    ('gauge', 'Sum of the delays of the departures in the latest poll.'),
+    'check_sl_delay_poll_interval_seconds':
+    ('gauge', 'Seconds between the polls of the check.'),
+    'check_sl_delay_scheduler_queue_depth':
+    ('gauge', 'Checks which are due but not being polled.'),
+    'check_sl_delay_api_requests_total': ('counter',
+                                          'Requests sent to the API.'),
+    'check_sl_delay_api_requests_waiting':
+    ('gauge', 'Requests waiting for the rate limit of the API.'),
+    'check_sl_delay_api_rate_limit_wait_seconds_total':
+    ('counter', 'Time requests have waited for the rate limit of the API.'),
+    'check_sl_delay_api_rate_limit_per_minute':
+    ('gauge', 'Rate limit of the API, 0 if unlimited.')
+}
+
+
+def render_metrics(rows, samples, counters, schedule=None):
+    """Render the latest `samples` of `rows`, the `counters` summed over all
+    polls, and the state of the `schedule` and the rate limits, in the
+    Prometheus text format."""
+    lines = {name: [] for name in METRICS}
+
+    def add(name, labels, value, suffix=''):
+        lines[name].append(name + suffix + format_labels(labels) + ' ' +
+                           str(value))
+
+    if schedule is not None:
+        add('check_sl_delay_scheduler_queue_depth', [],
+            schedule.queue_depth())
+    for api in scheduler.APIS:
+        limit = scheduler.rate_limit(api)
+        labels = [('api', api)]
+        add('check_sl_delay_api_requests_total', labels, limit.requests)
+        add('check_sl_delay_api_requests_waiting', labels, limit.waiting)
+        add('check_sl_delay_api_rate_limit_wait_seconds_total', labels,
+            round(limit.waited, 3))
+        add('check_sl_delay_api_rate_limit_per_minute', labels, limit.rate)
+
+    for index, row in enumerate(rows):
+        labels = [('service', row['service']), ('site_id', row['site_id']),
+                  ('traffic_type', row['traffic_type'])]
+        if schedule is not None:
+            add('check_sl_delay_poll_interval_seconds', labels,
+                round(schedule.intervals[index], 3))
+        sample = samples.get(row['service'])
+        if sample is None:
+            continue
+        add('check_sl_delay_up', labels, sample['up'])
+        add('check_sl_delay_state', labels, sample['state'])
+        add('check_sl_delay_last_poll_timestamp_seconds', labels,
+            sample['time'])
+        for counter in ('polls', 'response_cache_hits'):
+            add('check_sl_delay_' + counter + '_total', labels,
+                counters.get((row['service'], counter), 0))
+        if not sample['up']:
+            continue
+
+        add('check_sl_delay_fetch_duration_seconds', labels,
+            round(sample['fetch_seconds'], 6))
+        add('check_sl_delay_departures', labels, sample['departures'])
+        for threshold, value in sample['values'].items():
+            add('check_sl_delay_percentage_delayed',
+                labels + [('minutes', threshold)], value)
+        # Gauges rather than a histogram, since they are replaced by every
+        # poll instead of accumulating.
+        for bound, count in zip(DELAY_BUCKETS + ('+Inf', ),
+                                sample['buckets'] + [sample['departures']]):
+            add('check_sl_delay_delay_seconds_le', labels + [('le', bound)],
+                count)
+        add('check_sl_delay_delay_sum_seconds', labels, sample['delay_sum'])
+
+    output = []
+    for name, (metric_type, help_text) in METRICS.items():
+        if lines[name]:
+            output.extend(['# HELP ' + name + ' ' + help_text,
+                           '# TYPE ' + name + ' ' + metric_type] + lines[name])
+    return ''.join(line + '\n' for line in output)
+
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    "Serve the metrics of the latest poll on /metrics."
+
+    def do_GET(self):  # pylint: disable=invalid-name
+        "Reply with the metrics, or 404 for any other path."
+        if self.path.split('?')[0] != '/metrics':
+            self.send_error(404)
+            return
+        body = self.server.render().encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', CONTENT_TYPE)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *_args):  # pylint: disable=arguments-differ
+        "Do not log every scrape."
+
+
+class ExporterServer(ThreadingMixIn, HTTPServer):
+    "HTTP server holding the metrics of the latest poll of every row."
+    daemon_threads = True
+
+    def __init__(self, address, rows):
+        HTTPServer.__init__(self, address, MetricsHandler)
+        self.rows = rows
+        self.samples = {}
+        self.counters = {}
+        self.schedule = None
+        self._lock = threading.Lock()
+
+    def update(self, rows, samples):
+        "Store the `samples` of `collect` for `rows`."
+        now = time.time()
+        with self._lock:
+            for row, sample in zip(rows, samples):
+                sample['time'] = round(now, 3)
+                self.samples[row['service']] = sample
+                for name, count in (('polls', 1), ('response_cache_hits',
+                                                   sample.get('cache_hit')
+                                                   or 0)):
+                    key = (row['service'], name)
+                    self.counters[key] = self.counters.get(key, 0) + count
+
+    def render(self):
+        "Return the metrics in the Prometheus text format."
+        with self._lock:
+            return render_metrics(self.rows, self.samples, self.counters,
+                                  self.schedule)
+
+
+def run_exporter(site_api_key,
+                 departure_api_key,
+                 period,
+                 rows,
+                 timeout,
+                 address,
+                 interval=60,
+                 verbosity=0,
+                 workers=1,
+                 request_timeout=None,
+                 site_cache=None,
+                 response_cache=None,
+                 batch_timeout=None,
+                 max_interval=None,
+                 quiet_departures=10):
+    """Poll all checks in `rows` every `interval` seconds, on a pool of
+    `workers` threads, and serve their metrics on `address` until SIGTERM or
+    SIGINT, then exit the plugin with OK. `batch_timeout` applies to each
+    poll, see `check_sl_delay.run_checks`, and the polls are scheduled like
+    in `daemon.run_daemon`."""
+    daemon.check_services(rows)
+
+    try:
+        server = ExporterServer(address, rows)
+    except OSError as exception_message:
+        plugin.exit_plugin(4,
+                           error=('Could not listen on ' + address[0] + ':' +
+                                  str(address[1]) + ': ' +
+                                  str(exception_message)))
+    server.schedule = scheduler.Scheduler(rows, interval, max_interval,
+                                          quiet_departures)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+
+    def check(due_rows):
+        deadline = plugin.start_deadline(batch_timeout)
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            return list(
+                executor.map(
+                    lambda row: collect(site_api_key, departure_api_key,
+                                        period, row, timeout, verbosity,
+                                        request_timeout, site_cache,
+                                        response_cache, batch_timeout,
+                                        deadline), due_rows))
+
+    try:
+        with daemon.stop_on_signals() as stop:
+            daemon.poll(server, server.schedule, check, stop, verbosity)
+    finally:
+        server.shutdown()
+        server.server_close()
+
+    raise plugin.plugin_exception(0, '')
@@ -0,0 +1,369 @@
+"""Local stand-in for the SL APIs, to test and benchmark without network.
+
+Run `check_sl_delay_fakeapi` and point the plugin at it with --base-url, or
+start a server in the tests with `start_server`. Responses are generated,
+see `generate_response`, or replayed from a recording of the real APIs."""
+
+# pylint: disable=too-many-arguments,too-many-instance-attributes
+
+import argparse
+from collections import Counter
+from datetime import datetime, timedelta
+import gzip
+import hashlib
+from http.server import BaseHTTPRequestHandler, HTTPServer
+import json
+import os
+import random
+from socketserver import ThreadingMixIn
+import threading
+import time
+from urllib.parse import parse_qs, parse_qsl, urlencode, urlparse
+import urllib.request
+
+from check_sl_delay import check_sl_delay
+
+DATETIME_FORMAT = check_sl_delay.DATETIME_FORMAT
+
+# Size of the chunks which the bodies are sent in with `chunk_latency`.
+CHUNK_SIZE = 1024
+
+
+def generate_response(count=100,
+                      traffic_types=('Metros', 'Buses', 'Trains'),
+                      seed=0,
+                      start=datetime(2020, 3, 19, 13, 10)):
+    """Generate a realtimedeparturesV4 response with `count` departures
+    spread over `traffic_types`. The same `seed` gives the same response."""
+    rng = random.Random(seed)
+    response_data = {
+        'LatestUpdate': start.strftime(DATETIME_FORMAT),
+        'DataAge': 0,
+        'Metros': [],
+        'Buses': [],
+        'Trains': [],
+        'Trams': [],
+        'Ships': [],
+        'StopPointDeviations': []
+    }
+
+    for number in range(count):
+        traffic_type = traffic_types[number % len(traffic_types)]
+        scheduled = start + timedelta(seconds=rng.randrange(0, 3600, 15))
+        # Most departures are on time, some are a little late and a few are
+        # very late, like in a regular rush hour.
+        delay = rng.choice([0] * 6 + [rng.randrange(1, 180)] * 3 +
+                           [rng.randrange(180, 1200)])
+        response_data[traffic_type].append({
+            'TransportMode': traffic_type.upper()[:-1],
+            'LineNumber': str(rng.randrange(1, 200)),
+            'Destination': 'Destination ' + str(number % 17),
+            'JourneyDirection': rng.choice([1, 2]),
+            'StopAreaName': 'Stop area',
+            'StopAreaNumber': 1000,
+            'StopPointNumber': 1000 + number % 8,
+            'StopPointDesignation': str(number % 8),
+            'TimeTabledDateTime': scheduled.strftime(DATETIME_FORMAT),
+            'ExpectedDateTime': (scheduled +
+                                 timedelta(seconds=delay)).strftime(
+                                     DATETIME_FORMAT),
+            'DisplayTime': 'Nu',
+            'JourneyNumber': 10000 + number,
+            'Deviations': None
+        })
+
+    return {
+        'StatusCode': 0,
+        'Message': None,
+        'ExecutionTime': 0,
+        'ResponseData': response_data
+    }
+
+
+def filter_traffic_types(response, query):
+    """Return `response` without the departures of the traffic types which
+    `query` asks to leave out, like the realtimedeparturesV4 API does."""
+    left_out = [
+        api_format for name, api_format in
+        check_sl_delay.TRAFFIC_TYPE_API_FORMAT_OPTIONS.items()
+        if query.get(name.lower(), ['true'])[0] == 'false'
+    ]
+    if not left_out or not isinstance(response.get('ResponseData'), dict):
+        return response
+    response_data = dict(response['ResponseData'])
+    for api_format in left_out:
+        response_data[api_format] = []
+    return dict(response, ResponseData=response_data)
+
+
+def site_response(site_id, name):
+    "Return a typeahead response containing only the site `site_id`."
+    return {
+        'StatusCode': 0,
+        'Message': None,
+        'ExecutionTime': 0,
+        'ResponseData': [{
+            'Name': name,
+            'SiteId': str(site_id),
+            'Type': 'Station',
+            'X': '18059500',
+            'Y': '59331143'
+        }]
+    }
+
+
+class FakeAPIHandler(BaseHTTPRequestHandler):
+    "Answer the typeahead and realtimedeparturesV4 requests."
+    # Keep connections alive, like the real APIs, without waiting for more
+    # data to send after the headers.
+    protocol_version = 'HTTP/1.1'
+    disable_nagle_algorithm = True
+
+    def do_GET(self):  # pylint: disable=invalid-name
+        "Answer a GET request from the configuration of the server."
+        url = urlparse(self.path)
+        query = parse_qs(url.query)
+        self.server.requests[url.path] += 1
+
+        if self.server.latency:
+            time.sleep(self.server.latency)
+
+        if url.path == check_sl_delay.SITE_API_PATH:
+            api, site_id = 'site', query.get('searchstring', [''])[0]
+        elif url.path == check_sl_delay.DEPARTURE_API_PATH:
+            api, site_id = 'departures', query.get('siteid', [''])[0]
+        else:
+            self.send_error(404)
+            return
+
+        if self.server.failing():
+            self.send_error(503, 'Simulated error')
+            return
+        try:
+            body = self.server.respond(api, site_id, url.query)
+        except (OSError, ValueError) as exception_message:
+            self.send_error(502, 'Upstream error: ' + str(exception_message))
+            return
+        if api == 'departures':
+            body = filter_traffic_types(body, query)
+
+        content = json.dumps(body).encode('utf-8')
+        etag = '"' + hashlib.sha1(content).hexdigest()[:16] + '"'
+        if self.server.etags and self.headers.get('If-None-Match') == etag:
+            self.send_response(304)
+            self.send_header('ETag', etag)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json; charset=utf-8')
+        if self.server.etags:
+            self.send_header('ETag', etag)
+        if 'gzip' in self.headers.get('Accept-Encoding', ''):
+            content = gzip.compress(content)
+            self.send_header('Content-Encoding', 'gzip')
+        self.send_header('Content-Length', str(len(content)))
+        self.end_headers()
+        self.write_body(content)
+
+    def write_body(self, content):
+        "Send `content` as the body, in chunks if `chunk_latency` is set."
+        if not self.server.chunk_latency:
+            self.wfile.write(content)
+            return
+        for start in range(0, len(content), CHUNK_SIZE):
+            time.sleep(self.server.chunk_latency)
+            try:
+                self.wfile.write(content[start:start + CHUNK_SIZE])
+            # The client may give up before the whole body is sent.
+            except ConnectionError:
+                return
+
+    def log_message(self, *args):  # pylint: disable=arguments-differ
+        "Keep quiet, the requests are not interesting."
+
+
+class FakeAPIServer(ThreadingMixIn, HTTPServer):
+    """HTTP server answering like the SL APIs.
+
+    `departures` maps site ids (as strings) to departure responses, where the
+    key '' is used for any other site. `sites` maps site ids to names, or is
+    None to accept any site id. Every request is delayed by `latency`
+    seconds, counted by path in `requests`, and a random `error_rate` of
+    them are answered with 503 Service Unavailable. With `chunk_latency`,
+    the bodies are sent in chunks of `CHUNK_SIZE` bytes, each of them
+    delayed by that many seconds, like over a slow network. Responses are
+    compressed if the client accepts gzip, and with `etags` they are only
+    sent if they have changed since the ETag in If-None-Match.
+
+    With an `upstream` base URL, like `check_sl_delay.API_BASE_URL`, the
+    requests are instead forwarded there, and the responses are recorded in
+    the directory `recordings`. Without one, the responses recorded there are
+    replayed, and other sites are answered as above."""
+    daemon_threads = True
+
+    def __init__(self,
+                 address,
+                 departures,
+                 sites=None,
+                 latency=0.0,
+                 error_rate=0.0,
+                 recordings=None,
+                 upstream=None):
+        HTTPServer.__init__(self, address, FakeAPIHandler)
+        self.departures = departures
+        self.sites = sites
+        self.latency = latency
+        self.error_rate = error_rate
+        self.recordings = recordings
+        self.upstream = upstream
+        self.requests = Counter()
+        self.etags = False
+        self.chunk_latency = 0.0
+        self._random = random.Random(0)
+
+    @property
+    def base_url(self):
+        "The URL where the server can be reached."
+        return 'http://' + self.server_address[0] + ':' + str(
+            self.server_address[1])
+
+    def failing(self):
+        "Return True if the current request should fail, see `error_rate`."
+        return self.error_rate > 0 and self._random.random() < self.error_rate
+
+    def recording_path(self, api, site_id):
+        """Return the path of the recorded response of `api` for `site_id`,
+        or None if it can not be recorded."""
+        if self.recordings is None or not site_id.isdigit():
+            return None
+        return os.path.join(self.recordings, api + '-' + site_id + '.json')
+
+    def respond(self, api, site_id, query):
+        """Return the response of `api`, which is 'site' or 'departures', for
+        `site_id`, where `query` is the query string of the request."""
+        path = self.recording_path(api, site_id)
+        if self.upstream is not None:
+            body = fetch_upstream(self.upstream, api, query)
+            if path is not None:
+                os.makedirs(self.recordings, exist_ok=True)
+                with open(path, 'w', encoding='utf-8') as recording:
+                    json.dump(body, recording, indent=1)
+            return body
+        if path is not None and os.path.exists(path):
+            with open(path, encoding='utf-8') as recording:
+                return json.load(recording)
+
+        if api == 'departures':
+            return self.departures.get(site_id, self.departures.get(''))
+        if self.sites is None and site_id.isdigit():
+            return site_response(site_id, 'Site ' + site_id)
+        if self.sites and site_id in self.sites:
+            return site_response(site_id, self.sites[site_id])
+        return {'StatusCode': 0, 'ResponseData': []}
+
+
+def fetch_upstream(upstream, api, query):
+    """Forward a request to `api` with the query string `query` to the SL APIs
+    at the base URL `upstream`, and return the decoded response. The
+    departures of all traffic types are fetched, so that the recording can be
+    replayed for any of them."""
+    path = (check_sl_delay.SITE_API_PATH
+            if api == 'site' else check_sl_delay.DEPARTURE_API_PATH)
+    params = [(name, value) for name, value in parse_qsl(query)
+              if name.upper() not in
+              check_sl_delay.TRAFFIC_TYPE_API_FORMAT_OPTIONS]
+    with urllib.request.urlopen(upstream.rstrip('/') + path + '?' +
+                                urlencode(params),
+                                timeout=30) as response:
+        return json.loads(response.read().decode('utf-8'))
+
+
+def start_server(departures,
+                 sites=None,
+                 latency=0.0,
+                 address=('127.0.0.1', 0),
+                 error_rate=0.0,
+                 recordings=None,
+                 upstream=None):
+    """Start a `FakeAPIServer` in a background thread and return it. Stop it
+    with `shutdown` followed by `server_close`."""
+    server = FakeAPIServer(address, departures, sites, latency, error_rate,
+                           recordings, upstream)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    return server
+
+
+def api_urls(base_url):
+    """Return the SL API URLs of `check_sl_delay`, with the scheme and host
+    replaced by `base_url`."""
+    return tuple(base_url + path
+                 for path in (check_sl_delay.SITE_API_PATH,
+                              check_sl_delay.DEPARTURE_API_PATH))
+
+
+def main(argv=None):
+    """Serve a stand-in for the SL APIs until interrupted, for running the
+    plugin against with --base-url."""
+    parser = argparse.ArgumentParser(
+        description=('Serve a local stand-in for the SL APIs, to test and ' +
+                     'benchmark check_sl_delay without network.'))
+    parser.add_argument('-l',
+                        '--listen',
+                        default='127.0.0.1:8080',
+                        type=check_sl_delay.parse_listen,
+                        help='Address to listen on.')
+    parser.add_argument('--latency',
+                        default=0.0,
+                        type=float,
+                        help='Delay of every response, in seconds.')
+    parser.add_argument('--chunk-latency',
+                        default=0.0,
+                        type=float,
+                        help=('Delay of every ' + str(CHUNK_SIZE) +
+                              ' bytes of the responses, in seconds.'))
+    parser.add_argument('--departures',
+                        default=300,
+                        type=int,
+                        help='Number of departures of every site.')
+    parser.add_argument('--error-rate',
+                        default=0.0,
+                        type=float,
+                        help=('Fraction of the requests, between 0 and 1, ' +
+                              'answered with 503 Service Unavailable.'))
+    mode = parser.add_mutually_exclusive_group()
+    mode.add_argument('--record',
+                      metavar='DIR',
+                      help=('Forward the requests to --upstream and record ' +
+                            'the responses in DIR.'))
+    mode.add_argument('--replay',
+                      metavar='DIR',
+                      help='Replay the responses recorded in DIR.')
+    parser.add_argument('--upstream',
+                        default=check_sl_delay.API_BASE_URL,
+                        help='Base URL of the SL APIs to --record.')
+    args = parser.parse_args(argv)
+
+    server = FakeAPIServer(args.listen,
+                           {'': generate_response(args.departures)},
+                           latency=args.latency,
+                           error_rate=args.error_rate,
+                           recordings=args.record or args.replay,
+                           upstream=args.upstream if args.record else None)
+    server.chunk_latency = args.chunk_latency
+    print('Serving the SL APIs on ' + server.base_url + ', run ' +
+          'check_sl_delay with --base-url ' + server.base_url + ' or ' +
+          check_sl_delay.BASE_URL_ENVVAR + '=' + server.base_url)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,214 @@
+"""History of the delays of departures, stored between invocations of the
+plugin, for evaluating checks over a rolling window instead of a single poll.
+
+The history is stored in SQLite, which is part of the standard library. Every
+observed departure is stored in the `samples` table and counted in the
+`buckets` table, which holds the number of departures per whole minute of
+delay for every minute of time. A rolling window is evaluated from the
+buckets only, so the cost of a query depends on the length of the window and
+not on how much history there is. Both tables are pruned after the retention
+period, and the space freed is given back to the file system.
+
+A departure is seen by every poll until it leaves, so departures are
+identified by a key, see `check_sl_delay.departure_key`, and stored once. When
+a departure is seen again, its delay is updated to the latest one and it is
+moved to the bucket of the latest poll, so that it is counted once with its
+latest expected time."""
+
+from collections import Counter
+import os
+import sqlite3
+import threading
+import time
+
+from check_sl_delay import check_sl_delay as plugin
+
+# Length of the time buckets, in seconds.
+BUCKET_SECONDS = 60
+
+# Version of `SCHEMA`. A history with another version is recreated, since it
+# only holds recent departures anyway.
+SCHEMA_VERSION = 2
+
+SCHEMA = '''
+DROP TABLE IF EXISTS samples;
+DROP TABLE IF EXISTS buckets;
+CREATE TABLE samples (
+    site_id INTEGER NOT NULL,
+    traffic_type TEXT NOT NULL,
+    departure TEXT,
+    time REAL NOT NULL,
+    delay INTEGER NOT NULL,
+    UNIQUE (site_id, traffic_type, departure)
+);
+CREATE INDEX samples_time ON samples (time);
+CREATE TABLE buckets (
+    site_id INTEGER NOT NULL,
+    traffic_type TEXT NOT NULL,
+    bucket INTEGER NOT NULL,
+    minutes INTEGER NOT NULL,
+    count INTEGER NOT NULL,
+    PRIMARY KEY (site_id, traffic_type, bucket, minutes)
+);
+CREATE INDEX buckets_bucket ON buckets (bucket);
+'''
+
+
+def bucket_of(timestamp):
+    "Return the time bucket of `timestamp`."
+    return int(timestamp // BUCKET_SECONDS)
+
+
+class DelayHistory:
+    """Delays of departures in the last `retention` seconds, evaluated over
+    the last `window` seconds.
+
+    The history is stored in `cache_dir`, and may be shared by concurrent
+    threads and processes. Unlike the caches it is not best effort, since the
+    result of a check depends on it: `update` exits the plugin with UNKNOWN if
+    the history cannot be used."""
+
+    def __init__(self, cache_dir, window, retention):
+        self.path = os.path.join(cache_dir, 'history.sqlite')
+        self.window = window
+        self.retention = retention
+        self._connection = None
+        self._pruned_bucket = None
+        self._lock = threading.Lock()
+
+    def _connect(self):
+        "Return the connection to the history, opening it if needed."
+        if self._connection is None:
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            connection = sqlite3.connect(self.path,
+                                         timeout=30,
+                                         check_same_thread=False)
+            # Only has an effect when the file is created.
+            connection.execute('PRAGMA auto_vacuum = INCREMENTAL')
+            # Let other processes read while one of them is writing.
+            connection.execute('PRAGMA journal_mode = WAL')
+            with connection:
+                # Checked within a transaction, so that concurrent processes
+                # do not both create the tables.
+                connection.execute('BEGIN IMMEDIATE')
+                (version, ), = connection.execute(
+                    'PRAGMA user_version').fetchall()
+                if version != SCHEMA_VERSION:
+                    for statement in SCHEMA.split(';')[:-1]:
+                        connection.execute(statement)
+                    connection.execute('PRAGMA user_version = ' +
+                                       str(SCHEMA_VERSION))
+            self._connection = connection
+        return self._connection
+
+    def record(self, site_id, traffic_type, departures, now=None):
+        """Record the `departures` of `traffic_type` at `site_id` observed at
+        `now`, which are tuples of a departure key and a delay in seconds.
+        Departures without a key, which is None, are always added."""
+        if now is None:
+            now = time.time()
+        bucket = bucket_of(now)
+        # Changes of the counts of the buckets, keyed by bucket and minutes.
+        changes = Counter()
+        with self._lock:
+            connection = self._connect()
+            with connection:
+                for departure, delay in departures:
+                    previous = None
+                    if departure is not None:
+                        previous = connection.execute(
+                            'SELECT time, delay FROM samples WHERE ' +
+                            'site_id = ? AND traffic_type = ? AND ' +
+                            'departure = ?',
+                            (site_id, traffic_type, departure)).fetchone()
+                    if previous is None:
+                        connection.execute(
+                            'INSERT INTO samples VALUES (?, ?, ?, ?, ?)',
+                            (site_id, traffic_type, departure, now, delay))
+                    else:
+                        changes[bucket_of(previous[0]), previous[1] // 60] -= 1
+                        connection.execute(
+                            'UPDATE samples SET time = ?, delay = ? WHERE ' +
+                            'site_id = ? AND traffic_type = ? AND ' +
+                            'departure = ?',
+                            (now, delay, site_id, traffic_type, departure))
+                    changes[bucket, delay // 60] += 1
+                self._update_buckets(connection, site_id, traffic_type,
+                                     changes)
+            if self._pruned_bucket != bucket:
+                self._prune(connection, now)
+                self._pruned_bucket = bucket
+
+    @staticmethod
+    def _update_buckets(connection, site_id, traffic_type, changes):
+        "Apply the `changes` of the counts of the buckets."
+        for (bucket, minutes), change in changes.items():
+            if change == 0:
+                continue
+            key = (site_id, traffic_type, bucket, minutes)
+            connection.execute(
+                'INSERT OR IGNORE INTO buckets VALUES (?, ?, ?, ?, 0)', key)
+            connection.execute(
+                'UPDATE buckets SET count = count + ? WHERE site_id = ? AND ' +
+                'traffic_type = ? AND bucket = ? AND minutes = ?',
+                (change, ) + key)
+            if change < 0:
+                # Not needed when all departures have moved out of it.
+                connection.execute(
+                    'DELETE FROM buckets WHERE site_id = ? AND ' +
+                    'traffic_type = ? AND bucket = ? AND minutes = ? AND ' +
+                    'count <= 0', key)
+
+    def histogram(self, site_id, traffic_type, now=None):
+        """Return a dictionary mapping whole minutes of delay to the number of
+        departures of `traffic_type` at `site_id` delayed by them, over the
+        window ending at `now`. The window starts at the beginning of a
+        bucket, and includes the bucket of `now`."""
+        if now is None:
+            now = time.time()
+        first_bucket = bucket_of(now) - max(
+            int(self.window // BUCKET_SECONDS) - 1, 0)
+        with self._lock:
+            rows = self._connect().execute(
+                'SELECT minutes, SUM(count) FROM buckets WHERE site_id = ? ' +
+                'AND traffic_type = ? AND bucket >= ? GROUP BY minutes',
+                (site_id, traffic_type, first_bucket)).fetchall()
+        return dict(rows)
+
+    def update(self, site_id, traffic_type, departures, now=None):
+        """Record the `departures` observed `now`, see `record`, and return
+        the histogram of the window including them, see `histogram`."""
+        try:
+            self.record(site_id, traffic_type, departures, now)
+            return self.histogram(site_id, traffic_type, now)
+        except (sqlite3.Error, OSError) as exception_message:
+            plugin.exit_plugin(state=3,
+                               error='Could not use the history in ' +
+                               self.path + ': ' + str(exception_message))
+        return None
+
+    def _prune(self, connection, now):
+        "Remove everything older than the retention period."
+        with connection:
+            connection.execute('DELETE FROM samples WHERE time < ?',
+                               (now - self.retention, ))
+            connection.execute('DELETE FROM buckets WHERE bucket < ?',
+                               (bucket_of(now - self.retention), ))
+        connection.execute('PRAGMA incremental_vacuum')
+
+    def stats(self):
+        "Return a line summarizing the contents of the history."
+        try:
+            with self._lock:
+                (samples, ), = self._connect().execute(
+                    'SELECT COUNT(*) FROM samples').fetchall()
+        except (sqlite3.Error, OSError) as exception_message:
+            return 'History: ' + str(exception_message) + ' in ' + self.path
+        return 'History: ' + str(samples) + ' samples in ' + self.path
+
+    def close(self):
+        "Close the connection to the history."
+        with self._lock:
+            if self._connection is not None:
+                self._connection.close()
+                self._connection = None
@@ -0,0 +1,71 @@
+"""A sink for the verbose output as JSON lines, to be collected from batch
+and daemon runs.
+
+Every message of `check_sl_delay.maybe_output` is written as one JSON object
+per line, whatever the verbosity, with the time, the level ('debug' for the
+output of -vv and 'info' for the output of -v), the thread, the message and
+the structured fields of the message, like the site, stage and duration. The
+sink is built on the standard `logging` module, which is only imported when
+the sink is used."""
+
+import json
+import logging
+import sys
+
+LOGGER_NAME = 'check_sl_delay'
+
+
+class JsonFormatter(logging.Formatter):
+    "Format log records as JSON objects with their structured fields."
+
+    def format(self, record):
+        entry = {
+            'time': round(record.created, 6),
+            'level': record.levelname.lower(),
+            'thread': record.threadName,
+            'message': record.getMessage()
+        }
+        entry.update(getattr(record, 'fields', {}))
+        return json.dumps(entry, default=str)
+
+
+class JsonLogSink:
+    "Write the messages of `maybe_output` to `logger`."
+
+    # pylint: disable=too-few-public-methods
+
+    def __init__(self, logger):
+        self.logger = logger
+
+    def write(self, verbosity, msg, fields):
+        """Write `msg`, which is output at the `verbosity` level of -v or -vv,
+        with its structured `fields`."""
+        self.logger.log(logging.DEBUG if verbosity >= 2 else logging.INFO,
+                        msg,
+                        extra={'fields': fields})
+
+
+def close_sink():
+    "Close the handlers of the sink, if it has been opened."
+    logger = logging.getLogger(LOGGER_NAME)
+    for handler in list(logger.handlers):
+        logger.removeHandler(handler)
+        handler.close()
+
+
+def open_sink(path):
+    """Return a `JsonLogSink` writing JSON lines to `path`, which is
+    appended to, or to stderr if `path` is '-'. Raises `OSError` if `path`
+    can not be opened."""
+    close_sink()
+    if path == '-':
+        handler = logging.StreamHandler(sys.stderr)
+    else:
+        handler = logging.FileHandler(path, encoding='utf-8')
+    handler.setFormatter(JsonFormatter())
+    logger = logging.getLogger(LOGGER_NAME)
+    logger.addHandler(handler)
+    logger.setLevel(logging.DEBUG)
+    # Keep the records away from any handlers of the root logger.
+    logger.propagate = False
+    return JsonLogSink(logger)
@@ -0,0 +1,157 @@
+"""Profiling of single checks, to diagnose slow checks of large sites in
+production without patching the installed plugin.
+
+With --profile, a check is run under cProfile and the statistics are written
+to a file in the given directory, to be read with `pstats` or a viewer like
+snakeviz. With --profile-memory, the allocations of the check are traced
+with tracemalloc instead, and the peak of every stage of the check, see
+`check_sl_delay.STAGES`, and the largest allocations are written to a text
+file. Profiling is best effort: if the file cannot be written, the check is
+not affected."""
+
+import cProfile
+import os
+import pstats
+import sys
+import threading
+import time
+import tracemalloc
+
+from check_sl_delay import check_sl_delay as plugin
+
+# Number of allocation sites listed in the memory profile.
+TOP_ALLOCATIONS = 10
+
+
+class MemoryStages(dict):
+    """Stage times, see `check_sl_delay.record_timing`, which also record the
+    peak of the traced memory since the previous stage ended in `peaks`.
+    Stages which run concurrently share their peaks."""
+
+    def __init__(self):
+        dict.__init__(self)
+        self.peaks = {}
+        self._lock = threading.Lock()
+
+    def __setitem__(self, stage, seconds):
+        # The handshakes are part of the requests, which record their peaks.
+        if stage != 'connect':
+            with self._lock:
+                peak = tracemalloc.get_traced_memory()[1]
+                self.peaks[stage] = max(self.peaks.get(stage, 0), peak)
+                # Only available from Python 3.9.
+                if hasattr(tracemalloc, 'reset_peak'):
+                    tracemalloc.reset_peak()
+        dict.__setitem__(self, stage, seconds)
+
+
+class ThreadProfiles:
+    """cProfile profiles of the calling thread and of all threads started
+    while it is enabled, like the ones fetching the site and the departures
+    concurrently, which a single profile does not see."""
+
+    def __init__(self):
+        self.profiles = [cProfile.Profile()]
+        self._lock = threading.Lock()
+
+    def _start_thread(self, *_args):
+        "Replace the profile function of a new thread with a new profile."
+        sys.setprofile(None)
+        profile = cProfile.Profile()
+        try:
+            profile.enable()
+        except ValueError:
+            # Newer versions of Python only allow one profiler at a time.
+            return
+        with self._lock:
+            self.profiles.append(profile)
+
+    def runcall(self, function):
+        "Call `function` with all profiles enabled."
+        threading.setprofile(self._start_thread)
+        try:
+            return self.profiles[0].runcall(function)
+        finally:
+            threading.setprofile(None)
+
+    def dump_stats(self, path):
+        "Write the statistics of all profiles, merged, to `path`."
+        with self._lock:
+            stats = pstats.Stats(*self.profiles)
+        stats.dump_stats(path)
+
+
+def profile_path(directory, name, extension):
+    """Return the path of a new profile of the check `name` in `directory`,
+    which is unique per invocation of the plugin."""
+    return os.path.join(
+        directory, 'check_sl_delay-' + name + '-' +
+        time.strftime('%Y%m%dT%H%M%S') + '-' + str(os.getpid()) + extension)
+
+
+def format_memory_profile(stages, snapshot, peak):
+    """Format the `peak` of the traced memory since the last stage, the peaks
+    of the `stages` and the top allocations of `snapshot`."""
+    lines = [
+        'Peak memory of the check: ' +
+        str(max(list(stages.peaks.values()) + [peak])) + ' B',
+        'Peak memory per stage:'
+    ]
+    for stage in plugin.STAGES:
+        if stage in stages.peaks:
+            lines.append('  ' + stage + ': ' + str(stages.peaks[stage]) +
+                         ' B')
+    lines.append('Largest allocations:')
+    for statistic in snapshot.statistics('lineno')[:TOP_ALLOCATIONS]:
+        lines.append('  ' + str(statistic))
+    return '\n'.join(lines) + '\n'
+
+
+def write_profile(path, write, verbosity=0):
+    "Write a profile to `path` with `write`, creating its directory."
+    try:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        write(path)
+    except OSError as exception_message:
+        # Output for -vv:
+        plugin.maybe_output(print_on_levels=[2],
+                            actual_level=verbosity,
+                            msg='Could not write profile: %s (write_profile)',
+                            args=(exception_message, ))
+        return
+    # Output for -vv:
+    plugin.maybe_output(print_on_levels=[2],
+                        actual_level=verbosity,
+                        msg='Wrote profile to %s (write_profile)',
+                        args=(path, ))
+
+
+def run_profiled(check, directory, name, memory=False, verbosity=0):
+    """Call `check`, which exits the plugin, profiled, and write the profile
+    of the check `name` to `directory`. For the memory profile, `check` is
+    called with the `MemoryStages` to record the stages of the check in."""
+    if not memory:
+        profile = ThreadProfiles()
+        try:
+            profile.runcall(check)
+        finally:
+            write_profile(profile_path(directory, name, '.pstats'),
+                          profile.dump_stats, verbosity)
+        return
+
+    stages = MemoryStages()
+    tracemalloc.start()
+    try:
+        check(stages)
+    finally:
+        peak = tracemalloc.get_traced_memory()[1]
+        snapshot = tracemalloc.take_snapshot()
+        tracemalloc.stop()
+
+        def write(path):
+            with open(path, 'w', encoding='utf-8') as profile_file:
+                profile_file.write(
+                    format_memory_profile(stages, snapshot, peak))
+
+        write_profile(profile_path(directory, name, '.memory.txt'), write,
+                      verbosity)
@@ -0,0 +1,166 @@
+"""HTTP backend using a pooled `requests.Session`, see `transport`."""
+
+import functools
+import socket
+import time
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.connection import HTTPConnection, HTTPSConnection
+from urllib3.connectionpool import HTTPConnectionPool, HTTPSConnectionPool
+from urllib3.exceptions import (ConnectTimeoutError, DecodeError,
+                                ProtocolError, ReadTimeoutError, SSLError)
+from urllib3.util.retry import Retry
+
+from check_sl_delay import transport
+
+
+def resolve_host(connection, host):
+    """Return the address of `host`, the host of `connection`, resolved
+    within the timeout of the connection, see `transport.resolve`. If it can
+    not be resolved, `host` is returned for urllib3 to report the error."""
+    timeout = connection.timeout
+    try:
+        return transport.resolve(
+            host, connection.port,
+            timeout if isinstance(timeout, (int, float)) else None)[0][4][0]
+    except socket.timeout as exception:
+        raise ConnectTimeoutError(str(exception)) from exception
+    except socket.gaierror:
+        return host
+
+
+class TimedHTTPConnection(HTTPConnection):
+    """HTTP connection keeping track of the time spent connecting, and
+    resolving the host within its timeout, see `transport.resolve`."""
+
+    def connect(self):
+        # pylint: disable=attribute-defined-outside-init
+        start = time.perf_counter()
+        host = self._dns_host
+        try:
+            self._dns_host = resolve_host(self, host)
+            super().connect()
+        finally:
+            self._dns_host = host
+            transport.add_connect_time(start)
+
+
+class TimedHTTPSConnection(HTTPSConnection):
+    """HTTPS connection keeping track of the time spent connecting, and
+    resolving the host within its timeout, see `transport.resolve`. The
+    certificate is still verified for the name of the host."""
+
+    def connect(self):
+        # pylint: disable=attribute-defined-outside-init
+        start = time.perf_counter()
+        host = self._dns_host
+        try:
+            self._dns_host = resolve_host(self, host)
+            super().connect()  # pylint: disable=no-member
+        finally:
+            self._dns_host = host
+            transport.add_connect_time(start)
+
+
+class TimedHTTPConnectionPool(HTTPConnectionPool):
+    "Connection pool of `TimedHTTPConnection`."
+    ConnectionCls = TimedHTTPConnection
+
+
+class TimedHTTPSConnectionPool(HTTPSConnectionPool):
+    "Connection pool of `TimedHTTPSConnection`."
+    ConnectionCls = TimedHTTPSConnection
+
+
+class TimedHTTPAdapter(HTTPAdapter):
+    "Transport adapter using connections which keep track of connect times."
+
+    def init_poolmanager(self, *args, **kwargs):
+        super().init_poolmanager(*args, **kwargs)
+        self.poolmanager.pool_classes_by_scheme = {
+            'http': TimedHTTPConnectionPool,
+            'https': TimedHTTPSConnectionPool
+        }
+
+
+class DeadlineRetry(Retry):
+    """Retries of failed requests, which are given up at the deadline of the
+    request, see `transport.timed_get`."""
+
+    def is_exhausted(self):
+        return super().is_exhausted() or transport.deadline_reached()
+
+
+def read_chunk(response):
+    """Return the next chunk of the body of the streamed `response`, as soon
+    as any of it has arrived, or None when all of it has been read. The
+    errors of urllib3 are raised as the errors of requests, like
+    `requests.Response.iter_content` does."""
+    try:
+        return response.raw.read1(transport.CHUNK_SIZE,
+                                  decode_content=True) or None
+    except ReadTimeoutError as exception:
+        raise requests.exceptions.ConnectionError(exception) from exception
+    except ProtocolError as exception:
+        raise requests.exceptions.ChunkedEncodingError(
+            exception) from exception
+    except DecodeError as exception:
+        raise requests.exceptions.ContentDecodingError(
+            exception) from exception
+    except SSLError as exception:
+        raise requests.exceptions.SSLError(exception) from exception
+
+
+class DeadlineSession(requests.Session):
+    """Session reading the bodies of the responses in chunks, to give up at
+    the deadline of the request, see `transport.timed_get`, since the
+    timeout of requests applies to every read of the body."""
+
+    def get(self, url, **kwargs):  # pylint: disable=arguments-differ
+        response = super().get(url, stream=True, **kwargs)
+        # The connection of the response, whose socket is None once the
+        # body has been read.
+        connection = getattr(response.raw, 'connection', None)
+        if hasattr(response.raw, 'read1'):
+            next_chunk = functools.partial(read_chunk, response)
+        else:
+            # Older versions of urllib3 can only read whole chunks.
+            next_chunk = functools.partial(
+                next, response.iter_content(transport.CHUNK_SIZE), None)
+        content = []
+        try:
+            while True:
+                timeout = transport.time_left(kwargs.get('timeout'))
+                if getattr(connection, 'sock', None) is not None:
+                    connection.sock.settimeout(timeout)
+                chunk = next_chunk()
+                if chunk is None:
+                    break
+                content.append(chunk)
+        except BaseException:
+            response.close()
+            raise
+        # pylint: disable=protected-access
+        response._content = b''.join(content)
+        return response
+
+
+def create_session(pool_size=10, retries=0, backoff_factor=0.5):
+    """Create a `requests.Session` keeping up to `pool_size` connections per
+    host alive, and retrying failed requests up to `retries` times with an
+    exponential backoff of `backoff_factor` seconds."""
+    retry = DeadlineRetry(total=retries,
+                          connect=retries,
+                          read=retries,
+                          status=retries,
+                          backoff_factor=backoff_factor,
+                          status_forcelist=transport.RETRY_STATUSES,
+                          raise_on_status=False)
+    adapter = TimedHTTPAdapter(pool_connections=pool_size,
+                               pool_maxsize=pool_size,
+                               max_retries=retry)
+    session = DeadlineSession()
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    return session
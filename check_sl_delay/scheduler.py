@@ -0,0 +1,189 @@
+"""Scheduling of the polls of the long-running modes, within the rate limits
+of the SL APIs.
+
+Trafiklab limits the requests per minute of every API key. The requests to
+each API are limited with a token bucket, see `RateLimit`, which all modes
+share since the limits are kept in this module, like the session in
+`transport`. The daemon and exporter modes also spread the polls of their
+checks evenly over the interval with a `Scheduler`, instead of polling all of
+them at once, and poll sites with few departures less often."""
+
+# pylint: disable=too-many-instance-attributes
+
+import heapq
+import threading
+import time
+
+# The APIs, each of which has an API key with its own rate limit.
+APIS = ['site', 'departure']
+
+
+class RateLimit:
+    """Token bucket limiting the requests to an API to `rate` per minute,
+    spaced evenly, with bursts of up to `burst` requests. A `rate` of 0 does
+    not limit the requests, which are still counted."""
+
+    def __init__(self, rate=0, burst=1):
+        self.rate = rate
+        self.burst = burst
+        self.requests = 0
+        self.waiting = 0
+        self.waited = 0.0
+        self._tokens = float(burst)
+        self._updated = None
+        self._lock = threading.Lock()
+
+    def reserve(self, now=None):
+        """Take a token for a request and return the seconds to wait before
+        sending it. Requests which are waiting have already taken their
+        tokens, so later requests wait for them."""
+        if now is None:
+            now = time.monotonic()
+        with self._lock:
+            self.requests += 1
+            if not self.rate:
+                return 0.0
+            if self._updated is not None:
+                self._tokens = min(
+                    self.burst,
+                    self._tokens + (now - self._updated) * self.rate / 60.0)
+            self._updated = now
+            self._tokens -= 1
+            wait = max(-self._tokens * 60.0 / self.rate, 0.0)
+            self.waited += wait
+            return wait
+
+    def cancel(self, wait):
+        "Give back the token of a request which `reserve` gave `wait`."
+        with self._lock:
+            self.requests -= 1
+            if self.rate:
+                self._tokens += 1
+                self.waited -= wait
+
+    def acquire(self, deadline=None):
+        """Wait until a request may be sent and return True, or return False
+        right away if that is after `deadline`, a `time.monotonic` value."""
+        wait = self.reserve()
+        if wait and deadline is not None and (time.monotonic() + wait >
+                                              deadline):
+            self.cancel(wait)
+            return False
+        if wait:
+            with self._lock:
+                self.waiting += 1
+            try:
+                time.sleep(wait)
+            finally:
+                with self._lock:
+                    self.waiting -= 1
+        return True
+
+
+_RATE_LIMITS = {api: RateLimit() for api in APIS}
+
+# Number of departures in the latest response of every site.
+_DEPARTURES = {}
+
+
+def configure_rate_limits(site_rate=0, departure_rate=0):
+    """Limit the requests to the site and departure APIs to `site_rate` and
+    `departure_rate` per minute, see `RateLimit`."""
+    _RATE_LIMITS.update(site=RateLimit(site_rate),
+                        departure=RateLimit(departure_rate))
+
+
+def rate_limit(api):
+    "Return the `RateLimit` of `api`, which is one of `APIS`."
+    return _RATE_LIMITS[api]
+
+
+def record_departures(site_id, response):
+    "Record the number of departures of any traffic type in `response`."
+    response_data = response.get('ResponseData') if isinstance(
+        response, dict) else None
+    if isinstance(response_data, dict):
+        _DEPARTURES[site_id] = sum(
+            len(departures) for departures in response_data.values()
+            if isinstance(departures, list))
+
+
+def departures(site_id):
+    """Return the number of departures in the latest response of `site_id`,
+    or None if it has not been fetched."""
+    return _DEPARTURES.get(site_id)
+
+
+class Scheduler:
+    """Schedule of the polls of `rows`, every `interval` seconds.
+
+    The first polls are spread evenly over the interval. Rows of sites with
+    fewer than `quiet_departures` departures are polled less often, down to
+    every `max_interval` seconds for sites without departures."""
+
+    def __init__(self,
+                 rows,
+                 interval,
+                 max_interval=None,
+                 quiet_departures=10,
+                 now=None):
+        if now is None:
+            now = time.monotonic()
+        self.rows = rows
+        self.interval = interval
+        self.max_interval = max(max_interval or interval, interval)
+        self.quiet_departures = quiet_departures
+        self.intervals = [interval] * len(rows)
+        self._queue = [(now + index * interval / max(len(rows), 1), index)
+                       for index in range(len(rows))]
+        heapq.heapify(self._queue)
+        self._running = []
+        self._lock = threading.Lock()
+
+    def row_interval(self, row):
+        "Return the interval of `row`, from the departures of its site."
+        count = departures(row['site_id'])
+        if count is None or count >= self.quiet_departures:
+            return self.interval
+        return self.interval + ((self.max_interval - self.interval) *
+                                (self.quiet_departures - count) /
+                                self.quiet_departures)
+
+    def due(self, now=None):
+        """Return the rows which are due to be polled at `now`, which are
+        rescheduled by `done` once they have been polled."""
+        if now is None:
+            now = time.monotonic()
+        rows = []
+        with self._lock:
+            while self._queue and self._queue[0][0] <= now:
+                due, index = heapq.heappop(self._queue)
+                self._running.append((due, index))
+                rows.append(self.rows[index])
+        return rows
+
+    def done(self, now=None):
+        """Reschedule the rows returned by `due`, one interval after they were
+        due, or at `now` if they are already late for that."""
+        if now is None:
+            now = time.monotonic()
+        with self._lock:
+            for due, index in self._running:
+                self.intervals[index] = self.row_interval(self.rows[index])
+                heapq.heappush(self._queue,
+                               (max(due + self.intervals[index], now), index))
+            self._running = []
+
+    def wait(self, now=None):
+        "Return the seconds until the next row is due."
+        if now is None:
+            now = time.monotonic()
+        with self._lock:
+            return max(self._queue[0][0] - now, 0) if self._queue else None
+
+    def queue_depth(self, now=None):
+        "Return the number of rows which are due but not being polled."
+        if now is None:
+            now = time.monotonic()
+        with self._lock:
+            return sum(1 for due, _index in self._queue if due <= now)
@@ -0,0 +1,166 @@
+"""Lightweight HTTP backend using only `http.client`, see `transport`.
+
+It starts much faster than the requests backend, which matters for single
+checks, where the time to start the interpreter and import the modules
+dominates. Connections are kept alive per thread and host, and responses are
+requested gzip compressed, like the requests backend does."""
+
+import gzip
+import http.client
+import json
+import socket
+import threading
+import time
+from urllib.parse import urlsplit
+import zlib
+
+from check_sl_delay import transport
+
+
+class StdlibResponse:
+    """The parts of a `requests.Response` used by the plugin. The body is
+    decompressed, and `downloaded_bytes` is its size before that."""
+
+    def __init__(self, status_code, content, headers=None,
+                 downloaded_bytes=None):
+        self.status_code = status_code
+        self.headers = {} if headers is None else headers
+        self.downloaded_bytes = (len(content) if downloaded_bytes is None
+                                 else downloaded_bytes)
+        if self.headers.get('Content-Encoding') == 'gzip':
+            try:
+                content = gzip.decompress(content)
+            except (OSError, EOFError, zlib.error) as exception:
+                raise ConnectionError('Could not decompress the response: ' +
+                                      str(exception)) from exception
+        self.content = content
+
+    @property
+    def text(self):
+        "The body decoded as UTF-8."
+        return self.content.decode('utf-8', 'replace')
+
+    def json(self):
+        "Return the body decoded as JSON."
+        return json.loads(self.content)
+
+
+def read_body(response, sock, timeout=None):
+    """Return the body of `response` read from `sock` in chunks, giving up at
+    the deadline of the request, see `transport.time_left`."""
+    chunks = []
+    while True:
+        sock.settimeout(transport.time_left(timeout))
+        chunk = response.read1(transport.CHUNK_SIZE)
+        if not chunk:
+            # Also closes empty responses, to reuse the connection.
+            chunks.append(response.read())
+            return b''.join(chunks)
+        chunks.append(chunk)
+
+
+class StdlibSession:
+    """Session sending GET requests with `http.client`, retrying failed
+    requests up to `retries` times with an exponential backoff of
+    `backoff_factor` seconds, like the requests backend."""
+
+    def __init__(self, retries=0, backoff_factor=0.5):
+        self.retries = retries
+        self.backoff_factor = backoff_factor
+        self._local = threading.local()
+
+    def _connections(self):
+        "Return the kept alive connections of the current thread."
+        if not hasattr(self._local, 'connections'):
+            self._local.connections = {}
+        return self._local.connections
+
+    def _connect(self, scheme, netloc, timeout):
+        "Return a connection to `netloc`, reusing a kept alive one if any."
+        connections = self._connections()
+        connection = connections.get((scheme, netloc))
+        if connection is not None and connection.sock is not None:
+            connection.sock.settimeout(timeout)
+            return connection
+
+        if scheme == 'https':
+            connection = http.client.HTTPSConnection(netloc, timeout=timeout)
+        else:
+            connection = http.client.HTTPConnection(netloc, timeout=timeout)
+        # Resolve the host within the timeout too.
+        # pylint: disable=protected-access
+        connection._create_connection = transport.create_connection
+        start = time.perf_counter()
+        try:
+            connection.connect()
+        finally:
+            transport.add_connect_time(start)
+        connections[(scheme, netloc)] = connection
+        return connection
+
+    def _discard(self, scheme, netloc):
+        "Close and forget the connection to `netloc`."
+        connection = self._connections().pop((scheme, netloc), None)
+        if connection is not None:
+            connection.close()
+
+    def _backoff(self, attempt):
+        """Wait before retry number `attempt`, but not past the deadline of
+        the request."""
+        time.sleep(transport.time_left(self.backoff_factor * 2**(attempt - 1)))
+
+    def get(self, url, timeout=None, headers=None):
+        """Send a GET request for `url` with the extra `headers` and return a
+        `StdlibResponse`. The `timeout` applies to connecting and to every
+        read, and the request is given up at its deadline, see
+        `transport.timed_get`. Raises OSError, like `socket.timeout`, if the
+        request fails."""
+        parts = urlsplit(url)
+        path = (parts.path or '/') + ('?' + parts.query if parts.query else '')
+        request_headers = {'Accept-Encoding': 'gzip'}
+        request_headers.update(headers or {})
+        attempt = 0
+
+        while True:
+            reused = (parts.scheme, parts.netloc) in self._connections()
+            try:
+                connection = self._connect(parts.scheme, parts.netloc,
+                                           transport.time_left(timeout))
+                connection.request('GET', path, headers=request_headers)
+                # The connection forgets its socket if the server closes it.
+                sock = connection.sock
+                response = connection.getresponse()
+                content = read_body(response, sock, timeout)
+            except (OSError, http.client.HTTPException) as exception:
+                self._discard(parts.scheme, parts.netloc)
+                # The server may have closed a kept alive connection, which is
+                # retried once on a new connection.
+                if reused and not isinstance(exception, socket.timeout):
+                    continue
+                if attempt < self.retries and not transport.deadline_reached():
+                    attempt += 1
+                    self._backoff(attempt)
+                    continue
+                if isinstance(exception, OSError):
+                    raise
+                raise ConnectionError(str(exception)) from exception
+
+            if response.will_close:
+                self._discard(parts.scheme, parts.netloc)
+            if (response.status in transport.RETRY_STATUSES
+                    and attempt < self.retries
+                    and not transport.deadline_reached()):
+                attempt += 1
+                self._backoff(attempt)
+                continue
+            return StdlibResponse(response.status, content, response.headers)
+
+    def close(self):
+        "Close the kept alive connections of the current thread."
+        for scheme, netloc in list(self._connections()):
+            self._discard(scheme, netloc)
+
+
+def create_session(retries=0, backoff_factor=0.5):
+    "Create a `StdlibSession`."
+    return StdlibSession(retries, backoff_factor)
@@ -0,0 +1,280 @@
+"""HTTP transport for the SL APIs, reusing connections between requests.
+
+Two backends are available: 'requests', which uses a pooled
+`requests.Session`, and 'stdlib', which only uses `http.client` and starts
+faster. The backends are imported when the first session is created, so that
+importing this module stays cheap."""
+
+import re
+import socket
+import sys
+import threading
+import time
+
+# The available backends, the first one being the default.
+BACKENDS = ['requests', 'stdlib']
+
+# Statuses worth retrying, since they are usually temporary.
+RETRY_STATUSES = (429, 500, 502, 503, 504)
+
+# Size of the chunks which the bodies of responses are read in, checking the
+# deadline of the request between them.
+CHUNK_SIZE = 16 * 1024
+
+# Time spent connecting, including the TCP and TLS handshakes, by the
+# requests of the current thread.
+_TIMINGS = threading.local()
+
+# The deadline of the request of the current thread, see `timed_get`.
+_DEADLINE = threading.local()
+
+_SESSION = None
+_SETTINGS = {}
+_SESSION_LOCK = threading.Lock()
+
+# The lookups of host names in progress, keyed by the host and port, see
+# `resolve`.
+_LOOKUPS = {}
+_LOOKUPS_LOCK = threading.Lock()
+
+
+class RequestTimeout(Exception):
+    "Raised by `timed_get` when a request times out."
+
+
+class RequestError(Exception):
+    "Raised by `timed_get` when there is a problem with the connection."
+
+
+def add_connect_time(start):
+    "Add the time since `start` to the connect time of the current thread."
+    _TIMINGS.connect = (getattr(_TIMINGS, 'connect', 0.0) +
+                        time.perf_counter() - start)
+
+
+def deadline_reached():
+    "Return True if the deadline of the request of the current thread passed."
+    deadline = getattr(_DEADLINE, 'value', None)
+    return deadline is not None and time.monotonic() >= deadline
+
+
+def time_left(timeout=None):
+    """Return `timeout`, like the timeout of the next read of a body, limited
+    to the time left until the deadline of the request of the current thread.
+    Raises `socket.timeout` if the deadline has been reached."""
+    deadline = getattr(_DEADLINE, 'value', None)
+    if deadline is None:
+        return timeout
+    remaining = deadline - time.monotonic()
+    if remaining <= 0:
+        raise socket.timeout('Deadline of the request reached')
+    if timeout is None:
+        return remaining
+    return min(timeout, remaining)
+
+
+def resolve(host, port, timeout=None):
+    """Return the addresses of `host` to connect to `port` at, like
+    `socket.getaddrinfo`. The resolver of the system is not bound by any
+    socket timeout, so it is run in a separate thread, and `socket.timeout`
+    is raised if it does not answer within `timeout` seconds.
+
+    A lookup which can not be cancelled is left running, but there is at most
+    one lookup of the same host and port at a time, which every request
+    waiting for it shares, so a hanging resolver does not pile up threads."""
+    try:
+        return socket.getaddrinfo(host, port, 0, socket.SOCK_STREAM, 0,
+                                  socket.AI_NUMERICHOST)
+    except socket.gaierror:
+        pass
+    if not isinstance(timeout, (int, float)):
+        return socket.getaddrinfo(host, port, 0, socket.SOCK_STREAM)
+
+    with _LOOKUPS_LOCK:
+        result = _LOOKUPS.get((host, port))
+        started = result is None
+        if started:
+            result = _LOOKUPS[(host, port)] = {'done': threading.Event()}
+    if started:
+        # A daemon thread, since a hanging resolver can not be cancelled.
+        threading.Thread(target=lookup, args=(host, port, result),
+                         daemon=True).start()
+    if not result['done'].wait(timeout):
+        raise socket.timeout('Resolving ' + host + ' timed out')
+    if 'error' in result:
+        raise result['error']
+    return result['addresses']
+
+
+def lookup(host, port, result):
+    """Store the addresses of `host` to connect to `port` at, or the error
+    of looking them up, in the `result` of `resolve`, and mark it as done."""
+    try:
+        result['addresses'] = socket.getaddrinfo(host, port, 0,
+                                                 socket.SOCK_STREAM)
+    except OSError as exception:
+        result['error'] = exception
+    finally:
+        with _LOOKUPS_LOCK:
+            del _LOOKUPS[(host, port)]
+        result['done'].set()
+
+
+def create_connection(address, timeout=None, source_address=None):
+    """Connect to `address`, a tuple of a host and a port, like
+    `socket.create_connection`, but resolving the host with `resolve`."""
+    host, port = address
+    error = None
+    for address_info in resolve(host, port, timeout):
+        try:
+            return socket.create_connection(address_info[4][:2], timeout,
+                                            source_address)
+        except OSError as exception:
+            error = exception
+    raise error
+
+
+def create_session(pool_size=10,
+                   retries=0,
+                   backoff_factor=0.5,
+                   backend='requests'):
+    """Create a session of `backend`, keeping up to `pool_size` connections
+    per host alive, and retrying failed requests up to `retries` times with an
+    exponential backoff of `backoff_factor` seconds. The 'stdlib' backend
+    keeps one connection per host and thread alive, regardless of
+    `pool_size`."""
+    # Imported here, to only import the backend which is used.
+    # pylint: disable=import-outside-toplevel,cyclic-import
+    if backend == 'stdlib':
+        from check_sl_delay import stdlib_backend
+        return stdlib_backend.create_session(retries, backoff_factor)
+    from check_sl_delay import requests_backend
+    return requests_backend.create_session(pool_size, retries, backoff_factor)
+
+
+def configure_session(pool_size=10,
+                      retries=0,
+                      backoff_factor=0.5,
+                      backend='requests'):
+    """Configure the session shared by all requests, see `create_session`.
+    The session is created when it is first used."""
+    global _SESSION  # pylint: disable=global-statement
+    with _SESSION_LOCK:
+        if _SESSION is not None:
+            _SESSION.close()
+        _SESSION = None
+        _SETTINGS.update(pool_size=pool_size,
+                         retries=retries,
+                         backoff_factor=backoff_factor,
+                         backend=backend)
+
+
+def get_session():
+    "Return the session shared by all requests, creating it if needed."
+    global _SESSION  # pylint: disable=global-statement
+    with _SESSION_LOCK:
+        if _SESSION is None:
+            _SESSION = create_session(**_SETTINGS)
+        return _SESSION
+
+
+def is_timeout(exception):
+    "Return True if `exception` from a backend means that a request timed out."
+    if isinstance(exception, socket.timeout):
+        return True
+
+    # Only check for the exceptions of requests if it has been imported.
+    requests = sys.modules.get('requests')
+    if requests is None:
+        return False
+    if isinstance(exception, requests.exceptions.Timeout):
+        return True
+
+    # When the retries of reads are exhausted, requests raises a
+    # ConnectionError even if the last attempt timed out, with the reason in
+    # the MaxRetryError.
+    # The timeouts of reading streamed bodies are wrapped directly.
+    cause = exception.args[0] if exception.args else None
+    return isinstance(getattr(cause, 'reason', cause),
+                      sys.modules['urllib3'].exceptions.ReadTimeoutError)
+
+
+# The description of the connection pools and connections of urllib3, like
+# "HTTPConnectionPool(host='api.sl.se', port=443): ", in their errors.
+CONNECTION_PREFIX = re.compile(r'\w+\(host=[^)]*\): ')
+
+
+def error_message(exception):
+    """Return the message of the request `exception`, without the URL and the
+    internal classes of urllib3 which requests wraps around the cause."""
+    # requests wraps a MaxRetryError of urllib3, which wraps the cause.
+    reason = getattr(exception.args[0] if exception.args else None, 'reason',
+                     None)
+    if isinstance(reason, BaseException):
+        exception = reason
+    return CONNECTION_PREFIX.sub('', str(exception))
+
+
+def downloaded_bytes(response):
+    """Return the size of the body of `response` as downloaded, before it was
+    decompressed, or the size of the body if that is not known."""
+    # The raw response of requests knows how much was read from the wire.
+    raw = getattr(response, 'raw', None)
+    if hasattr(raw, 'tell'):
+        return raw.tell()
+    return getattr(response, 'downloaded_bytes', len(response.content))
+
+
+def timed_get(url, timeout=None, session=None, headers=None, deadline=None):
+    """Send a GET request for `url` with the extra `headers` using `session`,
+    or the shared session, and return the response together with a
+    dictionary of timings in seconds: `connect` is the time spent on
+    handshakes for new connections, which is 0 when a kept alive connection
+    is reused, and `transfer` is the rest. The dictionary also holds the
+    `bytes` downloaded, see `downloaded_bytes`.
+
+    `timeout` applies to connecting and to every read, and the request,
+    including its retries, is given up at `deadline`, a `time.monotonic`
+    value, however slowly the response arrives.
+
+    Raises `RequestTimeout` or `RequestError` if the request fails."""
+    if session is None:
+        session = get_session()
+
+    _TIMINGS.connect = 0.0
+    _DEADLINE.value = deadline
+    start = time.perf_counter()
+    try:
+        if headers:
+            response = session.get(url, timeout=timeout, headers=headers)
+        else:
+            response = session.get(url, timeout=timeout)
+    # The exceptions of requests are also subclasses of OSError.
+    except OSError as exception:
+        if is_timeout(exception):
+            raise RequestTimeout(error_message(exception)) from exception
+        raise RequestError(error_message(exception)) from exception
+    finally:
+        _DEADLINE.value = None
+    total = time.perf_counter() - start
+    connect = min(_TIMINGS.connect, total)
+
+    return response, {
+        'connect': connect,
+        'transfer': total - connect,
+        'bytes': downloaded_bytes(response)
+    }
+
+
+def format_timings(timings):
+    "Format the `timings` from `timed_get` for the verbose output."
+    if timings['connect']:
+        connection = ('new connection, handshake ' +
+                      str(round(timings['connect'], 3)) + 's')
+    else:
+        connection = 'reused connection'
+    text = (connection + ', transfer ' + str(round(timings['transfer'], 3)) +
+            's')
+    if 'bytes' in timings:
+        text += ', ' + str(timings['bytes']) + ' bytes'
+    return text
@@ -12,9 +12,13 @@ with open('HISTORY.md') as history_file:
 REQUIREMENTS = [
     'requests>=2.23',
     'Click>=7.1',
-    'func-timeout>=4.3',
 ]
 
+EXTRA_REQUIREMENTS = {
+    'async': ['aiohttp>=3.6'],
+    'fast': ['orjson>=3'],
+}
+
 SETUP_REQUIREMENTS = [
     'pytest-runner',
 ]
@@ -28,6 +32,7 @@ TEST_REQUIREMENTS = [
     'pytest-pylint',
     'flaky',
     'python-dotenv',
+    'aiohttp>=3.6',
 ]
 
 setup(
@@ -48,8 +53,11 @@ setup(
     entry_points='''
         [console_scripts]
         check_sl_delay=check_sl_delay.check_sl_delay:cli
+        check_sl_delay_client=check_sl_delay.client:main
+        check_sl_delay_fakeapi=check_sl_delay.fakeapi:main
     ''',
     install_requires=REQUIREMENTS,
+    extras_require=EXTRA_REQUIREMENTS,
     license="ISC license",
     long_description_content_type="text/markdown",
     long_description=README + '\n\n' + HISTORY,
@@ -0,0 +1,22 @@
+"""Fixtures shared by the tests of `check_sl_delay`."""
+
+import pytest
+
+from check_sl_delay import check_sl_delay, fakeapi
+
+
+@pytest.fixture
+def fake_api(monkeypatch):
+    "A local stand-in for the SL APIs, which the plugin is pointed at."
+    server = fakeapi.start_server(
+        {'': fakeapi.generate_response(300)},
+        sites={
+            '1002': 'Centralen',
+            '9192': 'Slussen  '
+        })
+    site_url, departure_url = fakeapi.api_urls(server.base_url)
+    monkeypatch.setattr(check_sl_delay, 'SITE_API_URL', site_url)
+    monkeypatch.setattr(check_sl_delay, 'DEPARTURE_API_URL', departure_url)
+    yield server
+    server.shutdown()
+    server.server_close()
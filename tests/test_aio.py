@@ -0,0 +1,190 @@
+#!/usr/bin/env python
+# pylint: disable=redefined-outer-name
+"""Tests for the asyncio engine of `check_sl_delay`."""
+
+import pytest
+
+from check_sl_delay import check_sl_delay, fakeapi
+
+aio = pytest.importorskip('check_sl_delay.aio')
+pytest.importorskip('aiohttp')
+
+API_KEY = '0' * 32
+
+
+@pytest.fixture
+def rows():
+    "Rows of a sites file, with a mix of valid and invalid sites."
+    return [{
+        'site_id': site_id,
+        'traffic_type': traffic_type,
+        'minutes': minutes,
+        'warning': 10,
+        'critical': 50,
+        'service': ''
+    } for site_id in (1002, 9192, 100) for traffic_type in ('BUS', 'METRO')
+            for minutes in (0, 1, 5)]
+
+
+@pytest.mark.usefixtures('fake_api')
+def test_engines_give_identical_results(rows):
+    "Test that the async engine gives the same results as the threads engine."
+    threads = check_sl_delay.run_checks(API_KEY,
+                                        API_KEY,
+                                        60,
+                                        rows,
+                                        5,
+                                        workers=4,
+                                        engine='threads')
+    async_ = check_sl_delay.run_checks(API_KEY,
+                                       API_KEY,
+                                       60,
+                                       rows,
+                                       5,
+                                       workers=4,
+                                       engine='async')
+
+    assert async_ == threads
+    assert async_[0][1].startswith('CRITICAL: ')
+    assert async_[-1] == (3, 'UNKNOWN: Invalid site id: 100')
+
+
+@pytest.mark.parametrize('engine', ['threads', 'async'])
+def test_failing_rows(fake_api, rows, monkeypatch, engine):
+    """Test that rows with an error from the API, or which raise an unexpected
+    exception, are UNKNOWN without affecting the other rows."""
+    fake_api.departures['9192'] = {
+        'StatusCode': 1006,
+        'Message': 'Too many requests per month',
+        'ResponseData': None
+    }
+    evaluate_check = check_sl_delay.evaluate_check
+
+    def evaluate_or_fail(*args):
+        if args[3] == 5:
+            raise TypeError('Unexpected')
+        evaluate_check(*args)
+
+    monkeypatch.setattr(check_sl_delay, 'evaluate_check', evaluate_or_fail)
+    results = check_sl_delay.run_checks(API_KEY,
+                                        API_KEY,
+                                        60,
+                                        rows[:12],
+                                        5,
+                                        workers=4,
+                                        engine=engine)
+    assert [state for state, _ in results] == [2, 1, 3, 2, 1, 3] + [3] * 6
+    assert results[2] == (3,
+                          "UNKNOWN: Unexpected error: TypeError('Unexpected')")
+    assert results[6:] == [
+        (3, 'UNKNOWN: SL API error 1006: Too many requests per month')
+    ] * 6
+
+
+@pytest.mark.usefixtures('fake_api')
+def test_stage_timings(rows):
+    "Test that the async engine times the same stages, except connections."
+    rows[0]['stage_timings'] = True
+    output = aio.run_checks(API_KEY, API_KEY, 60, rows[:2], 5, 4)[0][1]
+    labels = [
+        metric.split('=')[0]
+        for metric in output.split('|')[1].split()[2:]
+    ]
+    assert labels == ['site_time', 'api_time', 'decode_time', 'evaluate_time']
+
+
+def test_departures_are_shared(fake_api, rows, tmp_path):
+    """Test that the departures of a site are only fetched once per batch,
+    and that they are shared between batches using the response cache."""
+    response_cache = check_sl_delay.ResponseCache(str(tmp_path), 60)
+    departure_path = fakeapi.api_urls('')[1]
+
+    results = aio.run_checks(API_KEY, API_KEY, 60, rows[:12], 5, 4)
+    assert fake_api.requests[departure_path] == 2
+    assert aio.run_checks(API_KEY,
+                          API_KEY,
+                          60,
+                          rows[:12],
+                          5,
+                          4,
+                          response_cache=response_cache) == [
+                              (state, output + ' response_cache_hit=0')
+                              for state, output in results
+                          ]
+    assert fake_api.requests[departure_path] == 4
+
+    cached_results = aio.run_checks(API_KEY,
+                                    API_KEY,
+                                    60,
+                                    rows[:12],
+                                    5,
+                                    4,
+                                    response_cache=response_cache)
+    assert fake_api.requests[departure_path] == 4
+    assert cached_results == [(state, output + ' response_cache_hit=1')
+                              for state, output in results]
+
+
+def test_revalidation(fake_api, rows, tmp_path):
+    "Test that stale responses are revalidated when the API sends ETags."
+    fake_api.etags = True
+    # Every response is stale right away.
+    response_cache = check_sl_delay.ResponseCache(str(tmp_path), 0)
+    departure_path = fakeapi.api_urls('')[1]
+    rows = [dict(row, transfer_stats=True) for row in rows[:6]]
+
+    results = aio.run_checks(API_KEY,
+                             API_KEY,
+                             60,
+                             rows,
+                             5,
+                             4,
+                             response_cache=response_cache)
+    assert 'response_bytes=' in results[0][1]
+    assert list(response_cache.stale(1002, 60)[1]) == ['etag']
+
+    revalidated = aio.run_checks(API_KEY,
+                                 API_KEY,
+                                 60,
+                                 rows,
+                                 5,
+                                 4,
+                                 response_cache=response_cache)
+    assert fake_api.requests[departure_path] == 2
+    # Not modified, so nothing was downloaded or decoded.
+    assert 'response_bytes=' not in revalidated[0][1]
+    assert [output.split('|')[0] for _, output in revalidated
+            ] == [output.split('|')[0] for _, output in results]
+
+
+def test_timeout(fake_api, rows):
+    "Test that checks slower than the timeout are reported as UNKNOWN."
+    fake_api.latency = 0.5
+    assert aio.run_checks(API_KEY, API_KEY, 60, rows[:2], 0.1, 2) == [
+        (3, 'UNKNOWN: Timeout reached after 0.1 seconds')
+    ] * 2
+
+
+def test_request_timeout(fake_api, rows):
+    "Test that requests slower than the request timeout are reported."
+    fake_api.latency = 0.5
+    assert aio.run_checks(API_KEY,
+                          API_KEY,
+                          60,
+                          rows[:1],
+                          5,
+                          request_timeout=0.1) == [
+                              (3, 'UNKNOWN: HTTP request timed out: ' +
+                               'No response within 0.1 seconds')
+                          ]
+
+
+def test_connection_error(monkeypatch, rows):
+    "Test that connection errors are reported as UNKNOWN."
+    monkeypatch.setattr(check_sl_delay, 'SITE_API_URL',
+                        'http://127.0.0.1:1/api2/typeahead.json/')
+    ((state, output), ) = aio.run_checks(API_KEY, API_KEY, 60, rows[:1], 5)
+
+    assert state == 3
+    assert output.startswith(
+        'UNKNOWN: Encountered an exception during HTTP request: ')
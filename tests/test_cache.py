@@ -0,0 +1,196 @@
+#!/usr/bin/env python
+"""Tests for the caches of `check_sl_delay`."""
+
+import asyncio
+import os
+import threading
+import time
+
+from check_sl_delay import cache
+
+
+def test_default_cache_dir(monkeypatch):
+    "Test that the default cache dir follows XDG_CACHE_HOME."
+    monkeypatch.setenv('XDG_CACHE_HOME', '/var/cache/nagios')
+    assert cache.default_cache_dir() == '/var/cache/nagios/check_sl_delay'
+
+    monkeypatch.delenv('XDG_CACHE_HOME')
+    monkeypatch.setenv('HOME', '/home/nagios')
+    assert cache.default_cache_dir() == '/home/nagios/.cache/check_sl_delay'
+
+
+def test_site_cache(tmp_path):
+    "Test that site names are shared between instances of the cache."
+    site_cache = cache.SiteCache(str(tmp_path / 'cache'), 3600)
+
+    assert site_cache.get(1002) is None
+    site_cache.put(1002, 'Centralen')
+    assert site_cache.get(1002) == 'Centralen'
+    assert site_cache.stats() == (
+        'Site cache: 1 hits, 1 misses, 1 entries in ' +
+        os.path.join(str(tmp_path), 'cache', 'sites.json'))
+
+    other_cache = cache.SiteCache(str(tmp_path / 'cache'), 3600)
+    other_cache.put(9192, 'Slussen')
+    assert other_cache.get(1002) == 'Centralen'
+
+    # Entries added by others are kept when writing.
+    site_cache.put(9001, 'Liljeholmen')
+    assert cache.SiteCache(str(tmp_path / 'cache'),
+                           3600).stats().endswith(' 3 entries in ' +
+                                                  site_cache.path)
+
+
+def test_site_cache_ttl(tmp_path, monkeypatch):
+    "Test that expired site names are not used."
+    site_cache = cache.SiteCache(str(tmp_path), 60)
+    monkeypatch.setattr(cache.time, 'time', lambda: 1000.0)
+    site_cache.put(1002, 'Centralen')
+
+    monkeypatch.setattr(cache.time, 'time', lambda: 1059.0)
+    assert site_cache.get(1002) == 'Centralen'
+    monkeypatch.setattr(cache.time, 'time', lambda: 1060.0)
+    assert site_cache.get(1002) is None
+
+
+def test_site_cache_invalid_file(tmp_path):
+    "Test that a broken cache file is treated as an empty cache."
+    (tmp_path / 'sites.json').write_text('{"1002": "Centra')
+    site_cache = cache.SiteCache(str(tmp_path), 60)
+
+    assert site_cache.get(1002) is None
+    site_cache.put(1002, 'Centralen')
+    assert cache.SiteCache(str(tmp_path), 60).get(1002) == 'Centralen'
+
+
+def test_site_cache_unwritable(tmp_path):
+    "Test that a cache dir which cannot be written to is ignored."
+    (tmp_path / 'file').write_text('')
+    site_cache = cache.SiteCache(str(tmp_path / 'file'), 60)
+
+    site_cache.put(1002, 'Centralen')
+    assert site_cache.get(1002) == 'Centralen'
+
+
+def test_response_cache(tmp_path, monkeypatch):
+    "Test that responses are cached per site and time window for `ttl`."
+    response_cache = cache.ResponseCache(str(tmp_path), 30)
+    monkeypatch.setattr(cache.time, 'time', lambda: 1000.0)
+
+    assert response_cache.get(1002, 10) is None
+    response_cache.put(1002, 10, {'ResponseData': {}})
+    assert response_cache.get(1002, 10) == {'ResponseData': {}}
+    assert response_cache.get(1002, 20) is None
+    assert response_cache.get(9192, 10) is None
+
+    monkeypatch.setattr(cache.time, 'time', lambda: 1030.0)
+    assert response_cache.get(1002, 10) is None
+    assert response_cache.stats() == ('Response cache: 1 hits, 4 misses in ' +
+                                      os.path.join(str(tmp_path),
+                                                   'departures'))
+
+
+def test_response_cache_get_or_fetch(tmp_path):
+    "Test that concurrent fetches of the same response only fetch once."
+    response_cache = cache.ResponseCache(str(tmp_path), 30)
+    fetched = []
+    results = []
+
+    def fetch():
+        fetched.append(1)
+        time.sleep(0.2)
+        return {'ResponseData': {'Buses': []}}
+
+    def get_or_fetch():
+        # Each thread has its own cache, like separate processes would.
+        results.append(
+            cache.ResponseCache(str(tmp_path), 30).get_or_fetch(1002, 10,
+                                                                fetch))
+
+    threads = [threading.Thread(target=get_or_fetch) for _ in range(5)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert len(fetched) == 1
+    assert sorted(hit for _, hit in results) == [False, True, True, True, True]
+    assert response_cache.get_or_fetch(1002, 10, fetch) == ({
+        'ResponseData': {
+            'Buses': []
+        }
+    }, True)
+    assert response_cache.get_or_fetch(1002, 20, fetch)[1] is False
+    assert len(fetched) == 2
+
+
+def test_response_cache_get_or_fetch_async(tmp_path):
+    """Test that an asynchronous fetch waits for a concurrent fetch of the
+    same response without blocking the event loop."""
+    fetched = []
+
+    def fetch():
+        fetched.append(1)
+        time.sleep(0.2)
+        return {'ResponseData': {'Buses': []}}
+
+    async def fetch_async():
+        fetched.append(1)
+        return {'ResponseData': {}}
+
+    async def tick(ticks):
+        while True:
+            ticks.append(1)
+            await asyncio.sleep(0.01)
+
+    async def get_or_fetch():
+        ticks = []
+        ticker = asyncio.ensure_future(tick(ticks))
+        result = await cache.ResponseCache(str(tmp_path),
+                                           30).get_or_fetch_async(
+                                               1002, 10, fetch_async)
+        ticker.cancel()
+        return result, len(ticks)
+
+    # Another process, fetching the same response first.
+    response_cache = cache.ResponseCache(str(tmp_path), 30)
+    thread = threading.Thread(target=response_cache.get_or_fetch,
+                              args=(1002, 10, fetch))
+    thread.start()
+    time.sleep(0.05)
+    (response, hit), ticks = asyncio.run(get_or_fetch())
+    thread.join()
+
+    assert (response, hit) == ({'ResponseData': {'Buses': []}}, True)
+    assert len(fetched) == 1
+    assert ticks > 5
+
+
+def test_response_cache_revalidate(tmp_path, monkeypatch):
+    """Test that a hit reads the cache once, and that a miss passes the stale
+    response and its validators to the fetch."""
+    response_cache = cache.ResponseCache(str(tmp_path), 30)
+    response_cache.put(1002, 10, {'ResponseData': {}}, {'etag': '"1"'})
+    reads = []
+    read_json = cache.read_json
+    monkeypatch.setattr(cache, 'read_json',
+                        lambda path: reads.append(path) or read_json(path))
+    fetched = []
+
+    def fetch(stale_response, validators):
+        fetched.append((stale_response, dict(validators)))
+        validators['etag'] = '"2"'
+        return {'ResponseData': {'Buses': []}}
+
+    assert response_cache.get_or_fetch(1002, 10, fetch, True)[1] is True
+    assert len(reads) == 1 and not fetched
+
+    later = time.time() + 60
+    monkeypatch.setattr(cache.time, 'time', lambda: later)
+    assert response_cache.get_or_fetch(1002, 10, fetch, True) == ({
+        'ResponseData': {
+            'Buses': []
+        }
+    }, False)
+    assert fetched == [({'ResponseData': {}}, {'etag': '"1"'})]
+    assert response_cache.stale(1002, 10)[1] == {'etag': '"2"'}
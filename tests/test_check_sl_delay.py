@@ -1,17 +1,21 @@
 #!/usr/bin/env python
-# pylint: disable=redefined-outer-name
+# pylint: disable=redefined-outer-name,too-many-lines
 """Tests for `check_sl_delay` package."""
 
 from datetime import datetime
+import io
 import json
 import os
+import threading
 import pytest
 import click
+import requests
 
 from dotenv import load_dotenv
 from flaky import flaky
 
-from check_sl_delay import check_sl_delay
+from check_sl_delay import check_sl_delay, fakeapi, transport
+from check_sl_delay.history import DelayHistory
 
 load_dotenv()
 SITE_API_KEY = os.getenv('SITE_API_KEY')
@@ -416,6 +420,31 @@ def test_structure_departure(departure_example):
     }
 
 
+def test_parse_datetime():
+    "Test that timestamps are parsed like by datetime.strptime."
+    func = check_sl_delay.parse_datetime
+
+    assert func('2020-03-19T13:21:00') == datetime(2020, 3, 19, 13, 21)
+    assert func('1999-12-31T23:59:59') == datetime(1999, 12, 31, 23, 59, 59)
+    # Unexpected formats are handled by datetime.strptime.
+    assert func('2020-3-19T13:21:00') == datetime(2020, 3, 19, 13, 21)
+    for invalid in ('2020-02-30T13:21:00', '2020-03-19 13:21:00',
+                    '2020-03-19T13:21:00.000', '+020-03-19T13:21:00', ''):
+        with pytest.raises(ValueError):
+            func(invalid)
+
+
+def test_parse_fixed_format():
+    "Test the parser used by Python versions without fromisoformat."
+    func = check_sl_delay.parse_fixed_format
+
+    assert func('2020-03-19T13:21:00') == datetime(2020, 3, 19, 13, 21)
+    for invalid in ('2020-02-30T13:21:00', '+020-03-19T13:21:00',
+                    '2020-03-19T13:2 :00'):
+        with pytest.raises(ValueError):
+            func(invalid)
+
+
 def test_extract_departures(response, traffic_types):
     "Test that departures are correctly handled when iterated over."
     func = check_sl_delay.extract_departures
@@ -499,6 +528,201 @@ def test_calculate_percentage_of_offenders():
     assert func([True, True, False, False]) == 50
 
 
+def test_evaluate_departures(response):
+    "Test that departures are correctly counted in a single pass."
+    func = check_sl_delay.evaluate_departures
+
+    assert func(response, 'Buses', 1) == {
+        'total': 2,
+        'offenders': 1,
+        'max_delay': 120,
+        'sum_delay': 155
+    }
+    assert func(response, 'Metros', 0)['offenders'] == 16
+    assert func(response, 'Metros', 4)['offenders'] == 1
+    assert func(response, 'Trains', 0) == {
+        'total': 3,
+        'offenders': 3,
+        'max_delay': 0,
+        'sum_delay': 0
+    }
+
+
+def test_missing_traffic_types(response):
+    "Test that traffic types which are left out or null have no departures."
+    response['ResponseData']['Ships'] = None
+    del response['ResponseData']['Trams']
+
+    for traffic_type in ('Ships', 'Trams'):
+        assert not check_sl_delay.departures_of(response, traffic_type)
+        assert check_sl_delay.evaluate_departures(response, traffic_type,
+                                                  1)['total'] == 0
+        assert not check_sl_delay.extract_departures(response, traffic_type)
+        assert not check_sl_delay.sorted_delays(response, traffic_type)
+        assert not check_sl_delay.keyed_delays(response, traffic_type)
+
+
+def test_departure_delay(response):
+    "Test that departures ahead of their schedule are not delayed."
+    departures = response['ResponseData']['Buses']
+    assert [check_sl_delay.departure_delay(departure)
+            for departure in departures] == [120, 35]
+    assert check_sl_delay.departure_delay(
+        dict(departures[0], ExpectedDateTime='2020-03-19T13:18:00')) == 0
+
+
+def test_evaluate_departures_matches_pipeline():
+    "Test that the single pass gives the same value as the list pipeline."
+    response = fakeapi.generate_response(1000, ('Buses', ))
+
+    for threshold in range(0, 22):
+        evaluation = check_sl_delay.evaluate_departures(
+            response, 'Buses', threshold)
+        diffs = check_sl_delay.diffs_from_response(response, 'Buses')
+        assert evaluation['total'] == len(diffs)
+        assert check_sl_delay.calculate_percentage(
+            evaluation['offenders'], evaluation['total']
+        ) == check_sl_delay.calculate_percentage_of_offenders(
+            check_sl_delay.compare_to_threshold(diffs, threshold))
+
+
+def test_calculate_values(traffic_types):
+    "Test that all thresholds give the same values as one at a time."
+    response = fakeapi.generate_response(1000)
+    thresholds = list(range(0, 22))
+
+    for traffic_type in traffic_types:
+        values = check_sl_delay.calculate_values(response, traffic_type,
+                                                 thresholds)
+        assert values == {
+            threshold: check_sl_delay.calculate_value(
+                response, traffic_type, threshold)
+            for threshold in thresholds
+        }
+
+
+def test_calculate_type_values(response):
+    "Test that several traffic types are combined by the policies."
+    func = check_sl_delay.calculate_type_values
+    all_types = check_sl_delay.api_traffic_types('ALL')
+
+    metrics = {}
+    assert func(response, all_types, [1, 0], 'worst', metrics=metrics) == {
+        1: 50,
+        0: 100
+    }
+    assert metrics == {
+        '\'Percentage delayed METRO\'': (6, '%'),
+        '\'Percentage delayed BUS\'': (50, '%'),
+        '\'Percentage delayed TRAIN\'': (0, '%'),
+        '\'Percentage delayed TRAM\'': (0, '%'),
+        '\'Percentage delayed SHIP\'': (0, '%')
+    }
+    assert func(response, all_types, [1, 0], 'combined') == {1: 9, 0: 100}
+    assert func(response, ['Trains', 'Trams'], [0, 1], 'worst') == {
+        0: 100,
+        1: 0
+    }
+
+
+def test_keyed_delays(response):
+    "Test that departures are identified by journey, schedule and stop."
+    departures = response['ResponseData']['Buses']
+    assert check_sl_delay.departure_key(departures[0]) == (
+        '42553/2020-03-19T13:19:00/10537')
+    assert check_sl_delay.departure_key({'JourneyNumber': 42553}) is None
+
+    # A departure listed twice is only listed once, with its last delay.
+    departures.append(dict(departures[0],
+                           ExpectedDateTime='2020-03-19T13:22:00'))
+    departures.append(dict(departures[1]))
+    del departures[-1]['JourneyNumber']
+    assert check_sl_delay.keyed_delays(response, 'Buses') == [
+        ('42553/2020-03-19T13:19:00/10537', 180),
+        ('38117/2020-03-19T13:19:00/10537', 35), (None, 35)
+    ]
+
+
+def test_percentages_from_histogram():
+    "Test that percentages are calculated from counts per minute of delay."
+    func = check_sl_delay.percentages_from_histogram
+
+    assert func({0: 6, 1: 2, 5: 2}, [0, 1, 3, 6]) == {
+        0: 100,
+        1: 40,
+        3: 20,
+        6: 0
+    }
+    assert func({}, [1]) == {1: 0}
+
+
+def test_calculate_type_values_history(response, tmp_path):
+    "Test that the values are calculated over the window of the history."
+    func = check_sl_delay.calculate_type_values
+    delay_history = DelayHistory(str(tmp_path), 1800, 3600)
+
+    metrics = {}
+    assert func(response, ['Metros', 'Buses'], [1, 0],
+                'combined',
+                metrics=metrics,
+                history=delay_history,
+                site_id=1002) == func(response, ['Metros', 'Buses'], [1, 0],
+                                      'combined')
+    assert metrics['history_departures'] == (18, '')
+
+    # The departures of a later poll of the same response are counted once.
+    func(response, ['Metros', 'Buses'], [1, 0],
+         metrics=metrics,
+         history=delay_history,
+         site_id=1002)
+    assert metrics['history_departures'] == (18, '')
+
+    # Departures which are no longer in the response are still counted.
+    metrics = {}
+    assert func({'ResponseData': {}}, ['Buses'], [1, 0],
+                metrics=metrics,
+                history=delay_history,
+                site_id=1002) == {
+                    1: 50,
+                    0: 100
+                }
+    assert metrics == {'history_departures': (2, '')}
+
+
+def test_parse_traffic_types():
+    "Test that traffic types are normalized and converted for the API."
+    func = check_sl_delay.parse_traffic_types
+
+    assert func('BUS') == 'BUS'
+    assert func('bus, Metro,BUS') == 'BUS,METRO'
+    assert func('METRO,all') == 'ALL'
+    for invalid in ('', 'PLANE', 'BUS,', 'BUSES'):
+        with pytest.raises(ValueError):
+            func(invalid)
+
+    assert check_sl_delay.api_traffic_types('BUS') == 'Buses'
+    assert check_sl_delay.api_traffic_types('BUS,METRO') == [
+        'Buses', 'Metros'
+    ]
+    assert check_sl_delay.api_traffic_types('ALL') == [
+        'Metros', 'Buses', 'Trains', 'Trams', 'Ships'
+    ]
+
+
+def test_parse_minutes():
+    "Test that single thresholds are ints and several are lists."
+    func = check_sl_delay.parse_minutes
+
+    assert func('3') == 3
+    assert func('0') == 0
+    assert func('3,1, 5') == [3, 1, 5]
+    assert func('1,1,3') == [1, 3]
+    assert func('1,1') == 1
+    for invalid in ('', '1,', 'x', '-1', '1;3', '1.5'):
+        with pytest.raises(ValueError):
+            func(invalid)
+
+
 def test_generate_perfdata_string():
     "Thest that proper perfdata strings are generated."
     func = check_sl_delay.generate_perfdata_string
@@ -526,12 +750,575 @@ def test_exit_plugin(state_var):
     assert pytest_wrapped_e.value.message == state_var
 
 
+def test_generate_metrics_string():
+    "Test that additional metrics are formatted as perfdata."
+    func = check_sl_delay.generate_metrics_string
+
+    assert func() == ''
+    assert func({}) == ''
+    assert func({
+        'response_cache_hit': (1, ''),
+        'api_time': (0.231, 's')
+    }) == ' response_cache_hit=1 api_time=0.231s'
+
+
+def test_record_metric():
+    "Test that metrics are recorded with their thresholds, if any."
+    metrics = {}
+    check_sl_delay.record_metric(metrics, 'delay_max', 120, 's')
+    check_sl_delay.record_metric(metrics, 'delay_p90', 60, 's', None, 300)
+    check_sl_delay.record_metric(None, 'delay_p99', 60, 's')
+
+    assert check_sl_delay.generate_metrics_string(metrics) == (
+        ' delay_max=120s delay_p90=60s;;300')
+
+
+def test_delay_statistics():
+    "Test that the statistics of the delays use the nearest rank."
+    func = check_sl_delay.delay_statistics
+
+    assert func(list(range(1, 101))) == {
+        'count': 100,
+        'mean': 50,
+        'max': 100,
+        'p50': 50,
+        'p90': 90,
+        'p99': 99
+    }
+    assert func([0, 0, 30, 600]) == {
+        'count': 4,
+        'mean': 157,
+        'max': 600,
+        'p50': 0,
+        'p90': 600,
+        'p99': 600
+    }
+    assert func([]) == {
+        'count': 0,
+        'mean': 0,
+        'max': 0,
+        'p50': 0,
+        'p90': 0,
+        'p99': 0
+    }
+
+
+def test_evaluate_check_statistics(response):
+    """Test that the statistics of the delays are added to the perfdata, and
+    that the 90th percentile is compared to its thresholds."""
+    with pytest.raises(click.ClickException) as pytest_wrapped_e:
+        check_sl_delay.evaluate_check('Centralen',
+                                      response,
+                                      'Buses',
+                                      1,
+                                      60,
+                                      None,
+                                      statistics=True,
+                                      p90_critical=120)
+    assert pytest_wrapped_e.value.message == '2'
+    assert pytest_wrapped_e.value.output == (
+        'CRITICAL: 50%|\'Percentage delayed\'=50%;60; delay_count=2 ' +
+        'delay_mean=77s delay_max=120s delay_p50=35s ' +
+        'delay_p90=120s;;120 delay_p99=120s')
+
+
+def test_exit_plugin_output():
+    "Test that `exit_plugin` attaches the check output to the exception."
+    with pytest.raises(click.ClickException) as pytest_wrapped_e:
+        check_sl_delay.exit_plugin(state=1,
+                                   value=50,
+                                   name='Centralen',
+                                   warning=40,
+                                   minutes=2,
+                                   verbosity=1)
+    assert pytest_wrapped_e.value.output == (
+        'WARNING: 50% of the departures at Centralen are delayed more ' +
+        'than 2 minutes|\'Percentage delayed\'=50%;40;')
+
+    with pytest.raises(click.ClickException) as pytest_wrapped_e:
+        check_sl_delay.exit_plugin(state=0,
+                                   value=0,
+                                   metrics={'response_cache_hit': (0, '')})
+    assert pytest_wrapped_e.value.output == (
+        'OK: 0%|\'Percentage delayed\'=0%;; response_cache_hit=0')
+
+    with pytest.raises(click.ClickException) as pytest_wrapped_e:
+        check_sl_delay.exit_plugin(error='Something went wrong')
+    assert pytest_wrapped_e.value.output == 'UNKNOWN: Something went wrong'
+
+
 def test_determine_state():
     "Test that the correct state is determined."
     func = check_sl_delay.determine_state
     assert func(0, warning=0) == 1
 
 
+def test_worst_state():
+    "Test that the worst state is picked when summarizing checks."
+    func = check_sl_delay.worst_state
+
+    assert func([]) == 0
+    assert func([0, 0]) == 0
+    assert func([0, 3]) == 3
+    assert func([3, 1, 0]) == 1
+    assert func([1, 2, 3]) == 2
+
+
+def test_read_sites_file():
+    "Test that a sites file is parsed into rows."
+    sites_file = io.StringIO('# site,type,minutes,warning,critical,service\n'
+                             '1002,METRO,1,20,30\n'
+                             '\n'
+                             '9001, bus ,3,,50,Slussen buses\n')
+    assert check_sl_delay.read_sites_file(sites_file) == [{
+        'site_id': 1002,
+        'traffic_type': 'METRO',
+        'minutes': 1,
+        'warning': 20,
+        'critical': 30,
+        'service': '1002 METRO 1'
+    }, {
+        'site_id': 9001,
+        'traffic_type': 'BUS',
+        'minutes': 3,
+        'warning': None,
+        'critical': 50,
+        'service': 'Slussen buses'
+    }]
+
+
+@pytest.mark.parametrize('content', [
+    '', '1002,METRO\n', '0,METRO,1\n', '1002,PLANE,1\n', '1002,METRO,x\n',
+    '1002,METRO,1,101\n', '1002,METRO,1,30,20\n', '1002,METRO,"1,x"\n'
+])
+def test_read_sites_file_invalid(content):
+    "Test that invalid sites files exit with state 4 (ERROR)."
+    with pytest.raises(click.ClickException) as pytest_wrapped_e:
+        check_sl_delay.read_sites_file(io.StringIO(content))
+    assert pytest_wrapped_e.value.message == '4'
+    assert pytest_wrapped_e.value.output.startswith('ERROR: ')
+
+
+def test_format_batch_result(monkeypatch):
+    "Test that batch results are formatted as plain or passive results."
+    row = {'service': '1002 METRO 1'}
+    func = check_sl_delay.format_batch_result
+    monkeypatch.setattr(check_sl_delay.time, 'time', lambda: 1584623501.5)
+
+    assert func(row, 0, 'OK: 0%') == '1002 METRO 1: OK: 0%'
+    assert func(row, 0, 'OK: 0%', passive_host='nagios') == (
+        '[1584623501] PROCESS_SERVICE_CHECK_RESULT;nagios;1002 METRO 1;0;' +
+        'OK: 0%')
+
+
+def test_run_batch(monkeypatch, capsys, response):
+    "Test that all rows are checked and that the worst state is returned."
+    monkeypatch.setattr(check_sl_delay, 'fetch_site',
+                        lambda *args: 'Centralen')
+    monkeypatch.setattr(check_sl_delay, 'fetch_response',
+                        lambda *args: response)
+    rows = check_sl_delay.read_sites_file(
+        io.StringIO('1002,BUS,1,20,60\n1002,TRAIN,1,20,60\n'))
+
+    with pytest.raises(click.ClickException) as pytest_wrapped_e:
+        check_sl_delay.run_batch(SITE_API_KEY, DEPARTURE_API_KEY, 10, rows,
+                                 5)
+    assert pytest_wrapped_e.value.message == '1'
+    assert capsys.readouterr().out == (
+        '1002 BUS 1: WARNING: 50%|\'Percentage delayed\'=50%;20;60\n' +
+        '1002 TRAIN 1: OK: 0%|\'Percentage delayed\'=0%;20;60\n')
+
+
+def test_run_batch_multiple_thresholds(monkeypatch, capsys, response):
+    "Test that all thresholds are added to the perfdata of a single check."
+    monkeypatch.setattr(check_sl_delay, 'fetch_site',
+                        lambda *args: 'Centralen')
+    monkeypatch.setattr(check_sl_delay, 'fetch_response',
+                        lambda *args: response)
+    rows = check_sl_delay.read_sites_file(
+        io.StringIO('1002,METRO,"1,0,4",5,50\n'))
+    assert rows[0]['minutes'] == [1, 0, 4]
+
+    with pytest.raises(click.ClickException) as pytest_wrapped_e:
+        check_sl_delay.run_batch(SITE_API_KEY, DEPARTURE_API_KEY, 10, rows,
+                                 5)
+    assert pytest_wrapped_e.value.message == '1'
+    assert capsys.readouterr().out == (
+        '1002 METRO 1,0,4: WARNING: 6%|\'Percentage delayed\'=6%;5;50 ' +
+        '\'Percentage delayed 1m\'=6% \'Percentage delayed 0m\'=100% ' +
+        '\'Percentage delayed 4m\'=6%\n')
+
+
+def test_run_batch_all_traffic_types(monkeypatch, capsys, response):
+    "Test that all traffic types are checked from the same departures."
+    monkeypatch.setattr(check_sl_delay, 'fetch_site',
+                        lambda *args: 'Centralen')
+    monkeypatch.setattr(check_sl_delay, 'fetch_response',
+                        lambda *args: response)
+    rows = check_sl_delay.read_sites_file(
+        io.StringIO('1002,ALL,1,20,60\n1002,"TRAIN,METRO",1,10,60\n'))
+    rows[1]['type_policy'] = 'combined'
+
+    with pytest.raises(click.ClickException) as pytest_wrapped_e:
+        check_sl_delay.run_batch(SITE_API_KEY, DEPARTURE_API_KEY, 10, rows,
+                                 5)
+    assert pytest_wrapped_e.value.message == '1'
+    assert capsys.readouterr().out == (
+        '1002 ALL 1: WARNING: 50%|\'Percentage delayed\'=50%;20;60 ' +
+        '\'Percentage delayed METRO\'=6% \'Percentage delayed BUS\'=50% ' +
+        '\'Percentage delayed TRAIN\'=0% \'Percentage delayed TRAM\'=0% ' +
+        '\'Percentage delayed SHIP\'=0%\n' +
+        '1002 TRAIN,METRO 1: OK: 5%|\'Percentage delayed\'=5%;10;60 ' +
+        '\'Percentage delayed TRAIN\'=0% ' +
+        '\'Percentage delayed METRO\'=6%\n')
+
+
+def test_run_batch_workers(monkeypatch, capsys, response):
+    "Test that concurrent batch checks are printed in the order of the rows."
+    monkeypatch.setattr(check_sl_delay, 'fetch_site',
+                        lambda *args: 'Centralen')
+    monkeypatch.setattr(check_sl_delay, 'fetch_response',
+                        lambda *args: response)
+    rows = check_sl_delay.read_sites_file(
+        io.StringIO('1002,BUS,1\n1002,METRO,1\n1002,TRAIN,1\n' * 10))
+
+    with pytest.raises(click.ClickException) as pytest_wrapped_e:
+        check_sl_delay.run_batch(SITE_API_KEY,
+                                 DEPARTURE_API_KEY,
+                                 10,
+                                 rows,
+                                 5,
+                                 workers=4)
+    assert pytest_wrapped_e.value.message == '0'
+    assert capsys.readouterr().out.splitlines() == [
+        '1002 BUS 1: OK: 50%|\'Percentage delayed\'=50%;;',
+        '1002 METRO 1: OK: 6%|\'Percentage delayed\'=6%;;',
+        '1002 TRAIN 1: OK: 0%|\'Percentage delayed\'=0%;;'
+    ] * 10
+
+
+def test_plugin_main_invalid_site_first(monkeypatch):
+    """Test that an invalid site id is reported even when the departures fail
+    at the same time, just like when they were fetched one after the other."""
+    def fetch_response(*_args):
+        check_sl_delay.exit_plugin(error='Departures failed')
+
+    monkeypatch.setattr(check_sl_delay, 'fetch_site',
+                        lambda *args: check_sl_delay.exit_invalid_id(100))
+    monkeypatch.setattr(check_sl_delay, 'fetch_response', fetch_response)
+
+    with pytest.raises(click.ClickException) as pytest_wrapped_e:
+        check_sl_delay.plugin_main(SITE_API_KEY, DEPARTURE_API_KEY, 100, 10,
+                                   'Metros', 1, None, None)
+    assert pytest_wrapped_e.value.output == 'UNKNOWN: Invalid site id: 100'
+
+
+def test_lookup_site(monkeypatch, tmp_path):
+    "Test that site names are only fetched when they are not cached."
+    fetched = []
+
+    def fetch_site(_site_api_key, site_id, *_args):
+        fetched.append(site_id)
+        return 'Centralen'
+
+    monkeypatch.setattr(check_sl_delay, 'fetch_site', fetch_site)
+    site_cache = check_sl_delay.SiteCache(str(tmp_path), 60)
+
+    assert check_sl_delay.lookup_site('0' * 32, 1002) == 'Centralen'
+    assert check_sl_delay.lookup_site('0' * 32, 1002,
+                                      site_cache=site_cache) == 'Centralen'
+    assert check_sl_delay.lookup_site('0' * 32, 1002,
+                                      site_cache=site_cache) == 'Centralen'
+    assert fetched == [1002, 1002]
+    assert site_cache.hits == 1
+
+
+def test_lookup_response(monkeypatch, tmp_path, response):
+    "Test that departure responses are shared using the response cache."
+    fetched = []
+
+    def fetch_response(_departure_api_key, site_id, *_args):
+        fetched.append(site_id)
+        return response
+
+    monkeypatch.setattr(check_sl_delay, 'fetch_response', fetch_response)
+    response_cache = check_sl_delay.ResponseCache(str(tmp_path), 60)
+    metrics = {}
+
+    assert check_sl_delay.lookup_response('0' * 32, 1002, 10) == response
+    assert check_sl_delay.lookup_response('0' * 32,
+                                          1002,
+                                          10,
+                                          response_cache=response_cache,
+                                          metrics=metrics) == response
+    assert metrics == {'response_cache_hit': (0, '')}
+    assert check_sl_delay.lookup_response('0' * 32,
+                                          1002,
+                                          10,
+                                          response_cache=response_cache,
+                                          metrics=metrics) == response
+    assert metrics == {'response_cache_hit': (1, '')}
+    assert fetched == [1002, 1002]
+
+
+def test_departure_url():
+    "Test that the API is asked to leave out unneeded traffic types."
+    url = check_sl_delay.departure_url('0' * 32, 1002, 10)
+    assert url.endswith('&siteid=1002&timewindow=10')
+    assert check_sl_delay.departure_url('0' * 32, 1002, 10,
+                                        ['Metros', 'Trams']) == (
+                                            url + '&bus=false&train=false' +
+                                            '&ship=false')
+
+
+def test_fetch_response_traffic_types(fake_api):
+    "Test that only the departures of the traffic types are downloaded."
+    metrics = {}
+    response = check_sl_delay.fetch_response('0' * 32,
+                                             1002,
+                                             60,
+                                             traffic_types=['Metros'],
+                                             metrics=metrics)
+    assert len(response['ResponseData']['Metros']) == 100
+    # Only the departures of the traffic types are decoded.
+    assert list(response['ResponseData']) == ['Metros']
+    assert fake_api.requests['/api2/realtimedeparturesV4.json/'] == 1
+    assert set(metrics) == {'response_bytes', 'decode_time'}
+    assert metrics['response_bytes'][1] == 'B'
+    assert metrics['decode_time'][1] == 's'
+
+
+def test_lookup_response_revalidation(fake_api, tmp_path):
+    "Test that stale responses are revalidated when the API sends ETags."
+    fake_api.etags = True
+    # Every response is stale right away.
+    response_cache = check_sl_delay.ResponseCache(str(tmp_path), 0)
+    metrics = {}
+
+    response = check_sl_delay.lookup_response('0' * 32,
+                                              1002,
+                                              60,
+                                              response_cache=response_cache,
+                                              metrics=metrics,
+                                              transfer_stats=True)
+    assert 'response_bytes' in metrics
+    stale_response, validators = response_cache.stale(1002, 60)
+    assert stale_response == response
+    assert list(validators) == ['etag']
+
+    metrics = {}
+    assert check_sl_delay.lookup_response('0' * 32,
+                                          1002,
+                                          60,
+                                          response_cache=response_cache,
+                                          metrics=metrics,
+                                          transfer_stats=True) == response
+    # Not modified, so nothing was downloaded or decoded.
+    assert metrics == {'response_cache_hit': (0, '')}
+    assert fake_api.requests['/api2/realtimedeparturesV4.json/'] == 2
+    # The full response is still fetched for checks of any traffic type.
+    assert response['ResponseData']['Buses']
+
+
+def test_fetch_response_timeout():
+    "Test that a request timing out exits with state 3 (UNKNOWN)."
+    class Session:  # pylint: disable=too-few-public-methods
+        "Session where every request times out."
+
+        @staticmethod
+        def get(_url, timeout=None):
+            "Time out."
+            raise requests.exceptions.ReadTimeout('Read timed out. ' +
+                                                  '(read timeout=' +
+                                                  str(timeout) + ')')
+
+    with pytest.raises(click.ClickException) as pytest_wrapped_e:
+        check_sl_delay.fetch_response('0' * 32,
+                                      1002,
+                                      10,
+                                      request_timeout=2.5,
+                                      session=Session())
+    assert pytest_wrapped_e.value.message == '3'
+    assert pytest_wrapped_e.value.output == (
+        'UNKNOWN: HTTP request timed out: Read timed out. ' +
+        '(read timeout=2.5)')
+
+
+def test_remaining_timeout(monkeypatch):
+    "Test that requests are given the time left until the deadline."
+    func = check_sl_delay.remaining_timeout
+    monkeypatch.setattr(check_sl_delay.time, 'monotonic', lambda: 100.0)
+
+    assert func() is None
+    assert func(2.5) == 2.5
+    assert func(None, 104.0) == 4.0
+    assert func(2.5, 104.0) == 2.5
+    assert func(5, 104.0) == 4.0
+    with pytest.raises(check_sl_delay.DeadlineExceeded):
+        func(2.5, 100.0)
+
+
+def test_check_deadline(monkeypatch):
+    "Test that a check of a batch never outlasts the deadline of the batch."
+    func = check_sl_delay.check_deadline
+    monkeypatch.setattr(check_sl_delay.time, 'monotonic', lambda: 100.0)
+
+    assert func(5) == (105.0, 5)
+    assert func(5, 30, 120.0) == (105.0, 5)
+    assert func(5, 30, 102.0) == (102.0, 30)
+
+
+def test_plugin_main_deadline(fake_api):
+    "Test that the requests of a check are given up at its deadline."
+    fake_api.latency = 1
+    start = check_sl_delay.time.monotonic()
+
+    with pytest.raises(check_sl_delay.DeadlineExceeded):
+        check_sl_delay.plugin_main('0' * 32,
+                                   '0' * 32,
+                                   1002,
+                                   10,
+                                   'Metros',
+                                   1,
+                                   None,
+                                   None,
+                                   deadline=start + 0.2)
+    assert check_sl_delay.time.monotonic() - start < 0.8
+
+
+@pytest.mark.parametrize('backend', transport.BACKENDS)
+def test_plugin_main_deadline_slow_body(fake_api, backend):
+    """Test that a check is given up at its deadline, even if every chunk of
+    the response arrives within the timeout of the reads."""
+    fake_api.chunk_latency = 0.3
+    transport.configure_session(backend=backend)
+    start = check_sl_delay.time.monotonic()
+
+    with pytest.raises(check_sl_delay.DeadlineExceeded):
+        check_sl_delay.plugin_main('0' * 32,
+                                   '0' * 32,
+                                   1002,
+                                   10,
+                                   'Metros',
+                                   1,
+                                   None,
+                                   None,
+                                   deadline=start + 0.5)
+    assert check_sl_delay.time.monotonic() - start < 0.8
+    transport.configure_session()
+
+
+def test_run_checks_batch_timeout(fake_api):
+    "Test that checks which are not done within the batch timeout are UNKNOWN."
+    fake_api.latency = 0.4
+    rows = check_sl_delay.read_sites_file(io.StringIO('1002,METRO,1\n' * 3))
+
+    results = check_sl_delay.run_checks('0' * 32,
+                                        '0' * 32,
+                                        10,
+                                        rows,
+                                        5,
+                                        batch_timeout=0.6)
+    assert results[0][0] == 0
+    assert results[1:] == [(3, 'UNKNOWN: Timeout reached after 0.6 seconds')
+                           ] * 2
+
+
+@pytest.mark.usefixtures('fake_api')
+def test_run_checks_lookups_in_worker(monkeypatch):
+    """Test that the checks of a batch with several workers fetch everything
+    in their own worker."""
+    threads = []
+    for name in ('lookup_site', 'lookup_response'):
+
+        def lookup(*args, lookup_function=getattr(check_sl_delay, name)):
+            threads.append(threading.current_thread())
+            return lookup_function(*args)
+
+        monkeypatch.setattr(check_sl_delay, name, lookup)
+    rows = check_sl_delay.read_sites_file(io.StringIO('1002,METRO,1\n'))
+
+    (state, _), = check_sl_delay.run_checks('0' * 32,
+                                            '0' * 32,
+                                            10,
+                                            rows,
+                                            5,
+                                            workers=2)
+    assert state == 0
+    assert len(threads) == 2 and threads[0] is threads[1]
+
+
+def test_stage_timings(fake_api):
+    "Test that the time of every stage of a check is added to the perfdata."
+    fake_api.latency = 0.05
+    rows = check_sl_delay.read_sites_file(io.StringIO('1002,METRO,1\n'))
+    rows[0]['stage_timings'] = True
+
+    (state, output), = check_sl_delay.run_checks('0' * 32, '0' * 32, 60, rows,
+                                                 5)
+    assert state == 0
+    perfdata = dict(
+        metric.split('=') for metric in output.split('|')[1].split()[2:])
+    assert list(perfdata) == [
+        'site_time', 'api_time', 'connect_time', 'decode_time',
+        'evaluate_time'
+    ]
+    assert all(value.endswith('s') for value in perfdata.values())
+    assert float(perfdata['api_time'][:-1]) >= 0.05
+    assert float(perfdata['evaluate_time'][:-1]) < 0.05
+
+    del rows[0]['stage_timings']
+    assert '_time=' not in check_sl_delay.run_checks('0' * 32, '0' * 32, 60,
+                                                     rows, 5)[0][1]
+
+
+@pytest.mark.parametrize('cache', [False, True])
+def test_api_error_body(fake_api, tmp_path, cache):
+    "Test that an error from the API, like an exceeded quota, is UNKNOWN."
+    fake_api.departures['9192'] = {
+        'StatusCode': 1006,
+        'Message': 'Too many requests per month',
+        'ResponseData': None
+    }
+    response_cache = check_sl_delay.ResponseCache(str(tmp_path),
+                                                  60) if cache else None
+    with pytest.raises(click.ClickException) as exception_info:
+        check_sl_delay.plugin_main('0' * 32, '0' * 32, 9192, 60, 'Metros', 1,
+                                   None, None, 0, 5, None, response_cache)
+    assert exception_info.value.message == '3'
+    assert exception_info.value.output == (
+        'UNKNOWN: SL API error 1006: Too many requests per month')
+    if cache:
+        assert response_cache.get(9192, 60) is None
+
+
+def test_format_stage_times():
+    "Test the verbose output of the stage timings."
+    stage_times = {}
+    check_sl_delay.record_timing(stage_times, 'evaluate', 0.25)
+    check_sl_delay.record_timing(stage_times, 'api', 0.5)
+    check_sl_delay.record_timing(stage_times, 'api', 0.25)
+    check_sl_delay.record_timing(None, 'api', 0.25)
+    assert check_sl_delay.format_stage_times(stage_times) == (
+        'api 0.75s, evaluate 0.25s')
+
+
+def test_record_timing_concurrently():
+    "Test that no time is lost when threads record the same stage."
+    stage_times = {}
+
+    def record():
+        for _ in range(10000):
+            check_sl_delay.record_timing(stage_times, 'connect', 1.0)
+
+    threads = [threading.Thread(target=record) for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert stage_times == {'connect': 80000.0}
+
+
 @flaky
 @pytest.mark.script_launch_mode('subprocess')
 def test_invalid_site_id(script_runner):
@@ -0,0 +1,151 @@
+#!/usr/bin/env python
+# pylint: disable=redefined-outer-name
+"""Tests for the daemon mode of `check_sl_delay` and its client."""
+
+import socket
+import threading
+
+import click
+import pytest
+
+from check_sl_delay import check_sl_delay, client, daemon, scheduler
+
+API_KEY = '0' * 32
+
+
+@pytest.fixture
+def rows():
+    "Rows of a sites file, with one valid and one invalid site."
+    return [{
+        'site_id': site_id,
+        'traffic_type': 'METRO',
+        'minutes': 1,
+        'warning': 5,
+        'critical': 50,
+        'service': service
+    } for site_id, service in ((1002, 'centralen'), (100, 'invalid'))]
+
+
+@pytest.fixture
+def daemon_server(tmp_path, rows):
+    "A daemon server for `rows`, answering queries in a background thread."
+    socket_path = str(tmp_path / 'daemon.sock')
+    server = daemon.DaemonServer(socket_path,
+                                 [row['service'] for row in rows], 60)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+def test_query_before_first_poll(daemon_server):
+    "Test that services are UNKNOWN until they have been polled."
+    assert client.query('centralen', daemon_server.server_address) == (
+        3, 'UNKNOWN: No result yet, the daemon is starting')
+
+
+def test_query_unknown_service(daemon_server):
+    "Test that services missing from the sites file are UNKNOWN."
+    assert client.query('missing', daemon_server.server_address) == (
+        3, 'UNKNOWN: No such service in --sites-file: missing')
+
+
+@pytest.mark.usefixtures('fake_api')
+def test_poll_and_query(daemon_server, rows):
+    "Test that queries return the same results as the batch mode."
+    stop = threading.Event()
+
+    def check(due_rows):
+        stop.set()
+        return check_sl_delay.run_checks(API_KEY, API_KEY, 60, due_rows, 5)
+
+    # With an interval of 0, all rows are due at once.
+    daemon.poll(daemon_server, scheduler.Scheduler(rows, 0), check, stop)
+
+    assert [
+        client.query(row['service'], daemon_server.server_address)
+        for row in rows
+    ] == check_sl_delay.run_checks(API_KEY, API_KEY, 60, rows, 5)
+    assert client.query('centralen', daemon_server.server_address)[1] == (
+        "WARNING: 28%|'Percentage delayed'=28%;5;50")
+
+
+def test_poll_survives_errors(daemon_server, rows, fake_api):
+    """Test that an error from the API or an unexpected exception during a
+    poll only makes the polled services UNKNOWN."""
+    fake_api.departures['1002'] = {
+        'StatusCode': 1006,
+        'Message': 'Too many requests per month',
+        'ResponseData': None
+    }
+    stop = threading.Event()
+    polls = []
+
+    def check(due_rows):
+        if polls:
+            stop.set()
+            raise TypeError('Unexpected')
+        polls.append(
+            check_sl_delay.run_checks(API_KEY, API_KEY, 60, due_rows, 5))
+        return polls[0]
+
+    daemon.poll(daemon_server, scheduler.Scheduler(rows[:1], 0), check, stop)
+    assert polls == [[(3, 'UNKNOWN: SL API error 1006: ' +
+                       'Too many requests per month')]]
+    assert client.query('centralen', daemon_server.server_address) == (
+        3, "UNKNOWN: Poll failed: TypeError('Unexpected')")
+
+
+def test_stale_result(daemon_server, rows):
+    "Test that results older than the max age are UNKNOWN."
+    daemon_server.update(rows, [(0, 'OK'), (0, 'OK')])
+    daemon_server.max_age = -1
+    state, output = client.query('centralen', daemon_server.server_address)
+    assert state == 3
+    assert output.startswith('UNKNOWN: The latest result is ')
+
+
+def test_query_without_daemon(tmp_path):
+    "Test that the client is UNKNOWN when no daemon is running."
+    state, output = client.query('centralen', str(tmp_path / 'missing.sock'))
+    assert state == 3
+    assert output.startswith('UNKNOWN: Could not connect to daemon at ')
+
+
+def test_client_main_exit_code(daemon_server, rows, capsys):
+    "Test that the client prints the output and exits with the state."
+    daemon_server.update(rows, [(2, 'CRITICAL: 60%'), (0, 'OK')])
+    with pytest.raises(SystemExit) as exit_info:
+        client.main(['-s', daemon_server.server_address, 'centralen'])
+    assert exit_info.value.code == 2
+    assert capsys.readouterr().out == 'CRITICAL: 60%\n'
+
+
+def test_parse_reply():
+    "Test the parsing of replies from the daemon."
+    assert client.parse_reply('1\nWARNING: 25%\n') == (1, 'WARNING: 25%')
+    assert client.parse_reply('garbage')[0] == 3
+
+
+def test_check_services_duplicates(rows):
+    "Test that service names must be unique in daemon mode."
+    rows[1]['service'] = 'centralen'
+    with pytest.raises(click.ClickException) as exception_info:
+        daemon.check_services(rows)
+    assert exception_info.value.output == (
+        'ERROR: Duplicate service in --sites-file: centralen')
+
+
+def test_remove_stale_socket(tmp_path, daemon_server):
+    "Test that stale sockets are removed, but not those of running daemons."
+    stale_path = str(tmp_path / 'stale.sock')
+    stale = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    stale.bind(stale_path)
+    stale.close()
+    daemon.remove_stale_socket(stale_path)
+    assert not (tmp_path / 'stale.sock').exists()
+
+    with pytest.raises(click.ClickException):
+        daemon.remove_stale_socket(daemon_server.server_address)
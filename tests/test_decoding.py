@@ -0,0 +1,86 @@
+#!/usr/bin/env python
+# pylint: disable=redefined-outer-name
+"""Tests for the selective decoding of departure responses."""
+
+import json
+
+import pytest
+
+from check_sl_delay import check_sl_delay, decoding, fakeapi
+
+
+@pytest.fixture(params=['orjson', 'json'])
+def decoder(request, monkeypatch):
+    "Decode with orjson, if it is installed, and with the standard library."
+    if request.param == 'orjson' and decoding.orjson is None:
+        pytest.skip('orjson is not installed')
+    if request.param == 'json':
+        monkeypatch.setattr(decoding, 'orjson', None)
+    return request.param
+
+
+@pytest.mark.usefixtures('decoder')
+@pytest.mark.parametrize('filtered', [False, True])
+def test_decode_departures(filtered):
+    "Test that only the departures of the traffic types are decoded."
+    response = fakeapi.generate_response(300)
+    content = json.dumps(response, indent=1).encode('utf-8')
+    decoded = decoding.decode_departures(content, ['Metros', 'Trams'],
+                                         filtered)
+    assert decoded == {
+        'ResponseData': {
+            'Metros': response['ResponseData']['Metros'],
+            'Trams': []
+        }
+    }
+    assert check_sl_delay.sorted_delays(
+        decoded, 'Metros') == check_sl_delay.sorted_delays(response, 'Metros')
+    assert decoding.loads(content) == response
+
+
+@pytest.mark.usefixtures('decoder')
+@pytest.mark.parametrize('filtered', [False, True])
+def test_decode_unexpected_responses(filtered):
+    "Test that responses without departures are decoded in full."
+    for response in ({'StatusCode': 1001, 'ResponseData': None}, [], {}):
+        content = json.dumps(response).encode('utf-8')
+        assert decoding.decode_departures(content, ['Metros'],
+                                          filtered) == response
+    content = json.dumps({'ResponseData': {'Buses': []}}).encode('utf-8')
+    assert decoding.decode_departures(content, ['Metros'], filtered) == {
+        'ResponseData': {
+            'Metros': None
+        }
+    }
+
+
+@pytest.mark.usefixtures('decoder')
+@pytest.mark.parametrize('filtered', [False, True])
+def test_decode_invalid_json(filtered):
+    "Test that invalid responses raise like `json.loads`."
+    for content in (b'{"ResponseData": {"Metros": [', b'\xff'):
+        with pytest.raises((json.decoder.JSONDecodeError, UnicodeDecodeError)):
+            decoding.decode_departures(content, ['Metros'], filtered)
+
+
+def test_decode_unfiltered_without_orjson(monkeypatch):
+    """Test that responses of all traffic types are decoded selectively, even
+    if orjson is installed."""
+
+    class Orjson:  # pylint: disable=too-few-public-methods
+        "Stands in for orjson, which must not be used."
+
+        @staticmethod
+        def loads(_content):
+            "Fail, since the response must not be decoded in full."
+            raise AssertionError('Decoded in full')
+
+    monkeypatch.setattr(decoding, 'orjson', Orjson)
+    response = fakeapi.generate_response(10)
+    decoded = decoding.decode_departures(json.dumps(response).encode('utf-8'),
+                                         ['Buses'])
+    assert decoded == {
+        'ResponseData': {
+            'Buses': response['ResponseData']['Buses']
+        }
+    }
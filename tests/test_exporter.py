@@ -0,0 +1,183 @@
+#!/usr/bin/env python
+# pylint: disable=redefined-outer-name
+"""Tests for the Prometheus exporter mode of `check_sl_delay`."""
+
+import threading
+import urllib.error
+import urllib.request
+
+from click.testing import CliRunner
+import pytest
+
+from check_sl_delay import check_sl_delay, exporter, scheduler
+
+API_KEY = '0' * 32
+
+
+@pytest.fixture
+def rows():
+    "Rows of a sites file, with one valid and one invalid site."
+    return [{
+        'site_id': site_id,
+        'traffic_type': 'METRO',
+        'minutes': [1, 3],
+        'warning': 5,
+        'critical': 50,
+        'service': service
+    } for site_id, service in ((1002, 'centralen'), (100, 'invalid'))]
+
+
+@pytest.fixture
+def exporter_server(rows):
+    "An exporter server for `rows`, serving metrics in a background thread."
+    server = exporter.ExporterServer(('127.0.0.1', 0), rows)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+def scrape(server, path='/metrics'):
+    "Return the content type and body of a scrape of `server`."
+    url = 'http://127.0.0.1:' + str(server.server_address[1]) + path
+    with urllib.request.urlopen(url, timeout=5) as response:
+        return (response.headers['Content-Type'],
+                response.read().decode('utf-8'))
+
+
+@pytest.mark.usefixtures('fake_api')
+def test_collect(rows):
+    "Test that the metrics of a poll match the result of the check."
+    sample = exporter.collect(API_KEY, API_KEY, 60, rows[0], 5)
+    assert sample['up'] == 1
+    assert sample['state'] == 1
+    assert sample['values'] == {1: 28, 3: 6}
+    assert sample['departures'] == 100
+    assert sample['buckets'] == [65, 72, 86, 94, 94, 97, 99, 100]
+
+    assert exporter.collect(API_KEY, API_KEY, 60, rows[1], 5) == {
+        'up': 0,
+        'state': 3
+    }
+
+
+def test_collect_api_error(fake_api, rows, monkeypatch):
+    """Test that an error from the API, or an unexpected exception, only
+    marks the row as down."""
+    fake_api.departures['1002'] = {
+        'StatusCode': 1006,
+        'Message': 'Too many requests per month',
+        'ResponseData': None
+    }
+    assert exporter.collect(API_KEY, API_KEY, 60, rows[0], 5) == {
+        'up': 0,
+        'state': 3
+    }
+
+    del fake_api.departures['1002']
+    monkeypatch.setattr(check_sl_delay, 'calculate_type_values', None)
+    assert exporter.collect(API_KEY, API_KEY, 60, rows[0], 5) == {
+        'up': 0,
+        'state': 3
+    }
+
+
+def test_render_metrics(rows):
+    "Test the text format of the metrics."
+    samples = {
+        'centralen': {
+            'up': 1,
+            'state': 0,
+            'time': 1000.5,
+            'fetch_seconds': 0.25,
+            'values': {
+                1: 50
+            },
+            'departures': 2,
+            'delay_sum': 90,
+            'buckets': [1, 1, 2, 2, 2, 2, 2, 2]
+        }
+    }
+    rows[0]['service'] = 'central "en"'
+    samples['central "en"'] = samples.pop('centralen')
+    lines = exporter.render_metrics(rows, samples, {
+        ('central "en"', 'polls'): 3
+    }).splitlines()
+
+    labels = '{service="central \\"en\\"",site_id="1002",traffic_type="METRO"'
+    assert '# TYPE check_sl_delay_delay_seconds_le gauge' in lines
+    assert 'check_sl_delay_up' + labels + '} 1' in lines
+    assert 'check_sl_delay_polls_total' + labels + '} 3' in lines
+    assert 'check_sl_delay_response_cache_hits_total' + labels + '} 0' in lines
+    assert ('check_sl_delay_percentage_delayed' + labels + ',minutes="1"} 50'
+            in lines)
+    assert ('check_sl_delay_delay_seconds_le' + labels + ',le="60"} 1'
+            in lines)
+    assert ('check_sl_delay_delay_seconds_le' + labels + ',le="+Inf"} 2'
+            in lines)
+    assert 'check_sl_delay_delay_sum_seconds' + labels + '} 90' in lines
+    assert not any('histogram' in line for line in lines)
+    # Rows which have not been polled yet are left out.
+    assert not any('site_id="100"' in line for line in lines)
+
+
+def test_render_scheduler_metrics(rows):
+    "Test the metrics of the scheduler and the rate limits."
+    schedule = scheduler.Scheduler(rows, 60, now=0)
+    lines = exporter.render_metrics(rows, {}, {}, schedule).splitlines()
+    assert 'check_sl_delay_scheduler_queue_depth 2' in lines
+    assert ('check_sl_delay_poll_interval_seconds{service="centralen",' +
+            'site_id="1002",traffic_type="METRO"} 60') in lines
+    assert ('check_sl_delay_api_rate_limit_per_minute{api="departure"} 0'
+            in lines)
+    assert any(
+        line.startswith('check_sl_delay_api_requests_total{api="site"} ')
+        for line in lines)
+
+
+def test_scrape(fake_api, exporter_server, rows):
+    "Test that scrapes serve the latest poll without calling the APIs."
+    exporter_server.update(
+        rows,
+        [exporter.collect(API_KEY, API_KEY, 60, row, 5) for row in rows])
+    requests = sum(fake_api.requests.values())
+
+    content_type, body = scrape(exporter_server)
+    scrape(exporter_server)
+    assert content_type == exporter.CONTENT_TYPE
+    assert ('check_sl_delay_up{service="invalid",site_id="100",' +
+            'traffic_type="METRO"} 0') in body
+    assert ('check_sl_delay_departures{service="centralen",site_id="1002",' +
+            'traffic_type="METRO"} 100') in body
+    assert sum(fake_api.requests.values()) == requests
+
+
+def test_scrape_other_path(exporter_server):
+    "Test that only /metrics is served."
+    with pytest.raises(urllib.error.HTTPError) as exception_info:
+        scrape(exporter_server, '/')
+    assert exception_info.value.code == 404
+
+
+@pytest.mark.parametrize('option', [['--engine', 'async'],
+                                    ['--history-window', '30']])
+def test_exporter_usage(tmp_path, option):
+    "Test that options which the exporter does not support are rejected."
+    sites_file = tmp_path / 'sites.csv'
+    sites_file.write_text('1002,METRO,1,20,30,centralen\n')
+    result = CliRunner().invoke(check_sl_delay.cli, [
+        '-a', API_KEY, '-A', API_KEY, '-p', '60', '--sites-file',
+        str(sites_file), '--exporter'
+    ] + option)
+    assert result.exit_code == 2
+    assert '--exporter' in result.output
+
+
+def test_parse_listen():
+    "Test the parsing of the --listen option."
+    assert check_sl_delay.parse_listen(':9861') == ('', 9861)
+    assert check_sl_delay.parse_listen('localhost:9861') == ('localhost',
+                                                             9861)
+    for text in ('9861', 'localhost:', 'localhost:http', ':65536'):
+        with pytest.raises(ValueError):
+            check_sl_delay.parse_listen(text)
@@ -0,0 +1,114 @@
+#!/usr/bin/env python
+"""Tests for the local stand-in for the SL APIs, and for pointing the plugin
+at it."""
+
+import json
+import urllib.error
+import urllib.request
+
+from click.testing import CliRunner
+import pytest
+
+from check_sl_delay import check_sl_delay, fakeapi
+
+API_KEY = '0' * 32
+
+
+def get(url):
+    "Return the decoded JSON response of `url`."
+    with urllib.request.urlopen(url, timeout=5) as response:
+        return json.loads(response.read().decode('utf-8'))
+
+
+def test_error_rate():
+    "Test that a fraction of the requests fail with 503."
+    server = fakeapi.start_server({'': fakeapi.generate_response(10)},
+                                  error_rate=0.5)
+    url = fakeapi.api_urls(server.base_url)[1] + '?siteid=1002'
+    errors = 0
+    for _ in range(40):
+        try:
+            get(url)
+        except urllib.error.HTTPError as exception:
+            assert exception.code == 503
+            errors += 1
+    server.shutdown()
+    server.server_close()
+    assert 5 < errors < 35
+
+
+def test_record_and_replay(fake_api, tmp_path):
+    """Test that responses are recorded without the API key, for all traffic
+    types, and replayed like the recorded API."""
+    recorder = fakeapi.start_server({},
+                                    recordings=str(tmp_path),
+                                    upstream=fake_api.base_url)
+    site_url, departure_url = fakeapi.api_urls(recorder.base_url)
+    query = '?key=' + API_KEY + '&siteid=1002&timewindow=60&bus=false'
+    recorded = get(departure_url + query)
+    assert recorded['ResponseData']['Buses'] == []
+    assert get(site_url + '?key=' + API_KEY +
+               '&searchstring=1002')['ResponseData'][0]['Name'] == 'Centralen'
+    recorder.shutdown()
+    recorder.server_close()
+
+    assert sorted(path.name for path in tmp_path.iterdir()) == [
+        'departures-1002.json', 'site-1002.json'
+    ]
+    assert all(API_KEY not in path.read_text() for path in tmp_path.iterdir())
+    assert json.loads((tmp_path / 'departures-1002.json').read_text()) == (
+        fakeapi.generate_response(300))
+
+    replayer = fakeapi.start_server({'': fakeapi.generate_response(5)},
+                                    recordings=str(tmp_path))
+    site_url, departure_url = fakeapi.api_urls(replayer.base_url)
+    assert get(departure_url + query) == recorded
+    assert len(get(departure_url + '?siteid=1003')['ResponseData']
+               ['Metros']) == 2
+    assert get(site_url + '?searchstring=1002')['ResponseData'][0][
+        'Name'] == 'Centralen'
+    replayer.shutdown()
+    replayer.server_close()
+    assert fake_api.requests['/api2/realtimedeparturesV4.json/'] == 1
+
+
+def test_configure_api_urls(monkeypatch):
+    "Test that the requests can be sent to another base URL."
+    monkeypatch.setattr(check_sl_delay, 'SITE_API_URL', None)
+    monkeypatch.setattr(check_sl_delay, 'DEPARTURE_API_URL', None)
+    check_sl_delay.configure_api_urls('http://127.0.0.1:8080/')
+    assert check_sl_delay.site_url(API_KEY, 1002).startswith(
+        'http://127.0.0.1:8080/api2/typeahead.json/?')
+    check_sl_delay.configure_api_urls()
+    assert check_sl_delay.departure_url(API_KEY, 1002, 10).startswith(
+        'https://api.sl.se/api2/realtimedeparturesV4.json/?')
+
+
+def test_base_url_option(fake_api, monkeypatch):
+    "Test that the plugin can be pointed at the stand-in from the environment."
+    monkeypatch.setattr(check_sl_delay, 'SITE_API_URL', None)
+    monkeypatch.setattr(check_sl_delay, 'DEPARTURE_API_URL', None)
+    arguments = [
+        '-a', API_KEY, '-A', API_KEY, '-i', '1002', '-m', '1', '-p', '60',
+        '-T', 'METRO', '-w', '20', '-c', '30', '--no-cache'
+    ]
+    result = CliRunner().invoke(
+        check_sl_delay.cli,
+        arguments,
+        env={check_sl_delay.BASE_URL_ENVVAR: fake_api.base_url})
+    assert result.exit_code == 1
+    assert result.output == "WARNING: 28%|'Percentage delayed'=28%;20;30\n"
+
+    result = CliRunner().invoke(check_sl_delay.cli,
+                                arguments + ['--base-url', 'api.sl.se'])
+    assert result.exit_code == 2
+    assert 'must start with http:// or https://' in result.output
+
+
+@pytest.mark.parametrize('argv', [['--record', 'a', '--replay', 'b'],
+                                  ['--listen', '8080']])
+def test_main_usage(argv):
+    "Test that invalid command lines are rejected."
+    with pytest.raises(SystemExit) as exception_info:
+        fakeapi.main(argv)
+    assert exception_info.value.code == 2
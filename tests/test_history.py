@@ -0,0 +1,113 @@
+#!/usr/bin/env python
+"""Tests for the history of delays of `check_sl_delay`."""
+
+import sqlite3
+
+import click
+import pytest
+
+from check_sl_delay import history
+
+
+def test_window(tmp_path):
+    "Test that departures are evaluated over the window of the history."
+    delay_history = history.DelayHistory(str(tmp_path), 30 * 60, 3600)
+
+    delay_history.record(1002,
+                         'Buses', [(None, 0), (None, 59), (None, 60),
+                                   (None, 130)],
+                         now=6000.0)
+    delay_history.record(1002, 'Buses', [(None, 300)], now=6100.0)
+    delay_history.record(1002, 'Metros', [(None, 0)], now=6100.0)
+    delay_history.record(9192, 'Buses', [(None, 0)], now=6100.0)
+
+    assert delay_history.histogram(1002, 'Buses', now=6100.0) == {
+        0: 2,
+        1: 1,
+        2: 1,
+        5: 1
+    }
+    # The window starts at the beginning of a bucket, 30 buckets back.
+    assert delay_history.histogram(1002, 'Buses', now=7739.0) == {
+        0: 2,
+        1: 1,
+        2: 1,
+        5: 1
+    }
+    assert delay_history.histogram(1002, 'Buses', now=7800.0) == {5: 1}
+    assert not delay_history.histogram(1002, 'Buses', now=7860.0)
+
+
+def test_departures_counted_once(tmp_path):
+    """Test that a departure seen by several polls is counted once, with its
+    latest delay in the bucket of the latest poll."""
+    delay_history = history.DelayHistory(str(tmp_path), 30 * 60, 3600)
+
+    delay_history.record(1002, 'Buses', [('1/a/1', 0), ('2/a/1', 0)],
+                         now=6000.0)
+    delay_history.record(1002, 'Buses', [('1/a/1', 150), ('3/a/1', 0)],
+                         now=6300.0)
+    delay_history.record(1002, 'Metros', [('1/a/1', 0)], now=6300.0)
+
+    assert delay_history.histogram(1002, 'Buses', now=6300.0) == {0: 2, 2: 1}
+    # The first departure has moved to the bucket of the second poll.
+    assert delay_history.histogram(1002, 'Buses', now=7799.0) == {0: 2, 2: 1}
+    assert delay_history.histogram(1002, 'Buses', now=7800.0) == {0: 1, 2: 1}
+    assert delay_history.stats().startswith('History: 4 samples')
+
+
+def test_shared_between_instances(tmp_path):
+    "Test that the history is shared by instances using the same directory."
+    delay_history = history.DelayHistory(str(tmp_path / 'cache'), 600, 3600)
+    assert delay_history.update(1002,
+                                'Buses', [('1/a/1', 0), ('2/a/1', 120)],
+                                now=6000.0) == {
+                                    0: 1,
+                                    2: 1
+                                }
+    other_history = history.DelayHistory(str(tmp_path / 'cache'), 600, 3600)
+    assert other_history.update(1002,
+                                'Buses', [('1/a/1', 120)],
+                                now=6010.0) == {
+                                    2: 2
+                                }
+    assert other_history.stats() == ('History: 2 samples in ' +
+                                     str(tmp_path / 'cache' /
+                                         'history.sqlite'))
+    delay_history.close()
+    other_history.close()
+
+
+def test_retention(tmp_path):
+    "Test that departures older than the retention period are removed."
+    delay_history = history.DelayHistory(str(tmp_path), 600, 600)
+    delay_history.record(1002, 'Buses', [(None, 0), (None, 120)], now=6000.0)
+    delay_history.record(1002, 'Buses', [(None, 60)], now=6599.0)
+    assert delay_history.stats().startswith('History: 3 samples')
+
+    delay_history.record(1002, 'Buses', [(None, 60)], now=6660.0)
+    assert delay_history.stats().startswith('History: 2 samples')
+    with sqlite3.connect(delay_history.path) as connection:
+        assert connection.execute(
+            'SELECT COUNT(*) FROM buckets').fetchall() == [(2, )]
+
+
+def test_old_schema(tmp_path):
+    "Test that a history with another schema is recreated."
+    with sqlite3.connect(str(tmp_path / 'history.sqlite')) as connection:
+        connection.execute('CREATE TABLE samples (delay INTEGER)')
+    delay_history = history.DelayHistory(str(tmp_path), 600, 3600)
+
+    assert delay_history.update(1002, 'Buses', [('1/a/1', 0)]) == {0: 1}
+
+
+def test_unusable_history(tmp_path):
+    "Test that a history which cannot be used exits the plugin with UNKNOWN."
+    (tmp_path / 'history.sqlite').write_text('Not a database.' * 100)
+    delay_history = history.DelayHistory(str(tmp_path), 600, 3600)
+
+    with pytest.raises(click.ClickException) as pytest_wrapped_e:
+        delay_history.update(1002, 'Buses', [(None, 0)])
+    assert pytest_wrapped_e.value.message == '3'
+    assert pytest_wrapped_e.value.output.startswith(
+        'UNKNOWN: Could not use the history in ' + delay_history.path + ': ')
@@ -0,0 +1,118 @@
+#!/usr/bin/env python
+"""Tests for the verbose output, and for writing it to the JSON log sink."""
+
+import json
+import socket
+
+from click.testing import CliRunner
+import pytest
+
+from check_sl_delay import check_sl_delay, transport
+
+API_KEY = 'a1' * 16
+
+ARGUMENTS = [
+    '-a', API_KEY, '-A', API_KEY, '-i', '1002', '-m', '1', '-p', '60', '-T',
+    'METRO', '-w', '20', '-c', '30', '--no-cache'
+]
+
+
+@pytest.fixture(autouse=True)
+def no_log_sink():
+    "Close any log sink opened by a test."
+    yield
+    check_sl_delay.configure_log_sink()
+
+
+def test_redact_api_keys():
+    "Test that the API keys in URLs are redacted."
+    assert check_sl_delay.redact_api_keys(
+        'URL: https://api.sl.se/api2/typeahead.json/?key=' + API_KEY +
+        '&searchstring=1002 (fetch_site)') == (
+            'URL: https://api.sl.se/api2/typeahead.json/?key=REDACTED' +
+            '&searchstring=1002 (fetch_site)')
+    assert check_sl_delay.redact_api_keys(
+        "KeyError('/?key=" + API_KEY + "')") == "KeyError('/?key=REDACTED')"
+    assert check_sl_delay.redact_api_keys('monkey=1') == 'monkey=1'
+
+
+@pytest.mark.parametrize('backend', transport.BACKENDS)
+def test_request_error_is_redacted(monkeypatch, backend):
+    "Test that the API keys are left out of the errors of failed requests."
+    monkeypatch.setattr(check_sl_delay, 'SITE_API_URL', None)
+    monkeypatch.setattr(check_sl_delay, 'DEPARTURE_API_URL', None)
+    # A port which nothing listens on.
+    with socket.socket() as closed_socket:
+        closed_socket.bind(('127.0.0.1', 0))
+        port = closed_socket.getsockname()[1]
+
+    result = CliRunner().invoke(
+        check_sl_delay.cli, ARGUMENTS + [
+            '--base-url', 'http://127.0.0.1:' + str(port), '--http-backend',
+            backend
+        ])
+    assert result.exit_code == 3
+    assert result.output.startswith(
+        'UNKNOWN: Encountered an exception during HTTP request: ')
+    assert 'Connection refused' in result.output
+    assert API_KEY not in result.output
+    assert 'ConnectionPool' not in result.output
+    transport.configure_session()
+
+
+def test_maybe_output_is_lazy(capsys):
+    "Test that messages are only formatted when they are output."
+    calls = []
+
+    def format_value():
+        calls.append(None)
+        return 'value'
+
+    lazy_value = check_sl_delay.LazyFormat(format_value)
+    check_sl_delay.maybe_output([2], 0, 'Value: %s', (lazy_value, ))
+    check_sl_delay.maybe_output([2], 1, 'Value: %s', (lazy_value, ))
+    assert not calls
+    assert capsys.readouterr().out == ''
+
+    check_sl_delay.maybe_output([2], 2, 'Value: %s', (lazy_value, ))
+    assert calls == [None]
+    assert capsys.readouterr().out == 'Value: value\n'
+
+
+def test_log_json(fake_api, tmp_path):
+    """Test that all verbose output is written to the sink, with structured
+    fields and without the API keys, and that the check is not affected."""
+    log_path = tmp_path / 'check.jsonl'
+    result = CliRunner().invoke(
+        check_sl_delay.cli,
+        ARGUMENTS + ['--log-json', str(log_path), '--stage-timings'])
+    assert result.exit_code == 1
+    assert result.output.startswith(
+        "WARNING: 28%|'Percentage delayed'=28%;20;30 site_time=")
+    assert fake_api.requests['/api2/typeahead.json/'] == 1
+
+    text = log_path.read_text()
+    assert API_KEY not in text
+    entries = [json.loads(line) for line in text.splitlines()]
+    assert all(entry['level'] == 'debug' for entry in entries)
+    assert entries[0]['message'] == 'Variables:'
+    timings = [
+        entry for entry in entries
+        if entry['message'].startswith('Request timing: ')
+    ]
+    assert sorted(entry['stage'] for entry in timings) == ['api', 'site']
+    assert all(entry['site'] == 1002 and entry['duration'] > 0
+               for entry in timings)
+    assert any('key=REDACTED' in entry['message'] for entry in entries)
+    stage_times = [
+        entry['stage_times'] for entry in entries if 'stage_times' in entry
+    ]
+    assert set(stage_times[0]) == set(check_sl_delay.STAGES)
+
+
+def test_log_json_not_opened(tmp_path):
+    "Test that a log sink which cannot be opened is a usage error."
+    result = CliRunner().invoke(check_sl_delay.cli,
+                                ARGUMENTS + ['--log-json', str(tmp_path)])
+    assert result.exit_code == 2
+    assert '--log-json' in result.output
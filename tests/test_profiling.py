@@ -0,0 +1,116 @@
+#!/usr/bin/env python
+"""Tests for profiling single checks."""
+
+import pstats
+
+from click.testing import CliRunner
+
+from check_sl_delay import check_sl_delay, profiling
+
+API_KEY = '0' * 32
+
+ARGUMENTS = [
+    '-a', API_KEY, '-A', API_KEY, '-i', '1002', '-m', '1', '-p', '60', '-T',
+    'METRO', '-w', '20', '-c', '30', '--no-cache'
+]
+
+
+def test_profile(fake_api, tmp_path):
+    """Test that the profile includes the threads fetching the site and the
+    departures, and that the check is not affected."""
+    profile_dir = tmp_path / 'profiles'
+    result = CliRunner().invoke(check_sl_delay.cli,
+                                ARGUMENTS + ['--profile', str(profile_dir)])
+    assert result.exit_code == 1
+    assert result.output == "WARNING: 28%|'Percentage delayed'=28%;20;30\n"
+    assert fake_api.requests['/api2/realtimedeparturesV4.json/'] == 1
+
+    paths = list(profile_dir.iterdir())
+    assert len(paths) == 1
+    assert paths[0].name.startswith('check_sl_delay-1002-')
+    assert paths[0].name.endswith('.pstats')
+    functions = {
+        function
+        for _, _, function in pstats.Stats(str(paths[0])).stats
+    }
+    assert {'plugin_main', 'fetch_site', 'fetch_response'} <= functions
+
+
+def test_profile_memory(fake_api, tmp_path):
+    "Test that the memory profile lists the peak of every stage."
+    result = CliRunner().invoke(
+        check_sl_delay.cli,
+        ARGUMENTS + ['--profile', str(tmp_path), '--profile-memory'])
+    assert result.exit_code == 1
+    assert result.output.startswith(
+        "WARNING: 28%|'Percentage delayed'=28%;20;30 site_time=")
+    assert fake_api.requests['/api2/typeahead.json/'] == 1
+
+    paths = list(tmp_path.iterdir())
+    assert len(paths) == 1
+    assert paths[0].name.endswith('.memory.txt')
+    lines = paths[0].read_text().splitlines()
+    assert lines[0].startswith('Peak memory of the check: ')
+    for stage in ('site', 'api', 'decode', 'evaluate'):
+        assert any(line.startswith('  ' + stage + ': ') for line in lines)
+    assert 'Largest allocations:' in lines
+
+
+def test_profile_not_written(fake_api, tmp_path):
+    "Test that a profile which cannot be written does not affect the check."
+    not_a_directory = tmp_path / 'file'
+    not_a_directory.write_text('')
+    result = CliRunner().invoke(
+        check_sl_delay.cli,
+        ARGUMENTS + ['--profile', str(not_a_directory / 'profiles'), '-vv'])
+    assert result.exit_code == 1
+    assert 'Could not write profile: ' in result.output
+    assert result.output.endswith("|'Percentage delayed'=28%;20;30\n")
+    assert fake_api.requests['/api2/realtimedeparturesV4.json/'] == 1
+
+
+def test_profile_usage(tmp_path):
+    "Test that profiling is only allowed for single checks."
+    result = CliRunner().invoke(check_sl_delay.cli,
+                                ARGUMENTS + ['--profile-memory'])
+    assert result.exit_code == 2
+    assert '--profile-memory requires --profile.' in result.output
+
+    sites_file = tmp_path / 'sites.csv'
+    sites_file.write_text('1002,METRO,1,20,30,Centralen\n')
+    result = CliRunner().invoke(check_sl_delay.cli, [
+        '-a', API_KEY, '-A', API_KEY, '-p', '60', '--sites-file',
+        str(sites_file), '--profile',
+        str(tmp_path)
+    ])
+    assert result.exit_code == 2
+    assert '--profile only profiles single checks' in result.output
+
+
+def test_profile_environment_batch(fake_api, tmp_path):
+    """Test that a profile directory from the environment does not fail the
+    checks of a sites file, which are not profiled."""
+    sites_file = tmp_path / 'sites.csv'
+    sites_file.write_text('1002,METRO,1,20,30,Centralen\n')
+    profile_dir = tmp_path / 'profiles'
+    result = CliRunner().invoke(
+        check_sl_delay.cli,
+        ['-a', API_KEY, '-A', API_KEY, '-p', '60', '--sites-file',
+         str(sites_file), '--no-cache', '-vv'],
+        env={
+            'CHECK_SL_DELAY_PROFILE': str(profile_dir),
+            'CHECK_SL_DELAY_PROFILE_MEMORY': '1'
+        })
+    assert result.exit_code == 1
+    assert 'Not profiling --sites-file from the environment: ' in (
+        result.output)
+    assert result.output.endswith("|'Percentage delayed'=28%;20;30\n")
+    assert fake_api.requests['/api2/realtimedeparturesV4.json/'] == 1
+    assert not profile_dir.exists()
+
+
+def test_profile_path():
+    "Test that the profiles of a check are named after it."
+    path = profiling.profile_path('profiles', '1002', '.pstats')
+    assert path.startswith('profiles/check_sl_delay-1002-')
+    assert path.endswith('.pstats')
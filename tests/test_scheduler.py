@@ -0,0 +1,122 @@
+#!/usr/bin/env python
+# pylint: disable=redefined-outer-name
+"""Tests for the scheduling and rate limits of `check_sl_delay`."""
+
+import time
+
+import pytest
+
+from check_sl_delay import check_sl_delay, scheduler
+
+
+@pytest.fixture
+def rows():
+    "Rows of a sites file, for four different sites."
+    return [{
+        'site_id': site_id,
+        'service': str(site_id)
+    } for site_id in (9001, 9002, 9003, 9004)]
+
+
+@pytest.fixture
+def rate_limits():
+    "Rate limits which are removed after the test."
+    yield scheduler.configure_rate_limits
+    scheduler.configure_rate_limits()
+
+
+def test_rate_limit_spacing():
+    "Test that requests are spaced evenly once the burst is used."
+    limit = scheduler.RateLimit(60)
+    assert [limit.reserve(now=100.0) for _ in range(3)] == [0, 1, 2]
+    assert limit.reserve(now=101.5) == 1.5
+    # The bucket refills, but never above the burst.
+    assert limit.reserve(now=200.0) == 0
+    assert limit.reserve(now=200.0) == 1
+    assert limit.requests == 6
+    assert limit.waited == 5.5
+
+
+def test_rate_limit_unlimited():
+    "Test that requests are only counted without a rate limit."
+    limit = scheduler.RateLimit()
+    assert [limit.reserve() for _ in range(100)] == [0] * 100
+    assert limit.requests == 100
+    assert limit.acquire(time.monotonic() - 1)
+
+
+def test_rate_limit_deadline():
+    "Test that requests which would wait past the deadline are given up."
+    limit = scheduler.RateLimit(1)
+    assert limit.acquire()
+    assert not limit.acquire(time.monotonic() + 1)
+    assert limit.requests == 1
+    assert limit.waiting == 0
+    assert limit.waited == 0
+
+
+def test_wait_for_rate_limit(rate_limits):
+    "Test that the plugin gives up requests which the deadline does not allow."
+    rate_limits(departure_rate=1)
+    check_sl_delay.wait_for_rate_limit('departure')
+    with pytest.raises(check_sl_delay.DeadlineExceeded):
+        check_sl_delay.wait_for_rate_limit('departure',
+                                           time.monotonic() + 5)
+    check_sl_delay.wait_for_rate_limit('site', time.monotonic())
+    assert scheduler.rate_limit('site').requests == 1
+
+
+def test_record_departures():
+    "Test that departures of all traffic types are counted."
+    scheduler.record_departures(9101, {
+        'ResponseData': {
+            'Buses': [{}, {}],
+            'Metros': [{}],
+            'Ships': None,
+            'LatestUpdate': '2020-03-27T12:00:00'
+        }
+    })
+    assert scheduler.departures(9101) == 3
+    scheduler.record_departures(9102, {'StatusCode': 1006})
+    assert scheduler.departures(9102) is None
+
+
+def test_spread_polls(rows):
+    "Test that the first polls are spread evenly over the interval."
+    schedule = scheduler.Scheduler(rows, 60, now=0)
+    assert schedule.due(now=0) == rows[:1]
+    assert schedule.wait(now=0) == 15
+    assert schedule.queue_depth(now=30) == 2
+    assert schedule.due(now=30) == rows[1:3]
+    schedule.done(now=31)
+    assert schedule.due(now=59) == rows[3:]
+    schedule.done(now=59)
+    # Every row is polled one interval after it was due.
+    assert [schedule.due(now=due) for due in (60, 75, 90, 105)] == [
+        [row] for row in rows
+    ]
+
+
+def test_late_polls(rows):
+    "Test that rows which were polled late are rescheduled from now."
+    schedule = scheduler.Scheduler(rows[:1], 60, now=0)
+    schedule.due(now=0)
+    schedule.done(now=100)
+    assert schedule.wait(now=100) == 0
+
+
+def test_quiet_sites(rows):
+    "Test that sites with few departures are polled less often."
+    for row, departures in zip(rows, (0, 5, 10, 50)):
+        scheduler.record_departures(row['site_id'],
+                                    {'ResponseData': {
+                                        'Buses': [{}] * departures
+                                    }})
+    schedule = scheduler.Scheduler(rows, 60, 300, now=0)
+    assert [schedule.row_interval(row) for row in rows] == [300, 180, 60, 60]
+
+    schedule.due(now=0)
+    schedule.done(now=1)
+    assert schedule.intervals[0] == 300
+    assert schedule.due(now=299) == rows[1:]
+    assert schedule.due(now=300) == rows[:1]
@@ -0,0 +1,61 @@
+#!/usr/bin/env python
+"""Tests for the startup time of `check_sl_delay`, which dominates the cost of
+a single check."""
+
+import subprocess
+import sys
+
+from flaky import flaky
+import pytest
+
+# Budget for importing the plugin, in microseconds, as measured by
+# `python -X importtime`. Without the lazy imports it is about three times as
+# much.
+IMPORT_BUDGET = 150000
+
+# Modules which are only imported when they are needed.
+LAZY_MODULES = ('requests', 'urllib3', 'func_timeout', 'concurrent.futures',
+                'aiohttp', 'http.client', 'sqlite3', 'orjson',
+                'cProfile', 'tracemalloc', 'logging')
+
+
+def import_times(module):
+    """Import `module` in a new interpreter and return a dictionary of the
+    cumulative import time, in microseconds, of every imported module."""
+    result = subprocess.run(
+        [sys.executable, '-X', 'importtime', '-c', 'import ' + module],
+        stdout=subprocess.PIPE,
+        stderr=subprocess.PIPE,
+        universal_newlines=True,
+        check=True)
+    times = {}
+    for line in result.stderr.splitlines():
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        _, cumulative, name = line[len('import time:'):].split('|')
+        times[name.strip()] = int(cumulative)
+    return times
+
+
+@pytest.mark.parametrize(
+    'module', ['check_sl_delay.check_sl_delay', 'check_sl_delay.transport'])
+def test_heavy_modules_are_lazy(module):
+    "Test that importing the plugin does not import the heavy modules."
+    times = import_times(module)
+    assert module in times
+    for lazy_module in LAZY_MODULES:
+        assert lazy_module not in times
+
+
+def test_client_does_not_import_plugin():
+    "Test that the daemon client only imports what it needs."
+    times = import_times('check_sl_delay.client')
+    assert 'click' not in times
+    assert 'check_sl_delay.check_sl_delay' not in times
+
+
+@flaky(max_runs=3)
+def test_import_budget():
+    "Test that importing the plugin stays within the budget."
+    assert import_times('check_sl_delay.check_sl_delay')[
+        'check_sl_delay.check_sl_delay'] < IMPORT_BUDGET
@@ -0,0 +1,175 @@
+#!/usr/bin/env python
+# pylint: disable=redefined-outer-name
+"""Tests for the HTTP transport of `check_sl_delay`."""
+
+import socket
+import threading
+import time
+
+import pytest
+
+from check_sl_delay import fakeapi, stdlib_backend, transport
+
+
+@pytest.fixture
+def fake_api():
+    "A local stand-in for the SL APIs."
+    server = fakeapi.start_server({'': fakeapi.generate_response(10)})
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+@pytest.mark.parametrize('backend', transport.BACKENDS)
+def test_connections_are_reused(fake_api, backend):
+    "Test that only the first request needs a handshake."
+    session = transport.create_session(backend=backend)
+    url = fakeapi.api_urls(fake_api.base_url)[1] + '?siteid=1002'
+
+    response, timings = transport.timed_get(url, 5, session)
+    assert response.json() == fakeapi.generate_response(10)
+    assert timings['connect'] > 0
+    assert timings['transfer'] > 0
+
+    response, timings = transport.timed_get(url, 5, session)
+    assert response.status_code == 200
+    assert timings['connect'] == 0
+    assert timings['transfer'] > 0
+
+
+@pytest.mark.parametrize('backend', transport.BACKENDS)
+def test_compressed_responses(fake_api, backend):
+    "Test that responses are downloaded compressed by all backends."
+    session = transport.create_session(backend=backend)
+    url = fakeapi.api_urls(fake_api.base_url)[1] + '?siteid=1002'
+
+    response, timings = transport.timed_get(url, 5, session)
+    assert response.json() == fakeapi.generate_response(10)
+    assert 0 < timings['bytes'] < len(response.content)
+
+
+@pytest.mark.parametrize('backend', transport.BACKENDS)
+def test_conditional_requests(fake_api, backend):
+    "Test that extra headers are sent by all backends."
+    fake_api.etags = True
+    session = transport.create_session(backend=backend)
+    url = fakeapi.api_urls(fake_api.base_url)[1] + '?siteid=1002'
+
+    response = transport.timed_get(url, 5, session)[0]
+    response = transport.timed_get(
+        url, 5, session, {'If-None-Match': response.headers['ETag']})[0]
+    assert response.status_code == 304
+    assert not response.content
+
+
+@pytest.mark.parametrize('backend', transport.BACKENDS)
+def test_request_timeout(fake_api, backend):
+    "Test that timeouts are raised as RequestTimeout by all backends."
+    fake_api.latency = 0.5
+    url = fakeapi.api_urls(fake_api.base_url)[1] + '?siteid=1002'
+
+    session = transport.create_session(backend=backend)
+    with pytest.raises(transport.RequestTimeout):
+        transport.timed_get(url, 0.1, session)
+
+
+@pytest.mark.parametrize('backend', transport.BACKENDS)
+def test_request_error(fake_api, backend):
+    "Test that connection errors are raised as RequestError by all backends."
+    url = fakeapi.api_urls(fake_api.base_url)[1]
+    fake_api.shutdown()
+    fake_api.server_close()
+
+    with pytest.raises(transport.RequestError):
+        transport.timed_get(url, 1, transport.create_session(backend=backend))
+
+
+def test_create_session():
+    "Test that the pool size and retries are configured for both schemes."
+    session = transport.create_session(pool_size=32,
+                                       retries=3,
+                                       backoff_factor=0.1)
+
+    for prefix in ('http://', 'https://'):
+        adapter = session.get_adapter(prefix + 'api.sl.se/')
+        assert adapter.max_retries.total == 3
+        assert adapter.max_retries.backoff_factor == 0.1
+        assert adapter.poolmanager.connection_pool_kw['maxsize'] == 32
+
+
+def test_shared_session():
+    "Test that the shared session is only replaced when configured."
+    session = transport.get_session()
+    assert transport.get_session() is session
+
+    transport.configure_session(pool_size=5)
+    assert transport.get_session() is not session
+
+    transport.configure_session(backend='stdlib')
+    assert isinstance(transport.get_session(),
+                      stdlib_backend.StdlibSession)
+    transport.configure_session()
+
+
+def test_format_timings():
+    "Test that the timings are described for the verbose output."
+    assert transport.format_timings({
+        'connect': 0.0412,
+        'transfer': 0.1234
+    }) == 'new connection, handshake 0.041s, transfer 0.123s'
+    assert transport.format_timings({
+        'connect': 0,
+        'transfer': 0.1
+    }) == 'reused connection, transfer 0.1s'
+    assert transport.format_timings({
+        'connect': 0,
+        'transfer': 0.1,
+        'bytes': 2048
+    }) == 'reused connection, transfer 0.1s, 2048 bytes'
+
+
+@pytest.mark.parametrize('backend', transport.BACKENDS)
+def test_slow_resolver(monkeypatch, backend):
+    "Test that resolving the host of a request is bound by its timeout."
+    getaddrinfo = socket.getaddrinfo
+
+    def slow_getaddrinfo(host, *args):
+        if host == 'slow.invalid':
+            # The flags, which are only given for numeric hosts.
+            if args[4:] and args[4] & socket.AI_NUMERICHOST:
+                raise socket.gaierror('Not a numeric host')
+            time.sleep(2)
+            host = '127.0.0.1'
+        return getaddrinfo(host, *args)
+
+    monkeypatch.setattr(socket, 'getaddrinfo', slow_getaddrinfo)
+    session = transport.create_session(backend=backend)
+    start = time.monotonic()
+    with pytest.raises(transport.RequestTimeout,
+                       match='Resolving slow.invalid timed out'):
+        transport.timed_get('http://slow.invalid/', 0.2, session)
+    assert time.monotonic() - start < 1
+
+
+def test_hanging_resolver(monkeypatch):
+    "Test that a hanging lookup of a host is shared instead of repeated."
+    getaddrinfo = socket.getaddrinfo
+    lookups = []
+    release = threading.Event()
+
+    def hanging_getaddrinfo(host, *args):
+        if host == 'hanging.invalid':
+            if args[4:] and args[4] & socket.AI_NUMERICHOST:
+                raise socket.gaierror('Not a numeric host')
+            lookups.append(host)
+            release.wait(5)
+            host = '127.0.0.1'
+        return getaddrinfo(host, *args)
+
+    monkeypatch.setattr(socket, 'getaddrinfo', hanging_getaddrinfo)
+    for _ in range(3):
+        with pytest.raises(socket.timeout):
+            transport.resolve('hanging.invalid', 80, 0.05)
+    assert lookups == ['hanging.invalid']
+    release.set()
+    assert transport.resolve('hanging.invalid', 80, 1)[0][4][0] == '127.0.0.1'